@@ -0,0 +1,108 @@
+"""
+Startup cost of each entry point: `python -X importtime -c "import <module>"` in a fresh interpreter,
+median of --repeat runs. Reports the cumulative import time of the entry point, the wall time of the
+interpreter and the heaviest packages it loads, to catch a heavy dependency that slipped back to module level.
+
+python benchmarks/import_time.py --repeat 5 --out import_time.json
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TILE_CONCAT = os.path.join(ROOT, "prediction_models", "tile_concat_wy")
+
+# name: (working directory, module). The tile_concat_wy modules import each other from their root folder.
+ENTRY_POINTS = {
+    "generate_tiles": (ROOT, "preprocessing.generate_tiles"),
+    "generate_grid": (ROOT, "preprocessing.tile_generation.generate_grid"),
+    "reinhard": (ROOT, "preprocessing.normalization.reinhard_bg"),
+    "normalization_pkg": (ROOT, "preprocessing.normalization"),
+    "input_pipeline": (TILE_CONCAT, "input.inputPipeline"),
+    "model": (TILE_CONCAT, "model.resnext_ssl"),
+    "train": (TILE_CONCAT, "train.train"),
+    "predict": (TILE_CONCAT, "infer.predict"),
+    "runtime": (TILE_CONCAT, "infer.runtime"),
+}
+
+
+def parse_importtime(stderr):
+    """
+    :return: {module: (self_us, cumulative_us, depth)} from the -X importtime report
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return modules
+
+
+def measure(cwd, module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([cwd, ROOT, os.environ.get("PYTHONPATH", "")]))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return wall, parse_importtime(proc.stderr)
+
+
+def run(names, repeat, top):
+    # modules of the bare interpreter startup (site, encodings, ...) are not attributed to the entry points
+    startup = parse_importtime(subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"],
+                                              stderr=subprocess.PIPE, universal_newlines=True).stderr)
+    results = {}
+    for name in names:
+        cwd, module = ENTRY_POINTS[name]
+        try:
+            runs = [measure(cwd, module) for _ in range(repeat)]
+        except RuntimeError as e:
+            results[name] = {"module": module, "error": str(e)}
+            continue
+        walls = [wall for wall, _ in runs]
+        imports = [modules[module][1] / 1e6 if module in modules else float("nan") for _, modules in runs]
+        modules = runs[walls.index(statistics.median_low(walls))][1]
+        # heaviest third party top level packages (cumulative, a package imported by another one is counted in both)
+        packages = sorted(((cum, pkg) for pkg, (_, cum, _) in modules.items()
+                           if "." not in pkg and pkg not in startup and pkg != module.split(".")[0]), reverse=True)
+        results[name] = {
+            "module": module,
+            "wall_s": statistics.median(walls),
+            "import_s": statistics.median(imports),
+            "n_modules": len(set(modules) - set(startup)),
+            "heaviest": [[pkg, cum / 1e6] for cum, pkg in packages[:top]],
+        }
+    return results
+
+
+def report(results):
+    print("%-18s %10s %10s %9s  %s" % ("entry point", "wall (s)", "import (s)", "modules", "heaviest"))
+    for name, res in results.items():
+        if "error" in res:
+            print("%-18s failed: %s" % (name, res["error"]))
+            continue
+        heaviest = ", ".join("%s %.2f" % (pkg, s) for pkg, s in res["heaviest"])
+        print("%-18s %10.3f %10.3f %9d  %s" % (name, res["wall_s"], res["import_s"], res["n_modules"], heaviest))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of the entry points")
+    parser.add_argument("--entry_points", nargs="+", default=list(ENTRY_POINTS), choices=list(ENTRY_POINTS))
+    parser.add_argument("--repeat", default=5, type=int, help="Fresh interpreters per entry point")
+    parser.add_argument("--top", default=3, type=int, help="Heaviest packages reported per entry point")
+    parser.add_argument("--out", default=None, help="Write the results to a json file")
+    args = parser.parse_args()
+
+    results = run(args.entry_points, args.repeat, args.top)
+    report(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
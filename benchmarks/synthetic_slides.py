@@ -0,0 +1,216 @@
+"""
+Synthetic PANDA-like dataset for benchmarking and testing without the 400 GB of slides:
+pyramidal tiled TIFFs (train_images/{image_id}.tiff), label masks with the label in the red channel
+(train_label_masks/{image_id}_mask.tiff) and a train.csv with consistent data_provider, isup_grade and
+gleason_score. Slides are readable with OpenSlide, skimage.io.MultiImage and tifffile (one pyramid level per page).
+
+Each slide has tissue-like blobs on a white background, H&E-like colors with nuclei, cancer regions labelled
+according to the gleason score (radboud: 0 background, 1 stroma, 2 healthy epithelium, 3-5 gleason pattern;
+karolinska: 0 background, 1 benign tissue, 2 cancer) and pen marks outside of the mask labels.
+
+python benchmarks/synthetic_slides.py --out_dir /tmp/panda_synthetic --n_slides 32 --height 8192 --width 6144
+"""
+import os
+import argparse
+import time
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import tifffile
+
+# isup grade: gleason scores of that grade
+GLEASON_SCORES = {
+    0: ["0+0"],
+    1: ["3+3"],
+    2: ["3+4"],
+    3: ["4+3"],
+    4: ["4+4", "3+5", "5+3"],
+    5: ["4+5", "5+4", "5+5"],
+}
+
+# RGB of each drawing class, 0: background, 1: stroma, 2: epithelium, 3-5: gleason pattern
+CLASS_COLORS = np.array([[242, 242, 242], [232, 168, 206], [212, 140, 196], [190, 112, 180], [170, 90, 168],
+                         [150, 72, 160]], dtype=np.int16)
+# probability of a nucleus (dark purple dot) at each pixel of a class
+NUCLEI_DENSITY = np.array([0.0, 0.01, 0.03, 0.06, 0.09, 0.12], dtype=np.float32)
+NUCLEUS_COLOR = np.array([90, 50, 130], dtype=np.int16)
+# amplitude of the pixel noise of each class (and pen), the background is almost flat as in scanned slides
+NOISE = np.array([2, 10, 10, 10, 10, 10, 4], dtype=np.int16)
+PEN_COLORS = np.array([[20, 130, 60], [30, 60, 170], [35, 35, 35]], dtype=np.int16)
+PEN = len(CLASS_COLORS)
+
+
+def random_slide_labels(rng, n_slides):
+    """train.csv rows without image_id: data_provider, isup_grade, gleason_score"""
+    rows = []
+    for _ in range(n_slides):
+        provider = "radboud" if rng.random() < 0.5 else "karolinska"
+        isup = int(rng.integers(0, 6))
+        gleason = str(rng.choice(GLEASON_SCORES[isup]))
+        if isup == 0 and provider == "radboud":
+            gleason = "negative"
+        rows.append({"data_provider": provider, "isup_grade": isup, "gleason_score": gleason})
+    return rows
+
+
+def smooth_noise(rng, shape, cell):
+    """values in [0, 1) interpolated bilinearly from a random grid with one node every cell pixels"""
+    h, w = shape
+    grid = rng.random((h // cell + 2, w // cell + 2)).astype(np.float32)
+    fy = np.arange(h, dtype=np.float32) / cell
+    fx = np.arange(w, dtype=np.float32) / cell
+    iy, ix = fy.astype(np.int64), fx.astype(np.int64)
+    ty, tx = (fy - iy)[:, None], (fx - ix)[None, :]
+    top = grid[iy][:, ix] * (1 - tx) + grid[iy][:, ix + 1] * tx
+    bottom = grid[iy + 1][:, ix] * (1 - tx) + grid[iy + 1][:, ix + 1] * tx
+    return top * (1 - ty) + bottom * ty
+
+
+def blobs(rng, shape, n_blobs, scale):
+    """sum of randomly rotated elliptic gaussians, scale: blob radius as a fraction of the smaller side"""
+    h, w = shape
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    field = np.zeros(shape, dtype=np.float32)
+    for _ in range(n_blobs):
+        cy, cx = rng.uniform(0.15, 0.85) * h, rng.uniform(0.15, 0.85) * w
+        a, b = rng.uniform(0.5, 1.5, 2) * scale * min(h, w)
+        theta = rng.uniform(0, np.pi)
+        u = (xx - cx) * np.cos(theta) + (yy - cy) * np.sin(theta)
+        v = -(xx - cx) * np.sin(theta) + (yy - cy) * np.cos(theta)
+        field += np.exp(-(u / a) ** 2 - (v / b) ** 2)
+    return field
+
+
+def draw_pen_marks(rng, shape, n_marks, width):
+    """index of the pen color (-1: no pen) of each pixel, strokes are random quadratic curves"""
+    h, w = shape
+    pen = np.full(shape, -1, dtype=np.int8)
+    r = max(1, width // 2)
+    disk = np.hypot(*np.mgrid[-r:r + 1, -r:r + 1]) <= r
+    for _ in range(n_marks):
+        color = rng.integers(0, len(PEN_COLORS))
+        p0, p1, p2 = rng.uniform(0, 1, (3, 2)) * [h, w]
+        for t in np.linspace(0, 1, int(2 * np.hypot(h, w) / r)):
+            y, x = ((1 - t) ** 2 * p0 + 2 * (1 - t) * t * p1 + t ** 2 * p2).astype(int)
+            y0, x0 = max(y - r, 0), max(x - r, 0)
+            y1, x1 = min(y + r + 1, h), min(x + r + 1, w)
+            if y0 < y1 and x0 < x1:
+                stamp = disk[y0 - y + r:y1 - y + r, x0 - x + r:x1 - x + r]
+                pen[y0:y1, x0:x1][stamp] = color
+    return pen
+
+
+def slide_classes(rng, shape, provider, gleason_score, n_blobs, n_pen_marks):
+    """
+    Drawing classes (0-5, PEN for pen marks) and mask labels of a slide, at a low resolution (shape)
+    :return: classes (int8), labels (uint8), pen color index (int8)
+    """
+    tissue = blobs(rng, shape, n_blobs, 0.12) + 0.6 * smooth_noise(rng, shape, max(4, min(shape) // 24)) > 0.8
+    epithelium = smooth_noise(rng, shape, max(4, min(shape) // 40)) > 0.55
+    classes = np.where(tissue, np.where(epithelium, 2, 1), 0).astype(np.int8)
+    if gleason_score not in ("0+0", "negative"):
+        primary, secondary = (int(g) for g in gleason_score.split("+"))
+        cancer = tissue & (blobs(rng, shape, max(1, n_blobs // 2), 0.08) +
+                           0.5 * smooth_noise(rng, shape, max(4, min(shape) // 30)) > 0.7)
+        # the secondary pattern takes the smaller part of the cancer area
+        minor = smooth_noise(rng, shape, max(4, min(shape) // 30)) > 0.65
+        classes[cancer] = primary
+        classes[cancer & minor] = secondary
+    if provider == "radboud":
+        labels = classes.astype(np.uint8)
+    else:
+        labels = np.where(classes >= 3, 2, np.minimum(classes, 1)).astype(np.uint8)
+    pen = draw_pen_marks(rng, shape, n_pen_marks, max(3, min(shape) // 150))
+    classes[pen >= 0] = PEN
+    return classes, labels, pen
+
+
+def render(rng, classes, pen, factor, band_rows=1024):
+    """RGB slide at factor times the resolution of classes, rendered by bands of rows to bound memory"""
+    h, w = classes.shape[0] * factor, classes.shape[1] * factor
+    img = np.empty((h, w, 3), dtype=np.uint8)
+    colors = np.concatenate([CLASS_COLORS, np.zeros((1, 3), dtype=np.int16)])
+    density = np.concatenate([NUCLEI_DENSITY, [0.0]]).astype(np.float32)
+    for start in range(0, h, band_rows):
+        rows = slice(start // factor, -(-min(start + band_rows, h) // factor))
+        cls = np.repeat(np.repeat(classes[rows], factor, 0), factor, 1)[:min(band_rows, h - start)]
+        band = colors[cls]
+        pen_band = np.repeat(np.repeat(pen[rows], factor, 0), factor, 1)[:len(cls)]
+        band[cls == PEN] = PEN_COLORS[pen_band[cls == PEN]]
+        nuclei = rng.random(cls.shape, dtype=np.float32) < density[cls]
+        band[nuclei] = NUCLEUS_COLOR
+        band += rng.integers(-10, 11, cls.shape + (1,), dtype=np.int16) * NOISE[cls][..., None] // 10
+        img[start:start + len(cls)] = np.clip(band, 0, 255)
+    return img
+
+
+def write_pyramid(fname, img, n_levels, downsample, tile, zlib_level=1):
+    """one tiled, zlib compressed page per level, level i downsampled by downsample ** i"""
+    with tifffile.TiffWriter(fname) as tif:
+        for level in range(n_levels):
+            step = downsample ** level
+            data = np.ascontiguousarray(img[::step, ::step])
+            try:
+                tif.write(data, tile=(tile, tile), compression="zlib", compressionargs={"level": zlib_level},
+                          photometric="rgb", subfiletype=1 if level > 0 else 0)
+            except TypeError:
+                # tifffile < 2022.7: no compressionargs
+                tif.write(data, tile=(tile, tile), compression=("zlib", zlib_level), photometric="rgb",
+                          subfiletype=1 if level > 0 else 0)
+
+
+def generate_slide(job):
+    image_id, row, opts, seed = job
+    rng = np.random.default_rng(seed)
+    # slide size varies around --height x --width, a multiple of the lowest level downsample so that the levels
+    # are exact; the drawing is done at 1 / factor of it
+    factor = opts.downsample
+    multiple = opts.downsample ** max(opts.levels - 1, 1)
+    h = max(multiple, int(opts.height * rng.uniform(0.75, 1.25)) // multiple * multiple)
+    w = max(multiple, int(opts.width * rng.uniform(0.75, 1.25)) // multiple * multiple)
+    classes, labels, pen = slide_classes(rng, (h // factor, w // factor), row["data_provider"],
+                                         row["gleason_score"], opts.n_blobs, opts.n_pen_marks)
+    img = render(rng, classes, pen, factor)
+    write_pyramid(os.path.join(opts.out_dir, "train_images", f"{image_id}.tiff"), img, opts.levels,
+                  opts.downsample, opts.tile, opts.zlib_level)
+    del img
+    labels = np.repeat(np.repeat(labels, factor, 0), factor, 1)
+    mask = np.zeros(labels.shape + (3,), dtype=np.uint8)
+    mask[..., 0] = labels
+    write_pyramid(os.path.join(opts.out_dir, "train_label_masks", f"{image_id}_mask.tiff"), mask, opts.levels,
+                  opts.downsample, opts.tile, opts.zlib_level)
+    return image_id, (h, w)
+
+
+def main(opts):
+    os.makedirs(os.path.join(opts.out_dir, "train_images"), exist_ok=True)
+    os.makedirs(os.path.join(opts.out_dir, "train_label_masks"), exist_ok=True)
+    rng = np.random.default_rng(opts.seed)
+    rows = random_slide_labels(rng, opts.n_slides)
+    for row in rows:
+        row["image_id"] = rng.bytes(16).hex()
+    jobs = [(row["image_id"], row, opts, int(rng.integers(2 ** 31))) for row in rows]
+    start = time.time()
+    with Pool(opts.num_ps) as pool:
+        for counter, (image_id, (h, w)) in enumerate(pool.imap_unordered(generate_slide, jobs)):
+            print("[%d]/[%d] %s %dx%d" % (counter + 1, len(jobs), image_id, w, h))
+    train_df = pd.DataFrame(rows, columns=["image_id", "data_provider", "isup_grade", "gleason_score"])
+    train_df.to_csv(os.path.join(opts.out_dir, "train.csv"), index=False)
+    print("Wrote %d slides to %s in %.1fs" % (len(rows), opts.out_dir, time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic PANDA-like dataset")
+    parser.add_argument("--out_dir", default="/tmp/panda_synthetic/")
+    parser.add_argument("--n_slides", default=16, type=int)
+    parser.add_argument("--height", default=8192, type=int, help="Mean slide height at the highest resolution")
+    parser.add_argument("--width", default=6144, type=int, help="Mean slide width at the highest resolution")
+    parser.add_argument("--levels", default=3, type=int, help="Pyramid levels (PANDA: 3)")
+    parser.add_argument("--downsample", default=4, type=int, help="Downsample between levels (PANDA: 4)")
+    parser.add_argument("--tile", default=512, type=int, help="TIFF tile size, multiple of 16")
+    parser.add_argument("--zlib_level", default=1, type=int, help="Compression level of the tiles")
+    parser.add_argument("--n_blobs", default=4, type=int, help="Tissue blobs per slide")
+    parser.add_argument("--n_pen_marks", default=2, type=int, help="Pen marks per slide")
+    parser.add_argument("--num_ps", default=4, type=int, help="Slides generated in parallel")
+    parser.add_argument("--seed", default=0, type=int)
+    main(parser.parse_args())
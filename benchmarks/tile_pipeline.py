@@ -0,0 +1,258 @@
+"""
+End-to-end benchmark of the preprocessing pipeline: TileGeneratorGrid + stain normalizer + LMDB writer
+(preprocessing/generate_tiles.py write_batch_data) over a fixed corpus of slides, each normalizer in its own
+process. Reports tiles/s, slides/hour, peak RSS and the time of each stage:
+location_search, region_read, tissue_mask, normalize, resize, label_read, tile_stats, encode, put, commit.
+
+The corpus is a PANDA-like folder (--data_dir with train_images/, train_label_masks/ and train.csv) or, by default,
+synthetic slides generated once with a fixed seed (synthetic_slides.py), so that results are comparable between
+commits. Results go to a json file; compare two of them with a regression threshold:
+
+python benchmarks/tile_pipeline.py run --out base.json
+python benchmarks/tile_pipeline.py run --out new.json --baseline base.json --threshold 0.1
+python benchmarks/tile_pipeline.py compare base.json new.json --threshold 0.1
+"""
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from multiprocessing import get_context
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+STAGES = ["location_search", "region_read", "tissue_mask", "normalize", "resize", "label_read", "tile_stats",
+          "encode", "put", "commit"]
+
+
+def synthetic_corpus(opts):
+    """data dir of the synthetic corpus, generated on the first run"""
+    import synthetic_slides
+    data_dir = opts.corpus_dir or os.path.join(
+        tempfile.gettempdir(), f"panda_bench_{opts.n_slides}x{opts.height}x{opts.width}_seed{opts.seed}")
+    if not os.path.isfile(os.path.join(data_dir, "train.csv")):
+        synthetic_slides.main(argparse.Namespace(
+            out_dir=data_dir, n_slides=opts.n_slides, height=opts.height, width=opts.width, levels=3,
+            downsample=4, tile=512, zlib_level=1, n_blobs=4, n_pen_marks=2, num_ps=opts.num_ps, seed=opts.seed))
+    return data_dir
+
+
+def get_normalizer(method, tile_generator, opts):
+    """Reinhard uses the pre-computed LAB target, Macenko/Vahadane are fitted on the first tile of the corpus"""
+    if method == "reinhard":
+        from preprocessing.normalization.reinhard_bg import ReinhardNormalizer
+        normalizer = ReinhardNormalizer()
+        normalizer.fit(None)
+        return normalizer
+    if method == "macenko":
+        from preprocessing.normalization.macenko import MacenkoNormalizer
+        normalizer = MacenkoNormalizer()
+    else:
+        from preprocessing.normalization.vahadane import VahadaneNormalizer
+        normalizer = VahadaneNormalizer()
+    _, locations = tile_generator.get_tile_locations(opts.tile_size, opts.overlap, opts.ts_thres)
+    target, _, _ = tile_generator.extract_tile([int(locations[0][0]), int(locations[0][1])], opts.tile_size)
+    normalizer.fit(target)
+    return normalizer
+
+
+def run_normalizer(method, data_dir, opts, result_queue):
+    """tile, normalize and write the corpus with one normalizer, put the results on result_queue"""
+    import lmdb
+    import pandas as pd
+    from preprocessing.generate_tiles import write_batch_data
+    from preprocessing.thread_budget import apply_thread_budget
+    from preprocessing.tile_generation.generate_grid import TileGeneratorGrid
+    from preprocessing.tile_generation.utils import tile_stats
+    from preprocessing.tile_generation.utils.mask_codec import MaskCodec
+    from preprocessing.tile_generation.utils.stage_timer import StageTimer
+
+    if opts.threads:
+        apply_thread_budget(opts.threads)
+    slides_dir, masks_dir = f"{data_dir}/train_images/", f"{data_dir}/train_label_masks/"
+    slides = list(pd.read_csv(f"{data_dir}/train.csv").image_id)[:opts.n_slides]
+    out_dir = tempfile.mkdtemp(prefix=f"tile_pipeline_{method}_", dir=opts.tmp_dir)
+    envs = [lmdb.open(f"{out_dir}/{name}", map_size=int(1e12))
+            for name in ("tiles", "tissue_masks", "label_masks", "locations", "tile_stats")]
+    mask_shape = (opts.tile_size // opts.dw_rate, opts.tile_size // opts.dw_rate)
+    tissue_codec = MaskCodec(opts.tissue_mask_codec, mask_shape)
+    label_codec = MaskCodec(opts.label_mask_codec, mask_shape)
+    normalizer = get_normalizer(method, TileGeneratorGrid(slides_dir, f"{slides[0]}.tiff", masks_dir), opts)
+
+    timer = StageTimer()
+    n_tiles, counter, batches = 0, 0, []
+    start = time.perf_counter()
+    for i, slide_name in enumerate(slides):
+        tile_generator = TileGeneratorGrid(slides_dir, f"{slide_name}.tiff", masks_dir, timer=timer)
+        _, norm_tiles, locations, tissue_masks, label_masks = tile_generator.extract_all_tiles(
+            opts.tile_size, opts.overlap, opts.ts_thres, opts.dw_rate, normalizer)
+        if len(norm_tiles) > 0:
+            timer.reset()
+            stats = tile_stats.compute_tile_stats(tissue_masks, label_masks)
+            timer.lap("tile_stats")
+            batches.append({"slide_name": slide_name, "norm_tiles": norm_tiles, "tissue_masks": tissue_masks,
+                            "label_masks": label_masks, "locations": locations, "tile_stats": stats})
+            n_tiles += len(norm_tiles)
+        if batches and (len(batches) == opts.write_batch_size or i == len(slides) - 1):
+            counter = write_batch_data(*envs, batches, len(slides), counter, False, tissue_codec, label_codec,
+                                       timer=timer)
+    wall = time.perf_counter() - start
+    for env in envs:
+        env.close()
+    lmdb_mb = sum(os.path.getsize(os.path.join(path, f)) for path, _, files in os.walk(out_dir) for f in files)
+    shutil.rmtree(out_dir)
+
+    stages = timer.stats()
+    result_queue.put({
+        "slides": len(slides),
+        "tiles": n_tiles,
+        "wall_s": wall,
+        "tiles_per_s": n_tiles / wall,
+        "slides_per_hour": 3600 * len(slides) / wall,
+        # ru_maxrss is in KB on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "lmdb_mb": lmdb_mb / 2 ** 20,
+        "stages_s": {stage: stages.get(stage, 0.0) for stage in STAGES},
+        "stages_ms_per_tile": {stage: 1000 * stages.get(stage, 0.0) / max(n_tiles, 1) for stage in STAGES},
+    })
+
+
+def run(opts):
+    data_dir = opts.data_dir or synthetic_corpus(opts)
+    ctx = get_context("spawn")
+    results = {}
+    for method in opts.normalizers:
+        result_queue = ctx.Queue()
+        p = ctx.Process(target=run_normalizer, args=(method, data_dir, opts, result_queue))
+        p.start()
+        while True:
+            try:
+                results[method] = result_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not p.is_alive():
+                    results[method] = {"error": f"exit code {p.exitcode}"}
+                    break
+        p.join()
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "meta": {"commit": commit, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                 "cpu_count": os.cpu_count(), "data_dir": data_dir,
+                 "params": {k: getattr(opts, k) for k in ("tile_size", "overlap", "ts_thres", "dw_rate", "threads",
+                                                          "write_batch_size", "tissue_mask_codec",
+                                                          "label_mask_codec", "n_slides")}},
+        "results": results,
+    }
+
+
+def report(bench):
+    print("%-10s %8s %10s %14s %14s" % ("normalizer", "tiles", "tiles/s", "slides/hour", "peak RSS (MB)"))
+    for method, res in bench["results"].items():
+        if "error" in res:
+            print("%-10s failed: %s" % (method, res["error"]))
+            continue
+        print("%-10s %8d %10.1f %14.1f %14.0f" % (method, res["tiles"], res["tiles_per_s"], res["slides_per_hour"],
+                                                  res["peak_rss_mb"]))
+    print("\nms per tile  " + " ".join("%10s" % stage[:10] for stage in STAGES))
+    for method, res in bench["results"].items():
+        if "error" not in res:
+            print("%-12s " % method + " ".join("%10.2f" % res["stages_ms_per_tile"][stage] for stage in STAGES))
+
+
+def compare(base, new, threshold, rss_threshold):
+    """
+    Print the relative change of new against base for each normalizer.
+    :return: list of regressions: throughput lower by more than threshold or peak RSS higher by more than
+             rss_threshold (fractions)
+    """
+    regressions = []
+    print("%-10s %12s %12s %9s %12s %12s %9s" % ("normalizer", "base tiles/s", "new tiles/s", "change",
+                                                 "base RSS", "new RSS", "change"))
+    for method, new_res in new["results"].items():
+        base_res = base["results"].get(method)
+        if base_res is None or "error" in base_res or "error" in new_res:
+            continue
+        tps = new_res["tiles_per_s"] / base_res["tiles_per_s"] - 1
+        rss = new_res["peak_rss_mb"] / base_res["peak_rss_mb"] - 1
+        print("%-10s %12.1f %12.1f %+8.1f%% %12.0f %12.0f %+8.1f%%" % (
+            method, base_res["tiles_per_s"], new_res["tiles_per_s"], 100 * tps, base_res["peak_rss_mb"],
+            new_res["peak_rss_mb"], 100 * rss))
+        stage_changes = ["%s %+.2f" % (stage, new_res["stages_ms_per_tile"][stage] -
+                                       base_res["stages_ms_per_tile"][stage])
+                         for stage in STAGES if base_res["stages_ms_per_tile"][stage] > 0
+                         or new_res["stages_ms_per_tile"][stage] > 0]
+        print("%-10s ms/tile: %s" % ("", ", ".join(stage_changes)))
+        if tps < -threshold:
+            regressions.append(f"{method}: tiles/s {100 * tps:+.1f}% (threshold -{100 * threshold:.0f}%)")
+        if rss > rss_threshold:
+            regressions.append(f"{method}: peak RSS {100 * rss:+.1f}% (threshold +{100 * rss_threshold:.0f}%)")
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return regressions
+
+
+def load(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the tile generation pipeline")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_run = subparsers.add_parser("run", help="Run the benchmark")
+    parser_run.add_argument("--data_dir", default=None,
+                            help="PANDA-like folder (train_images/, train_label_masks/, train.csv), "
+                                 "default: synthetic corpus")
+    parser_run.add_argument("--corpus_dir", default=None, help="Folder of the synthetic corpus, default: in /tmp")
+    parser_run.add_argument("--n_slides", default=8, type=int)
+    parser_run.add_argument("--height", default=8192, type=int, help="Synthetic slide height")
+    parser_run.add_argument("--width", default=6144, type=int, help="Synthetic slide width")
+    parser_run.add_argument("--seed", default=0, type=int, help="Seed of the synthetic corpus")
+    parser_run.add_argument("--num_ps", default=4, type=int, help="Processes generating the synthetic corpus")
+    parser_run.add_argument("--normalizers", nargs="+", default=["reinhard", "macenko", "vahadane"],
+                            choices=["reinhard", "macenko", "vahadane"])
+    parser_run.add_argument("--tile_size", default=512, type=int)
+    parser_run.add_argument("--overlap", default=0.25, type=float)
+    parser_run.add_argument("--ts_thres", default=0.5, type=float)
+    parser_run.add_argument("--dw_rate", default=1, type=int)
+    parser_run.add_argument("--threads", default=None, type=int, help="Thread budget of the benchmark process")
+    parser_run.add_argument("--write_batch_size", default=4, type=int)
+    parser_run.add_argument("--tissue_mask_codec", default="packbits", choices=["raw", "packbits", "zstd"])
+    parser_run.add_argument("--label_mask_codec", default="rle", choices=["raw", "rle", "zstd"])
+    parser_run.add_argument("--tmp_dir", default=None, help="Folder of the temporary LMDB envs")
+    parser_run.add_argument("--out", default=None, help="Write the results to a json file")
+    parser_run.add_argument("--baseline", default=None, help="Compare with the results in this json file")
+    parser_run.add_argument("--threshold", default=0.1, type=float, help="Tolerated throughput drop (fraction)")
+    parser_run.add_argument("--rss_threshold", default=0.2, type=float, help="Tolerated peak RSS growth (fraction)")
+    parser_compare = subparsers.add_parser("compare", help="Compare two result files")
+    parser_compare.add_argument("base")
+    parser_compare.add_argument("new")
+    parser_compare.add_argument("--threshold", default=0.1, type=float, help="Tolerated throughput drop (fraction)")
+    parser_compare.add_argument("--rss_threshold", default=0.2, type=float,
+                                help="Tolerated peak RSS growth (fraction)")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(1 if compare(load(args.base), load(args.new), args.threshold, args.rss_threshold) else 0)
+    elif args.command == "run":
+        bench = run(args)
+        report(bench)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(bench, f, indent=2)
+        if args.baseline:
+            print()
+            sys.exit(1 if compare(load(args.baseline), bench, args.threshold, args.rss_threshold) else 0)
+    else:
+        parser.print_help()
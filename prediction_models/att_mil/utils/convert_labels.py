@@ -1,4 +1,6 @@
 import numpy as np
+# Number of label values in PANDA masks, shared with the tile statistics of tile generation
+from preprocessing.tile_generation.utils.tile_stats import N_MASK_CLASSES
 
 
 class ConvertRad:
@@ -43,8 +45,50 @@ class ConvertKaro:
             return -1
         unique, counts = np.unique(mask, return_counts=True)
         pattern_counts = dict(zip(unique, counts))
-        if pattern_counts[2] > 0:
+        if pattern_counts.get(2, 0) > 0:
             if self.binary:
                 return 1
-            else:
-                return slide_pg
+            # Same label space as ConvertRad: 0: benign/stroma/background, 1: G3, 2: G4, 3: G5
+            return max(slide_pg - 2, 0)
+        return 0
+
+
+def convert_rad_batch(class_hists, slide_pg, slide_sg, binary=False):
+    """
+    Vectorized ConvertRad over a batch of tiles.
+    :param class_hists: (n_tiles, N_MASK_CLASSES) pixel count per mask value
+    :param slide_pg: (n_tiles, ) primary Gleason pattern of the slide each tile belongs to
+    :param slide_sg: (n_tiles, ) secondary Gleason pattern of the slide each tile belongs to
+    :param binary: return 0/1 labels (cancer or not)
+    :return: tile_labels: (n_tiles, ) int64
+             unexpected: (n_tiles, 3) bool, Gleason 3-5 pixels that are not included in the slide label
+    """
+    pattern_counts = class_hists[:, 3:]
+    patterns = np.arange(3, N_MASK_CLASSES)[None, :]
+    in_slide = (patterns == slide_pg[:, None]) | (patterns == slide_sg[:, None])
+    unexpected = (pattern_counts > 0) & ~in_slide
+    valid_counts = np.where(in_slide, pattern_counts, 0)
+    # argmax returns the first maximum, i.e. the lowest pattern on ties, as the loop in ConvertRad does.
+    tile_labels = np.where(valid_counts.max(axis=1) > 0, valid_counts.argmax(axis=1) + 1, 0).astype(np.int64)
+    if binary:
+        return (tile_labels >= 1).astype(np.int64), unexpected
+    return tile_labels, unexpected
+
+
+def convert_karo_batch(class_hists, slide_pg, slide_sg, binary=False):
+    """
+    Vectorized ConvertKaro over a batch of tiles. Tiles from mixed Gleason slides are labeled -1.
+    :param class_hists: (n_tiles, N_MASK_CLASSES) pixel count per mask value
+    :param slide_pg: (n_tiles, ) primary Gleason pattern of the slide each tile belongs to
+    :param slide_sg: (n_tiles, ) secondary Gleason pattern of the slide each tile belongs to
+    :param binary: return 0/1 labels (cancer or not)
+    :return: tile_labels: (n_tiles, ) int64
+    """
+    has_cancer = class_hists[:, 2] > 0
+    if binary:
+        cancer_label = np.ones_like(slide_pg, dtype=np.int64)
+    else:
+        cancer_label = np.maximum(slide_pg - 2, 0).astype(np.int64)
+    tile_labels = np.where(has_cancer, cancer_label, 0)
+    tile_labels[slide_pg != slide_sg] = -1
+    return tile_labels
@@ -3,9 +3,10 @@ import os
 import shutil
 import lmdb
 import numpy as np
+from multiprocessing import Pool
 from sklearn.model_selection import StratifiedKFold
-from prediction_models.att_mil.utils import file_utils
 from prediction_models.att_mil.utils import convert_labels
+from preprocessing.tile_generation.utils.mask_codec import MaskCodec
 
 
 def parse_gleason(raw_gleason):
@@ -16,40 +17,100 @@ def parse_gleason(raw_gleason):
     return pg, sg
 
 
+def _read_label_hists(lmdb_dir, keys):
+    """
+    Worker for generate_tile_label: compute the class histogram of each label mask in keys.
+    :return: tile_names: list of str, class_hists: (len(keys), N_MASK_CLASSES) int64
+    """
+    env_label_masks = lmdb.open(f"{lmdb_dir}/label_masks", max_readers=3, readonly=True, lock=False,
+                                readahead=False, meminit=False)
+    label_codec = MaskCodec.from_env(f"{lmdb_dir}/label_masks")
+    class_hists = np.zeros((len(keys), convert_labels.N_MASK_CLASSES), dtype=np.int64)
+    with env_label_masks.begin(write=False, buffers=True) as txn_labels:
+        for i, key in enumerate(keys):
+            class_hists[i] = label_codec.class_histogram(txn_labels.get(key), convert_labels.N_MASK_CLASSES)
+    env_label_masks.close()
+    return [key.decode('ascii') for key in keys], class_hists
+
+
+def _split_tile_names(tile_names):
+    parts = pd.Series(tile_names).str.split("_", expand=True)
+    return parts[0].to_numpy(dtype=str), parts[1].to_numpy(dtype=np.int64), parts[2].to_numpy(dtype=np.int64)
+
+
 # Generate tile label given a tile label mask
-def generate_tile_label(lmdb_dir, tile_info_dir, mask_size, trainval_file, binary_label=False):
-    tile_label_data = []
+def generate_tile_label(lmdb_dir, tile_info_dir, mask_size, trainval_file, binary_label=False, num_ps=4,
+                        chunk_size=20000):
+    """
+    Label every tile in {lmdb_dir}/label_masks and save the result to {tile_info_dir}/trainval_tiles.npz
+    (keys: tile_name, slide_name, loc_x, loc_y, tile_label, class_hist).
+    The key space is split into chunks and the per-tile class histograms are computed on a process pool.
+    :param mask_size: kept for backward compatibility, histograms do not need the mask shape.
+    """
     env_label_masks = lmdb.open(f"{lmdb_dir}/label_masks", max_readers=3, readonly=True, lock=False,
                                 readahead=False, meminit=False)
-    logs = []
-    rad_converter = convert_labels.ConvertRad(logs, binary_label)
-    karo_converter = convert_labels.ConvertKaro(logs, binary_label)
+    with env_label_masks.begin(write=False) as txn_labels:
+        keys = list(txn_labels.cursor().iternext(keys=True, values=False))
+    env_label_masks.close()
+
+    chunks = [keys[i: i + chunk_size] for i in range(0, len(keys), chunk_size)]
+    with Pool(num_ps) as pool:
+        results = pool.starmap(_read_label_hists, [(lmdb_dir, chunk) for chunk in chunks])
+    tile_names = np.array([name for names, _ in results for name in names], dtype=str)
+    class_hists = np.concatenate([hists for _, hists in results]) if results else \
+        np.zeros((0, convert_labels.N_MASK_CLASSES), dtype=np.int64)
+    label_tiles(tile_names, class_hists, tile_info_dir, trainval_file, binary_label)
+    return
 
+
+def generate_tile_label_from_stats(tile_stats_file, tile_info_dir, trainval_file, binary_label=False):
+    """
+    Same as generate_tile_label, but uses the tile_stats.npy table written by preprocessing/generate_tiles.py
+    instead of decoding the label mask env. Tiles from slides without label masks (empty histogram) are skipped.
+    """
+    table = np.load(tile_stats_file, mmap_mode="r")
+    class_hists = np.asarray(table["class_hist"], dtype=np.int64)
+    has_mask = class_hists.sum(axis=1) > 0
+    table, class_hists = table[has_mask], class_hists[has_mask]
+    tile_names = np.char.add(np.char.add(np.char.add(np.char.add(
+        table["slide_name"].astype(str), "_"), table["loc_x"].astype(str)), "_"), table["loc_y"].astype(str))
+    label_tiles(tile_names, class_hists, tile_info_dir, trainval_file, binary_label)
+    return
+
+
+def label_tiles(tile_names, class_hists, tile_info_dir, trainval_file, binary_label=False):
+    """
+    Apply the ConvertRad/ConvertKaro rules to all tiles at once and save {tile_info_dir}/trainval_tiles.npz
+    :param tile_names: (n_tiles, ) str, {slide_name}_{loc_x}_{loc_y}
+    :param class_hists: (n_tiles, N_MASK_CLASSES) pixel count per mask value
+    """
+    slide_names, loc_x, loc_y = _split_tile_names(tile_names)
+
+    # Pre-join slide level information as arrays
     trainval_df = pd.read_csv(trainval_file, index_col='image_id')
+    slide_idx = trainval_df.index.get_indexer(slide_names)
+    if (slide_idx < 0).any():
+        missing = np.unique(slide_names[slide_idx < 0])
+        raise KeyError(f"{len(missing)} slides not found in {trainval_file}, e.g. {missing[0]}")
+    gleasons = np.array([parse_gleason(score) for score in trainval_df.gleason_score], dtype=np.int64) \
+        .reshape(-1, 2)
+    is_rad = (trainval_df.data_provider == "radboud").to_numpy()[slide_idx]
+    slide_pg, slide_sg = gleasons[slide_idx, 0], gleasons[slide_idx, 1]
 
-    with env_label_masks.begin(write=False) as txn_labels:
-        for tile_name, mask_buff in txn_labels.cursor():
-            tile_name = str(tile_name.decode('ascii'))
-            slide_name = tile_name.split("_")[0]
-            tile_mask = file_utils.decode_buffer(mask_buff, (mask_size, mask_size), np.uint8)
-            slide_info = trainval_df.loc[slide_name]
-            if slide_info.data_provider == "radboud":
-                slide_pg, slide_sg = parse_gleason(slide_info.gleason_score)
-                tile_label = rad_converter.convert(tile_mask, slide_name, slide_pg, slide_sg)
-            else:
-                tile_label = karo_converter.convert(tile_mask, slide_name, slide_pg, slide_sg)
-            tile_loc_x = tile_name.split("_")[1]
-            tile_loc_y = tile_name.split("_")[2]
-            tile_label_data.append({
-                "tile_name": tile_name,
-                "tile_label": tile_label,
-                "loc_x": tile_loc_x,
-                "loc_y": tile_loc_y
-            })
-
-    tiles_data_df = pd.DataFrame(columns=["tile_name", "tile_label", "loc_x", "loc_y"],
-                                 data=tile_label_data)
-    tiles_data_df.to_csv(f"{tile_info_dir}/trainval_tiles.csv")
+    rad_labels, unexpected = convert_labels.convert_rad_batch(class_hists, slide_pg, slide_sg, binary_label)
+    karo_labels = convert_labels.convert_karo_batch(class_hists, slide_pg, slide_sg, binary_label)
+    tile_labels = np.where(is_rad, rad_labels, karo_labels)
+
+    # Maybe wrong prediction. Since the pattern was not included in the slide label
+    logs = [f"Slide {slide_names[i]}, Pixel pattern{pattern + 3} not included in slide"
+            for i, pattern in zip(*np.nonzero(unexpected & is_rad[:, None]))]
+    if len(logs) > 0:
+        with open(f"{tile_info_dir}/trainval_tiles_logs.txt", "w") as log_file:
+            log_file.write("\n".join(logs) + "\n")
+
+    np.savez(f"{tile_info_dir}/trainval_tiles.npz", tile_name=tile_names, slide_name=slide_names,
+             loc_x=loc_x, loc_y=loc_y, tile_label=tile_labels, class_hist=class_hists)
+    print(f"Labeled {len(tile_names)} tiles, {len(logs)} unexpected pixel patterns")
     return
 
 
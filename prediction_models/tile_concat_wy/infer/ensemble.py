@@ -0,0 +1,141 @@
+"""
+Fold ensemble inference. Each slide is read and tiled once by predict(): the normalized batch is packed with its
+test-time augmentations along the batch dimension and the same tensor is fed to every fold model.
+"""
+
+## system package
+import os, sys, re, glob, json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+## general package
+import numpy as np
+import torch
+## custom package
+from infer.predict import load_model, predict, write_sample_submission
+from utiles.image_stats import load_stats
+
+## dihedral views of square tiles: (flip width, flip height, transpose)
+TTA_VIEWS = [(False, False, False), (True, False, False), (False, True, False), (True, True, False),
+             (False, False, True), (True, False, True), (False, True, True), (True, True, True)]
+
+def tta_pack(x, n_tta):
+    """
+    x: (bs, N, 3, h, w)
+    return: (n_tta * bs, N, 3, h, w), view t of all slides in rows t * bs: (t + 1) * bs
+    """
+    if n_tta <= 1:
+        return x
+    views = []
+    for flip_w, flip_h, transpose in TTA_VIEWS[:n_tta]:
+        v = x.transpose(-2, -1) if transpose else x
+        dims = [d for d, flip in ((-1, flip_w), (-2, flip_h)) if flip]
+        views.append(v.flip(dims) if dims else v)
+    return torch.cat(views)
+
+class EnsembleModel(object):
+    def __init__(self, models, n_tta = 1, combine = 'mean', thresholds = None):
+        """
+        Args:
+            models (list): fold models, called on the same packed batch.
+            n_tta (int): views per slide, 1 (no TTA) to 8 (all dihedral views).
+            combine (string): 'mean' averages the outputs (softmax probabilities for classification models),
+                'thresholds' maps the mean score (expected grade for classification models) to a grade with
+                the thresholds.
+            thresholds (list): 5 increasing score thresholds between the 6 isup grades, for combine='thresholds',
+                fitted on the out-of-fold predictions by fit_thresholds.py.
+        """
+        if combine not in ('mean', 'thresholds'):
+            raise ValueError('Unknown combine {}, should be mean or thresholds'.format(combine))
+        if combine == 'thresholds' and (thresholds is None or len(thresholds) != 5):
+            raise ValueError('combine=thresholds needs 5 thresholds')
+        self.models = models
+        self.n_tta = n_tta
+        self.combine = combine
+        self.thresholds = None if thresholds is None else torch.tensor(thresholds, dtype=torch.float32)
+
+    def scores(self, x):
+        """
+        x: (bs, N, 3, h, w) normalized tiles
+        return: (bs, n) mean over models and views, probabilities for classification models
+        """
+        bs = x.shape[0]
+        packed = tta_pack(x, self.n_tta)
+        total = 0
+        for model in self.models:
+            outputs = model(packed).float()
+            if outputs.shape[1] > 1:
+                outputs = outputs.softmax(1)
+            total = total + outputs
+        total = total / len(self.models)
+        return total.view(-1, bs, total.shape[1]).mean(0)
+
+    def __call__(self, x):
+        """
+        return: (bs, 1) grades or scores, (bs, 6) probabilities for classification models with combine='mean'
+        """
+        outputs = self.scores(x)
+        if self.combine == 'mean':
+            return outputs
+        if outputs.shape[1] > 1:
+            outputs = outputs @ torch.arange(outputs.shape[1], dtype=outputs.dtype)
+        else:
+            outputs = outputs[:, 0]
+        return torch.bucketize(outputs.contiguous(), self.thresholds, right=True).float()[:, None]
+
+def find_folds(weights_pattern):
+    """
+    weights_pattern: path with a {} for the fold, e.g. ./weights/Resnext50_reg_30/Resnext50_reg_30_{}_best.pth.tar
+    return: sorted folds with a weights file
+    """
+    prefix, suffix = weights_pattern.split('{}')
+    match = re.compile(re.escape(prefix) + r'(\d+)' + re.escape(suffix) + '$')
+    files = glob.glob(glob.escape(prefix) + '*' + glob.escape(suffix))
+    return sorted(int(m.group(1)) for m in map(match.match, files) if m)
+
+def load_fold_models(weights_pattern, folds, arch = 'resnext50_32x4d', n = 1, mmap = True):
+    """
+    weights_pattern: path with a {} for the fold, e.g. ./weights/Resnext50_reg_30/Resnext50_reg_30_{}_best.pth.tar
+    """
+    return [load_model(weights_pattern.format(fold), arch, n, mmap) for fold in folds]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Predict isup grades with an ensemble of fold models')
+    parser.add_argument('--data_dir', default='../input/prostate-cancer-grade-assessment/')
+    parser.add_argument('--csv_file', default='test.csv')
+    parser.add_argument('--image_dir', default='test_images/')
+    parser.add_argument('--weights_pattern', default='./weights/Resnext50_reg_30/Resnext50_reg_30_{}_best.pth.tar')
+    parser.add_argument('--folds', default=None, help='comma separated, default: every fold with a weights file')
+    parser.add_argument('--stats_file', default='../input/panda-16x128x128-tiles-data/stats.json')
+    parser.add_argument('--out_file', default='submission.csv')
+    parser.add_argument('--arch', default='resnext50_32x4d')
+    parser.add_argument('--n', default=1, type=int, help='model outputs, 1 for regression')
+    parser.add_argument('--tta', default=1, type=int, help='dihedral views per slide, 1 to 8')
+    parser.add_argument('--combine', default='mean', choices=['mean', 'thresholds'])
+    parser.add_argument('--thresholds_file', default=None, help='json with "thresholds" written by fit_thresholds.py, for --combine thresholds')
+    parser.add_argument('--bs', default=4, type=int)
+    parser.add_argument('--N', default=12, type=int, help='tiles per slide')
+    parser.add_argument('--sz', default=128, type=int, help='tile size')
+    parser.add_argument('--num_workers', default=4, type=int, help='processes reading and tiling slides')
+    parser.add_argument('--num_threads', default=None, type=int, help='intra-op threads for the models')
+    args = parser.parse_args()
+
+    csv_file = os.path.join(args.data_dir, args.csv_file)
+    image_dir = os.path.join(args.data_dir, args.image_dir)
+    if not os.path.isdir(image_dir):
+        print('{} not found, writing sample submission'.format(image_dir))
+        write_sample_submission(args.data_dir, args.out_file)
+        sys.exit(0)
+    thresholds = None
+    if args.thresholds_file:
+        with open(args.thresholds_file) as f:
+            thresholds = json.load(f)['thresholds']
+    mean, std = load_stats(args.stats_file)
+    folds = [int(fold) for fold in args.folds.split(',')] if args.folds else find_folds(args.weights_pattern)
+    if not folds:
+        raise FileNotFoundError('No fold weights matching {}'.format(args.weights_pattern))
+    model = EnsembleModel(load_fold_models(args.weights_pattern, folds, args.arch, args.n), args.tta, args.combine,
+                          thresholds)
+    predict(model, csv_file, image_dir, args.out_file, mean, std, args.bs, args.N, args.sz, args.num_workers,
+            args.num_threads)
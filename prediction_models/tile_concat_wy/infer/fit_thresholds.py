@@ -0,0 +1,43 @@
+"""
+Regression thresholds for the fold ensemble (ensemble.py --combine thresholds), fitted on the merged out-of-fold
+predictions written by train.py ({weights_dir}/{fname}_oof.csv) and saved as a json with "thresholds".
+"""
+
+## system package
+import os, sys, json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+## general package
+import numpy as np
+import pandas as pd
+## custom package
+from utiles.metrics import confusion_matrix, quadratic_weighted_kappa, search_thresholds
+
+def oof_thresholds(oof_file, n_iter = 3, score_range = (-1.0, 6.0), n_bins = 700):
+    """
+    oof_file: csv with the isup_grade and pred (regression score) of every training slide
+    return: thresholds (list), kappa with these thresholds, kappa of the rounded scores
+    """
+    oof = pd.read_csv(oof_file)
+    scores, labels = oof['pred'].to_numpy(np.float64), oof['isup_grade'].to_numpy(np.int64)
+    ## same score histogram as the validation StreamingKappa of train.py
+    edges = np.linspace(score_range[0], score_range[1], n_bins + 1)
+    bins = np.clip(np.searchsorted(edges, scores, side='right') - 1, 0, n_bins - 1)
+    hist = np.bincount(bins * 6 + labels, minlength=n_bins * 6).reshape(n_bins, 6)
+    thresholds, kappa = search_thresholds(hist, edges, n_iter = n_iter)
+    preds = np.clip(np.round(scores), 0, 5).astype(int)
+    return thresholds, kappa, float(quadratic_weighted_kappa(confusion_matrix(preds, labels)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit the ensemble thresholds on the out-of-fold predictions')
+    parser.add_argument('--oof_file', default='./weights/Resnext50_reg_30/Resnext50_reg_30_oof.csv')
+    parser.add_argument('--out_file', default=None, help='default: thresholds.json next to the oof file')
+    parser.add_argument('--n_iter', default=3, type=int)
+    args = parser.parse_args()
+
+    out_file = args.out_file or os.path.join(os.path.dirname(args.oof_file), 'thresholds.json')
+    thresholds, kappa, round_kappa = oof_thresholds(args.oof_file, args.n_iter)
+    with open(out_file, 'w') as f:
+        json.dump({'thresholds': thresholds, 'kappa': kappa, 'oof_file': args.oof_file}, f, indent=2)
+    print('Out-of-fold kappa-score: {:.4f} rounded, {:.4f} with thresholds {}, saved in {}.'.format(
+        round_kappa, kappa, ', '.join('{:.2f}'.format(t) for t in thresholds), out_file))
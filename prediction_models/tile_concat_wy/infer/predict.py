@@ -0,0 +1,130 @@
+## system package
+import os, sys, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+## general package
+import torch
+from torch.utils.data import DataLoader
+## custom package
+from input.inputPipeline import PandaPatchDatasetInfer, dataloader_collte_fn_infer
+from input.batch_augment import BatchAugment
+from utiles.image_stats import load_stats
+from utiles.checkpoint import load_checkpoint
+
+def load_model(weights_file, arch = 'resnext50_32x4d', n = 1, mmap = False):
+    """
+    Build Model_Infer (no pretrained download) and load weights saved by train.py
+    (either the best weights or a full checkpoint with 'state_dict').
+    With mmap (torch >= 2.1), the parameters are assigned from the memory-mapped file instead of copied,
+    so models loaded by several processes share the page cache.
+    """
+    from model.resnext_ssl import Model_Infer
+    model = Model_Infer(arch, n = n)
+    state_dict = load_checkpoint(weights_file, mmap = mmap)
+    if 'state_dict' in state_dict:
+        state_dict = state_dict['state_dict']
+    try:
+        model.load_state_dict(state_dict, assign = mmap)
+    except TypeError:
+        ## torch < 2.1
+        model.load_state_dict(state_dict)
+    return model.eval()
+
+def to_isup_grade(outputs):
+    """
+    outputs: (bs, 1) regression outputs or (bs, 6) class scores
+    return: (bs, ) int isup grades
+    """
+    if outputs.shape[1] == 1:
+        return outputs[:, 0].round().clamp(0, 5).long()
+    return outputs.argmax(1)
+
+def predict(model, csv_file, image_dir, out_file, mean, std, bs = 8, N = 12, sz = 128, num_workers = 4,
+            num_threads = None, prefetch_factor = 2):
+    """
+    Predict the isup grade of every slide in csv_file and stream the results to out_file.
+    DataLoader workers read and tile the slides (PandaPatchDatasetInfer), at most num_workers * prefetch_factor
+    batches of bs slides wait in the queue, and the model runs in the main process under inference_mode.
+    :param model: callable mapping a normalized (bs, N, 3, sz, sz) float tensor to (bs, 1) or (bs, 6) outputs
+    :param mean, std: image channel statistics used in training
+    :param num_threads: intra-op threads for the model, default: cores not used by the workers
+    :return: dict with the number of slides, slides/s and seconds spent in each stage
+    """
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) - num_workers)
+    torch.set_num_threads(num_threads)
+    dataset = PandaPatchDatasetInfer(csv_file, image_dir, N = N, sz = sz)
+    loader_kwargs = dict(prefetch_factor = prefetch_factor) if num_workers > 0 else dict()
+    loader = DataLoader(dataset, batch_size = bs, shuffle = False, num_workers = num_workers,
+                        collate_fn = dataloader_collte_fn_infer, **loader_kwargs)
+    normalize = BatchAugment(mean, std, augment = False)
+
+    timings = {'data': 0.0, 'forward': 0.0, 'write': 0.0}
+    n_slides = 0
+    start_time = time.perf_counter()
+    with open(out_file, 'w') as f, torch.inference_mode():
+        f.write('image_id,isup_grade\n')
+        f.flush()
+        t0 = time.perf_counter()
+        for imgs, names in loader:
+            t1 = time.perf_counter()
+            outputs = model(normalize(imgs))
+            preds = to_isup_grade(outputs).tolist()
+            t2 = time.perf_counter()
+            f.write(''.join('{},{}\n'.format(name, pred) for name, pred in zip(names, preds)))
+            f.flush()
+            t3 = time.perf_counter()
+            timings['data'] += t1 - t0
+            timings['forward'] += t2 - t1
+            timings['write'] += t3 - t2
+            n_slides += len(names)
+            t0 = time.perf_counter()
+    elapsed = time.perf_counter() - start_time
+    report = dict(timings, slides = n_slides, seconds = elapsed, slides_per_s = n_slides / max(elapsed, 1e-9))
+    print('{} slides in {:.1f}s, {:.2f} slides/s ({} workers, {} threads)'.format(
+        n_slides, elapsed, report['slides_per_s'], num_workers, num_threads))
+    for stage in timings:
+        print('  {:>8s}: {:.1f}s total, {:.1f} ms/slide'.format(stage, timings[stage],
+                                                                timings[stage] / max(n_slides, 1) * 1000))
+    return report
+
+def write_sample_submission(data_dir, out_file):
+    """test images are only available when the submission is scored, copy the sample submission otherwise"""
+    with open(os.path.join(data_dir, 'sample_submission.csv')) as src, open(out_file, 'w') as dst:
+        dst.write(src.read())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Predict isup grades on CPU and write submission.csv')
+    parser.add_argument('--data_dir', default='../input/prostate-cancer-grade-assessment/')
+    parser.add_argument('--csv_file', default='test.csv')
+    parser.add_argument('--image_dir', default='test_images/')
+    parser.add_argument('--weights', default='./weights/Resnext50_reg/Resnext50_reg_0_best.pth.tar',
+                        help='train.py weights, or a .pt/.onnx graph exported by model/export.py')
+    parser.add_argument('--stats_file', default='../input/panda-16x128x128-tiles-data/stats.json')
+    parser.add_argument('--out_file', default='submission.csv')
+    parser.add_argument('--arch', default='resnext50_32x4d')
+    parser.add_argument('--n', default=1, type=int, help='model outputs, 1 for regression')
+    parser.add_argument('--bs', default=8, type=int)
+    parser.add_argument('--N', default=12, type=int, help='tiles per slide')
+    parser.add_argument('--sz', default=128, type=int, help='tile size')
+    parser.add_argument('--num_workers', default=4, type=int, help='processes reading and tiling slides')
+    parser.add_argument('--num_threads', default=None, type=int, help='intra-op threads for the model')
+    args = parser.parse_args()
+
+    csv_file = os.path.join(args.data_dir, args.csv_file)
+    image_dir = os.path.join(args.data_dir, args.image_dir)
+    if not os.path.isdir(image_dir):
+        print('{} not found, writing sample submission'.format(image_dir))
+        write_sample_submission(args.data_dir, args.out_file)
+        sys.exit(0)
+    mean, std = load_stats(args.stats_file)
+    if os.path.splitext(args.weights)[1] in ('.pt', '.jit', '.onnx'):
+        ## exported graph, runs without fastai
+        from infer.runtime import load_runtime
+        model = load_runtime(args.weights, args.num_threads)
+    else:
+        model = load_model(args.weights, args.arch, args.n)
+    predict(model, csv_file, image_dir, args.out_file, mean, std, args.bs, args.N, args.sz, args.num_workers,
+            args.num_threads)
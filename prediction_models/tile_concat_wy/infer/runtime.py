@@ -0,0 +1,51 @@
+"""
+Inference backends for graphs exported by model/export.py. Only torch (and onnxruntime for .onnx files)
+is imported: neither fastai nor model.resnext_ssl are needed to run an exported model.
+"""
+
+import os
+import numpy as np
+import torch
+
+class TorchScriptModel(object):
+    def __init__(self, path, num_threads = None):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = torch.jit.load(path, map_location='cpu').eval()
+
+    def __call__(self, x):
+        """
+        x: (bs, N, 3, h, w) float tensor
+        return: (bs, n) tensor
+        """
+        with torch.no_grad():
+            return self.model(x)
+
+class OnnxRuntimeModel(object):
+    def __init__(self, path, num_threads = None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        """
+        x: (bs, N, 3, h, w) float tensor
+        return: (bs, n) tensor
+        """
+        x = np.ascontiguousarray(x.numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
+
+def load_runtime(path, num_threads = None):
+    """
+    Pick the backend from the file extension: .onnx for ONNX Runtime, .pt/.jit for TorchScript.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == '.onnx':
+        return OnnxRuntimeModel(path, num_threads)
+    if ext in ('.pt', '.jit'):
+        return TorchScriptModel(path, num_threads)
+    raise ValueError('Unknown exported model format {}, should be .onnx, .pt or .jit'.format(path))
@@ -0,0 +1,83 @@
+import math
+import torch
+import torch.nn.functional as F
+
+class BatchAugment(object):
+    """
+    Augment and normalize a collated batch of tiles in one pass, instead of per tile PIL transforms in the
+    DataLoader workers. Apply it to the (bs, N, 3, H, W) uint8 tensor after collate, on CPU or GPU.
+    Random flips and rot90 are tensor index operations, the rotation (like RandomAffine(degrees)) is one batched
+    affine_grid/grid_sample call with a white fill, and the normalization is a single fused multiply-add.
+    """
+    def __init__(self, mean = (0.5, 0.5, 0.5), std = (0.5, 0.5, 0.5), augment = True, flip = True, rot90 = True,
+                 degrees = 180, fill = 255, mode = 'bilinear', seed = None):
+        """
+        Args:
+            mean, std: channel statistics of images scaled to [0, 1].
+            augment (bool): False only normalizes (validation/inference).
+            flip (bool): random horizontal and vertical flips.
+            rot90 (bool): random rotation by a multiple of 90 degrees.
+            degrees (float): random rotation in [-degrees, degrees], 0 to disable.
+            fill (int): pixel value for areas outside the rotated tile.
+            mode (string): grid_sample interpolation, 'bilinear' or 'nearest'.
+            seed (int, optional): seed for a deterministic sequence of augmentations.
+        """
+        mean = torch.as_tensor(mean, dtype=torch.float32).view(1, 1, -1, 1, 1)
+        std = torch.as_tensor(std, dtype=torch.float32).view(1, 1, -1, 1, 1)
+        ## (x / 255 - mean) / std = x * scale + bias
+        self.scale = 1.0 / (255.0 * std)
+        self.bias = -mean / std
+        self.augment = augment
+        self.flip = flip
+        self.rot90 = rot90
+        self.degrees = degrees
+        self.fill = fill
+        self.mode = mode
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def _rand(self, n, device):
+        return torch.rand(n, generator=self.generator).to(device)
+
+    def __call__(self, x):
+        """
+        x: (bs, N, 3, H, W) uint8
+        return: (bs, N, 3, H, W) float32, augmented and normalized
+        """
+        bs, n, c, h, w = x.shape
+        x = x.reshape(bs * n, c, h, w).float()
+        if self.augment:
+            x = self._augment(x)
+        x = x.view(bs, n, c, h, w)
+        self.scale, self.bias = self.scale.to(x.device), self.bias.to(x.device)
+        return torch.addcmul(self.bias, x, self.scale)
+
+    def _augment(self, x):
+        num, c, h, w = x.shape
+        device = x.device
+        if self.flip:
+            flip_h = (self._rand(num, device) < 0.5).view(-1, 1, 1, 1)
+            flip_v = (self._rand(num, device) < 0.5).view(-1, 1, 1, 1)
+            x = torch.where(flip_h, x.flip(-1), x)
+            x = torch.where(flip_v, x.flip(-2), x)
+        if self.rot90:
+            ## quarter turns need square tiles, otherwise only half turns
+            n_turns = 4 if h == w else 2
+            ks = (self._rand(num, 'cpu') * n_turns).long() * (4 // n_turns)
+            for k in ks.unique().tolist():
+                if k == 0:
+                    continue
+                idx = (ks == k).nonzero().view(-1).to(device)
+                x[idx] = torch.rot90(x[idx], k, dims=(-2, -1))
+        if self.degrees:
+            angle = (self._rand(num, device) * 2 - 1) * math.radians(self.degrees)
+            cos, sin, zero = torch.cos(angle), torch.sin(angle), torch.zeros_like(angle)
+            theta = torch.stack([torch.stack([cos, -sin, zero], 1), torch.stack([sin, cos, zero], 1)], 1)
+            grid = F.affine_grid(theta, (num, c, h, w), align_corners=False)
+            ## zero padding of (x - fill) is a fill padding of x
+            x = F.grid_sample(x - self.fill, grid, mode=self.mode, padding_mode='zeros',
+                              align_corners=False) + self.fill
+        return x
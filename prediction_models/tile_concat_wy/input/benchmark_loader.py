@@ -0,0 +1,61 @@
+"""
+Epoch start latency and total cross-validation wall time of the data pipeline alone (no model):
+fresh workers and decoding every epoch against persistent workers with the shared decoded tile cache.
+"""
+
+## system package
+import os, sys, time, shutil
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+## custom package
+from input.inputPipeline import PandaPatchDataset, crossValDataloader
+from input.tile_cache import DecodedTileCache
+
+def run(args, persistent_workers, prefetch_factor, cache_dir, cache_val):
+    cache = None
+    if cache_dir:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cache = DecodedTileCache(cache_dir, args.cache_bytes)
+    dataset = PandaPatchDataset(args.csv_file, args.image_dir, N=args.N, cache=cache)
+    crossValData = crossValDataloader(args.csv_file, dataset, args.bs, args.num_workers, cache_val=cache_val,
+                                      persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    start_latency = []
+    start = time.perf_counter()
+    for fold in range(args.nfolds):
+        trainloader, valloader = crossValData(fold)
+        for epoch in range(args.epochs):
+            epoch_start = time.perf_counter()
+            for i, _ in enumerate(trainloader):
+                if i == 0:
+                    start_latency.append(time.perf_counter() - epoch_start)
+                if args.max_iters and i + 1 >= args.max_iters:
+                    break
+            for _ in valloader:
+                pass
+        del trainloader, valloader
+    return sum(start_latency) / max(len(start_latency), 1), time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the cross-validation data loaders')
+    parser.add_argument('--csv_file', default='../input/panda-16x128x128-tiles-data/4_fold_train.csv')
+    parser.add_argument('--image_dir', default='../input/panda-16x128x128-tiles-data/train/')
+    parser.add_argument('--nfolds', default=4, type=int)
+    parser.add_argument('--epochs', default=2, type=int)
+    parser.add_argument('--max_iters', default=None, type=int, help='training batches per epoch, default: all')
+    parser.add_argument('--bs', default=32, type=int)
+    parser.add_argument('--N', default=12, type=int)
+    parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--cache_dir', default='/dev/shm/panda_tiles_benchmark')
+    parser.add_argument('--cache_bytes', default=16 * 2 ** 30, type=int)
+    args = parser.parse_args()
+
+    ## before: workers forked every epoch, validation read every epoch, every png decoded in every fold
+    configs = [('before', False, 2, None, False), ('persistent', True, 4, None, True),
+               ('persistent+cache', True, 4, args.cache_dir, True)]
+    print('{:>18s} {:>16s} {:>14s}'.format('loader', 'epoch start s', 'total s'))
+    for name, persistent_workers, prefetch_factor, cache_dir, cache_val in configs:
+        latency, total = run(args, persistent_workers, prefetch_factor, cache_dir, cache_val)
+        print('{:>18s} {:>16.2f} {:>14.1f}'.format(name, latency, total))
+    shutil.rmtree(args.cache_dir, ignore_errors=True)
@@ -1,14 +1,17 @@
-import os
+import os, sys, copy
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import warnings
 warnings.filterwarnings("ignore")
 from PIL import Image
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
-import skimage.io
+from utiles.image_stats import get_stats, FolderSource
+from input.tiler import tile_image
+from input.tiff_reader import PyramidReader
+from input.tile_cache import DecodedTileCache
 
 class crossValInx(object):
     def __init__(self, csv_file):
@@ -20,36 +23,90 @@ class crossValInx(object):
         return train_idx, val_idx
 
 class crossValDataloader(object):
-    def __init__(self, csv_file, dataset, bs = 4):
+    def __init__(self, csv_file, dataset, bs = 4, num_workers = 4, cache_val = True, persistent_workers = True,
+                 prefetch_factor = 4):
+        """
+        Validation batches are uint8 tiles without any transform, in a fixed order: normalize them with
+        BatchAugment(augment=False). With cache_val, the validation slides of the fold are decoded once
+        (ValidationCache), otherwise they are read by a DataLoader every epoch.
+        persistent_workers: keep the workers of a fold alive between epochs instead of forking them every epoch.
+        prefetch_factor: batches loaded in advance by each worker.
+        """
         self.inx = crossValInx(csv_file)
         self.dataset = dataset
         self.bs = bs
+        self.num_workers = num_workers
+        self.cache_val = cache_val
+        self.loader_kwargs = dict(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor) \
+            if num_workers > 0 else dict()
 
     def __call__(self, fold = 0):
         train_idx, val_idx = self.inx(fold)
         train = torch.utils.data.Subset(self.dataset, train_idx)
-        val = torch.utils.data.Subset(self.dataset, val_idx)
-        trainloader = torch.utils.data.DataLoader(train, batch_size=self.bs, shuffle=True, num_workers=4,
-                                                  collate_fn=dataloader_collte_fn, pin_memory=True)
-        valloader = torch.utils.data.DataLoader(val, batch_size=self.bs, shuffle=True, num_workers=4,
-                                                collate_fn=dataloader_collte_fn, pin_memory=True)
+        trainloader = torch.utils.data.DataLoader(train, batch_size=self.bs, shuffle=True, num_workers=self.num_workers,
+                                                  collate_fn=dataloader_collte_fn, pin_memory=True,
+                                                  **self.loader_kwargs)
+        if self.cache_val:
+            valloader = ValidationCache(self.dataset, val_idx, self.bs, self.num_workers)
+        else:
+            val = torch.utils.data.Subset(untransformed(self.dataset), val_idx)
+            valloader = torch.utils.data.DataLoader(val, batch_size=self.bs, shuffle=False, num_workers=self.num_workers,
+                                                    collate_fn=dataloader_collte_fn, pin_memory=True,
+                                                    **self.loader_kwargs)
         return trainloader, valloader
 
+def untransformed(dataset):
+    """shallow copy of dataset returning uint8 tiles, without its (augmenting) transform"""
+    if getattr(dataset, 'transform', None) is None:
+        return dataset
+    dataset = copy.copy(dataset)
+    dataset.transform = None
+    return dataset
+
+class ValidationCache(object):
+    """
+    Validation tiles of a fold decoded once into a uint8 (n, N, 3, sz, sz) tensor in shared memory, without
+    augmentation. Iterating yields [imgs, labels] batches in a fixed order, like a DataLoader with shuffle=False,
+    so that validation only costs the model time.
+    """
+    def __init__(self, dataset, idxs, bs = 4, num_workers = 4):
+        self.bs = bs
+        self.imgs, self.labels = None, torch.zeros(len(idxs), dtype=torch.long)
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(untransformed(dataset), idxs), batch_size=bs,
+                                             shuffle=False, num_workers=num_workers, collate_fn=dataloader_collte_fn)
+        start = 0
+        for imgs, labels in loader:
+            if self.imgs is None:
+                self.imgs = torch.empty((len(idxs), ) + imgs.shape[1:], dtype=imgs.dtype).share_memory_()
+            self.imgs[start: start + len(imgs)] = imgs
+            self.labels[start: start + len(imgs)] = labels
+            start += len(imgs)
+
+    def __len__(self):
+        return (len(self.labels) + self.bs - 1) // self.bs
+
+    def __iter__(self):
+        for start in range(0, len(self.labels), self.bs):
+            yield [self.imgs[start: start + self.bs], self.labels[start: start + self.bs]]
+
 class PandaPatchDataset(Dataset):
     """Panda Tile dataset. With fixed tiles for each slide."""
-    def __init__(self, csv_file, image_dir, N = 12, transform=None):
+    def __init__(self, csv_file, image_dir, N = 12, transform=None, cache=None):
         """
         Args:
             csv_file (string): Path to the csv file with annotations.
             image_dir (string): Directory with all the images.
             N (interger): Number of tiles selected for each slide.
             transform (callable, optional): Optional transform to be applied
-                on a sample.
+                on a sample. Without transform, tiles are returned as uint8 tensor (N, 3, sz, sz),
+                to be augmented on the whole batch with input.batch_augment.BatchAugment.
+            cache (DecodedTileCache, optional): cache of the decoded tiles, shared across epochs and folds.
         """
         self.train_csv = pd.read_csv(csv_file)
         self.image_dir = image_dir
         self.transform = transform
         self.N = N
+        self.cache = cache
 
     def __len__(self):
         return len(self.train_csv)
@@ -57,21 +114,27 @@ class PandaPatchDataset(Dataset):
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        fnames = [os.path.join(self.image_dir, self.train_csv.loc[idx, 'image_id']+'_'+str(i)+'.png')
-                  for i in range(self.N)]
-        imgs = [self.open_image(fname)
-               for fname in fnames]
+        name = self.train_csv.loc[idx, 'image_id']
+        if self.cache is None:
+            tiles = self.decode(name)
+        else:
+            tiles = self.cache.get_or_decode(name, lambda: self.decode(name))
         isup_grade = self.train_csv.loc[idx, 'isup_grade']
 
         if self.transform:
-            imgs = [self.transform(img) for img in imgs]
-        ## convert the output to tensor
-        imgs = [torch.tensor(img) for img in imgs]
-        imgs = torch.stack(imgs)
+            imgs = torch.stack([self.transform(Image.fromarray(tile)) for tile in tiles])
+        else:
+            imgs = torch.from_numpy(tiles.transpose(0, 3, 1, 2).copy())
         isup_grade = torch.tensor(isup_grade)
         sample = {'image': imgs, 'isup_grade': isup_grade}
         return sample
 
+    def decode(self, name):
+        """return: (N, sz, sz, 3) uint8 tiles of slide name"""
+        fnames = [os.path.join(self.image_dir, name+'_'+str(i)+'.png')
+                  for i in range(self.N)]
+        return np.stack([np.asarray(self.open_image(fname)) for fname in fnames])
+
     def open_image(self, fn, convert_mode='RGB', after_open=None):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", UserWarning)  # EXIF warning from TiffPlugin
@@ -80,15 +143,55 @@ class PandaPatchDataset(Dataset):
             x = after_open(x)
         return x
 
+class PandaPatchMemmapDataset(Dataset):
+    """Panda Tile dataset read from the memory-mapped .npy tile store written by write_2_zip(out_format='npy')."""
+    def __init__(self, csv_file, tiles_file, N = 12, transform=None):
+        """
+        Args:
+            csv_file (string): Path to the csv file with annotations.
+            tiles_file (string): (num_slides, N', sz, sz, 3) uint8 .npy file, N' >= N.
+            N (interger): Number of tiles selected for each slide.
+            transform (callable, optional): Optional transform to be applied
+                on a sample. Without transform, tiles are returned as uint8 tensor (N, 3, sz, sz).
+        """
+        self.train_csv = pd.read_csv(csv_file)
+        ## imported here: tile_extraction imports cv2, only needed by the tile store writer
+        from input.tile_extraction import tile_store_index
+        self.tiles = np.load(tiles_file, mmap_mode='r')
+        store_ids = pd.read_csv(tile_store_index(tiles_file)).image_id
+        store_rows = pd.Series(np.arange(len(store_ids)), index=store_ids)
+        self.rows = store_rows[self.train_csv.image_id].to_numpy()
+        self.transform = transform
+        self.N = N
+
+    def __len__(self):
+        return len(self.train_csv)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+        ## tiles are stored sorted by tissue, so the first N are the N most tissue-rich
+        tiles = self.tiles[self.rows[idx], :self.N]
+        isup_grade = self.train_csv.loc[idx, 'isup_grade']
+        if self.transform:
+            imgs = torch.stack([self.transform(Image.fromarray(tile)) for tile in tiles])
+        else:
+            imgs = torch.from_numpy(np.ascontiguousarray(tiles.transpose(0, 3, 1, 2)))
+        isup_grade = torch.tensor(isup_grade)
+        sample = {'image': imgs, 'isup_grade': isup_grade}
+        return sample
+
 class PandaPatchDatasetInfer(Dataset):
-    def __init__(self, csv_file, image_dir, transform = None, N = 12, sz = 128):
+    def __init__(self, csv_file, image_dir, transform = None, N = 12, sz = 128, decode_threads = 1):
         """
         Args:
             csv_file (string): Path to the csv file with annotations.
             image_dir (string): Directory with all the images.
             N (interger): Number of tiles selected for each slide.
             transform (callable, optional): Optional transform to be applied
-                on a sample.
+                on a sample (tiles scaled to [0, 1]). Without transform, tiles are returned as
+                uint8 tensor (N, 3, sz, sz), to be normalized on the batch with BatchAugment(augment=False).
+            decode_threads (interger): Threads used to decode the lowest resolution page of a slide.
         """
         self.test_csv = pd.read_csv(csv_file)
         self.image_dir = image_dir
@@ -96,33 +199,24 @@ class PandaPatchDatasetInfer(Dataset):
         self.N = N
         self.sz = sz
         self.transform = transform
+        ## only decodes the lowest resolution page, the buffer is reused between slides
+        self.reader = PyramidReader(level=-1, maxworkers=decode_threads)
 
     def __len__(self):
         return len(self.test_csv)
 
     def __getitem__(self, idx):
         name = self.test_csv.image_id[idx]
-        img = skimage.io.MultiImage(os.path.join(self.image_dir, name + '.tiff'))[-1] # get the lowest resolution
-        imgs = self.tile_image(img) / 255.0 ## list of tiles per slide
+        img = self.reader.read(os.path.join(self.image_dir, name + '.tiff')) # get the lowest resolution
+        tiles = self.tile_image(img) ## N tiles per slide
         if self.transform:
-            imgs = [self.transform(img) for img in imgs]
-        ## convert the output to tensor
-        # imgs = [torch.tensor(img) for img in imgs]
-        imgs = torch.stack(imgs)
+            imgs = torch.stack([self.transform(tile) for tile in tiles / 255.0])
+        else:
+            imgs = torch.from_numpy(tiles.transpose(0, 3, 1, 2).copy())
         return {'image': imgs, 'name': name}
 
     def tile_image(self, img):
-        shape = img.shape
-        pad0, pad1 = (self.sz - shape[0] % self.sz) % self.sz, (self.sz - shape[1] % self.sz) % self.sz
-        img = np.pad(img, [[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2], [0, 0]], mode='constant',
-                     constant_values=255)
-        img = img.reshape(img.shape[0] // self.sz, self.sz, img.shape[1] // self.sz, self.sz, 3)
-        img = img.transpose(0, 2, 1, 3, 4).reshape(-1, self.sz, self.sz, 3)
-        if len(img) < self.N:
-            img = np.pad(img, [[0, self.N - len(img)], [0, 0], [0, 0], [0, 0]], mode='constant', constant_values=255)
-        idxs = np.argsort(img.reshape(img.shape[0], -1).sum(-1))[:self.N]
-        img = img[idxs]
-        return img
+        return tile_image(img, self.sz, self.N)[0]
 
 
 def data_transform(mean = (0.5,0.5,0.5), std = (0.5,0.5,0.5)):
@@ -154,9 +248,10 @@ if __name__ == "__main__":
     bs = 4
     csv_file = './panda-16x128x128-tiles-data/{}_fold_train.csv'.format(nfolds)
     image_dir = './panda-16x128x128-tiles-data/train/'
-    ## image statistics
-    mean = torch.tensor([0.90949707, 0.8188697, 0.87795304])
-    std = torch.tensor([0.36357649, 0.49984502, 0.40477625])
+    stats_file = './panda-16x128x128-tiles-data/stats.json'
+    ## image statistics, computed from the tiles on the first run
+    mean, std = get_stats(stats_file, FolderSource(image_dir))
+    mean, std = torch.tensor(mean), torch.tensor(std)
     ## image transformation
     tsfm = data_transform(mean, std)
     ## dataset, can fetch data by dataset[idx]
@@ -0,0 +1,47 @@
+import numpy as np
+import tifffile
+
+class PyramidReader(object):
+    """
+    Read one page of a pyramidal TIFF (PANDA slides store one pyramid level per page) without touching
+    the other levels. Replaces skimage.io.MultiImage(path)[-1]: only the IFD headers and the chosen page
+    are read, and the page is decoded into a buffer that is reused between calls.
+    """
+    def __init__(self, level = -1, maxworkers = 1):
+        """
+        Args:
+            level (int): page to read, negative values count from the last (lowest resolution) page.
+            maxworkers (int): threads used by tifffile to decode the tiles of the page.
+        """
+        self.level = level
+        self.maxworkers = maxworkers
+        self._buffer = None
+
+    def _get_buffer(self, shape, dtype):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self._buffer is None or self._buffer.nbytes < nbytes:
+            self._buffer = np.empty(nbytes, dtype=np.uint8)
+        return self._buffer[:nbytes].view(dtype).reshape(shape)
+
+    def read(self, path, out = None):
+        """
+        Args:
+            path (string): tiff file.
+            out (ndarray, optional): C-contiguous array with the page shape and dtype to decode into.
+        Returns:
+            the decoded page (h, w, c). Without out, it is a view of the reader buffer,
+            valid until the next call to read.
+        """
+        with tifffile.TiffFile(path) as tif:
+            level = self.level if self.level >= 0 else len(tif.pages) + self.level
+            page = tif.pages[level]
+            if out is None:
+                out = self._get_buffer(page.shape, page.dtype)
+            page.asarray(out=out, maxworkers=self.maxworkers)
+        return out
+
+    @staticmethod
+    def page_shape(path, level = -1):
+        with tifffile.TiffFile(path) as tif:
+            level = level if level >= 0 else len(tif.pages) + level
+            return tif.pages[level].shape
@@ -0,0 +1,94 @@
+import os, uuid
+import numpy as np
+
+class DecodedTileCache(object):
+    """
+    Cache of the decoded uint8 tiles of each slide, one .npy file per slide id in cache_dir, shared by the
+    DataLoader workers of every fold and epoch (and by concurrent processes). Put cache_dir on /dev/shm for a
+    shared memory cache or on a local disk for a larger one.
+    Files are written atomically (temporary file + rename) and evicted in least recently used order (file mtime,
+    refreshed on every hit) when the cache grows over max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes = 8 * 2 ** 30, rescan_frac = 0.05):
+        """
+        Args:
+            cache_dir (string): folder of the cached tiles, created if needed.
+            max_bytes (int): size budget of the cache.
+            rescan_frac (float): each process rescans cache_dir after writing rescan_frac * max_bytes,
+                so that the writes of the other processes are accounted for.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.rescan_bytes = max(1, int(rescan_frac * max_bytes))
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = None
+        self._written = 0
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, '{}.npy'.format(key))
+
+    def get(self, key):
+        """return: cached array of key, None on a miss"""
+        fname = self._file(key)
+        try:
+            arr = np.load(fname)
+            os.utime(fname)
+        except (OSError, ValueError):
+            ## missing, evicted meanwhile or partially removed
+            return None
+        return arr
+
+    def put(self, key, arr):
+        fname = self._file(key)
+        tmp = '{}.{}.tmp'.format(fname, uuid.uuid4().hex)
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, fname)
+        except OSError:
+            ## full or read-only cache: the data is still returned to the caller
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        if self._size is None:
+            self._size = self._scan()[1]
+        else:
+            self._size += arr.nbytes
+        self._written += arr.nbytes
+        if self._written >= self.rescan_bytes:
+            self._size, self._written = self._scan()[1], 0
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def evict(self, target_frac = 0.9):
+        """remove the least recently used slides until the cache is under target_frac * max_bytes"""
+        entries, size = self._scan()
+        for _, nbytes, path in sorted(entries):
+            if size <= target_frac * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= nbytes
+        self._size, self._written = size, 0
+
+    def get_or_decode(self, key, decode):
+        """cached array of key, decode() is called and its result cached on a miss"""
+        arr = self.get(key)
+        if arr is None:
+            arr = decode()
+            self.put(key, arr)
+        return arr
@@ -1,100 +1,201 @@
-import os
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import cv2
-import skimage.io
 from tqdm import tqdm
 import zipfile
+import time
+from multiprocessing import Pool
 import numpy as np
+from utiles.image_stats import RunningMoments, save_stats
+from input.tiler import tile_image, extract_tiles
+from input.tiff_reader import PyramidReader
 
 def tile(img, mask, sz=128, N=16):
     '''
     Tile img and mask into N patches with size (sz, sz, 3)
     img: (h,w,3)
     mask: (h,w,3)
+    return: imgs (N,sz,sz,3), masks (N,sz,sz,3)
     '''
-    result = []
-    shape = img.shape
-    ## calculate padding size so the dimesion is a multiple of sz
-    pad0, pad1 = (sz - shape[0] % sz) % sz, (sz - shape[1] % sz) % sz
-    ## pad image and msk
-    img = np.pad(img, [[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2], [0, 0]], mode='constant',
-                 constant_values=255)  # img (h',w',3)
-    mask = np.pad(mask, [[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2], [0, 0]], mode='constant',
-                  constant_values=0)  # mask (h',w',3)
-
-    img = img.reshape(img.shape[0] // sz, sz, img.shape[1] // sz, sz, 3)  # img (h'/128, 128, w'/128, 128, 3)
-    img = img.transpose(0, 2, 1, 3, 4).reshape(-1, sz, sz, 3)  # img (h'*w'/(128**2), 128, 128, 3)
-    mask = mask.reshape(mask.shape[0] // sz, sz, mask.shape[1] // sz, sz, 3)  # mask (h'/128, 128, w'/128, 128, 3)
-    mask = mask.transpose(0, 2, 1, 3, 4).reshape(-1, sz, sz, 3)  # mask (h'*w'/(128**2), 128, 128, 3)
-
-    ## if number of pathces cropped from the image is smaller than N, padding more patches with constant
-    if len(img) < N:
-        mask = np.pad(mask, [[0, N - len(img)], [0, 0], [0, 0], [0, 0]], mode='constant', constant_values=0)
-        img = np.pad(img, [[0, N - len(img)], [0, 0], [0, 0], [0, 0]], mode='constant', constant_values=255)
-    ## sort the patches by pixel value from smallest to largest
-    ## pick up the first N smallest patches, thoses are the patches that most likely contains tissues
-    ## as white space (255, 255, 255) contains the largest pixel value
-    idxs = np.argsort(img.reshape(img.shape[0], -1).sum(-1))[:N]
-    img = img[idxs]
-    mask = mask[idxs]
-    for i in range(len(img)):
-        result.append({'img': img[i], 'mask': mask[i], 'idx': i})
-    ## result: list [{'img': img[0], 'mask': mask[0], 'idx': 0},{'img': img[1], 'mask': mask[1], 'idx': 1},...]
-    return result
-
-def write_2_zip(Source_Folder, Des_File, names, sz = 128, N = 16):
+    ## pick up the N patches with the smallest pixel sum, thoses are the patches that most likely contains tissues
+    ## as white space (255, 255, 255) contains the largest pixel value. Padding is white for img and 0 for mask.
+    imgs, idxs = tile_image(img, sz, N, pad_value=255)
+    masks = extract_tiles(mask, idxs, sz, N, pad_value=0)
+    return imgs, masks
+
+def tile_store_index(tiles_file):
+    """Path of the csv listing the image_id of each row in a .npy tile store"""
+    return os.path.splitext(tiles_file)[0] + '_ids.csv'
+
+def encode_png(img, png_compression=None):
+    params = [] if png_compression is None else [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    return cv2.imencode('.png', img, params)[1]
+
+class ZipTileWriter(object):
+    """Write each tile as a png file into image and mask zip files. Tiles are encoded by the workers."""
+    def __init__(self, Des_File):
+        OUT_TRAIN, OUT_MASKS = Des_File
+        self.img_out = zipfile.ZipFile(OUT_TRAIN, 'w')
+        self.mask_out = zipfile.ZipFile(OUT_MASKS, 'w')
+
+    @staticmethod
+    def encode(imgs, masks, png_compression=None):
+        # if read with PIL RGB turns into BGR
+        return [(encode_png(cv2.cvtColor(imgs[idx], cv2.COLOR_RGB2BGR), png_compression),
+                 encode_png(masks[idx][:, :, 0], png_compression)) for idx in range(len(imgs))]
+
+    def write(self, slide_idx, name, encoded):
+        for idx, (img, mask) in enumerate(encoded):
+            self.img_out.writestr('{0:s}_{1:d}.png'.format(name, idx), img)
+            self.mask_out.writestr('{0:s}_{1:d}.png'.format(name, idx), mask)
+
+    def close(self):
+        self.img_out.close()
+        self.mask_out.close()
+
+class NpyTileWriter(object):
+    """
+    Write tiles into one (num_slides, N, sz, sz, 3) uint8 .npy file and masks into one (num_slides, N, sz, sz) file,
+    both can be memory mapped with np.load(mmap_mode='r'). Row i belongs to names[i], listed in tile_store_index.
+    The files are created here, workers write their rows directly into the memory map (see _write_npy_rows).
+    """
+    def __init__(self, Des_File, names, sz, N):
+        OUT_TRAIN, OUT_MASKS = Des_File
+        self.OUT_TRAIN = OUT_TRAIN
+        self.names = names
+        imgs = np.lib.format.open_memmap(OUT_TRAIN, mode='w+', dtype=np.uint8, shape=(len(names), N, sz, sz, 3))
+        masks = np.lib.format.open_memmap(OUT_MASKS, mode='w+', dtype=np.uint8, shape=(len(names), N, sz, sz))
+        del imgs, masks
+
+    def write(self, slide_idx, name, encoded):
+        return
+
+    def close(self):
+        ## drop the maps opened when slides are processed in the main process
+        for store in _npy_stores.values():
+            store.flush()
+        _npy_stores.clear()
+        with open(tile_store_index(self.OUT_TRAIN), 'w') as f:
+            f.write('image_id\n' + '\n'.join(self.names) + '\n')
+
+## lowest resolution page readers of each worker process, buffers are reused between slides
+_img_reader, _mask_reader = PyramidReader(level=-1), PyramidReader(level=-1)
+## memory maps opened by each worker process, {path: np.memmap}
+_npy_stores = {}
+
+def _write_npy_rows(Des_File, slide_idx, imgs, masks):
+    for path, data in zip(Des_File, [imgs, masks[..., 0]]):
+        if path not in _npy_stores:
+            _npy_stores[path] = np.load(path, mmap_mode='r+')
+        _npy_stores[path][slide_idx] = data
+
+def process_slide(job):
+    """
+    Worker: read the lowest resolution of a slide and its mask, tile them and encode the tiles.
+    :param job: (slide_idx, name, Source_Folder, Des_File, sz, N, out_format, png_compression)
+    :return: slide_idx, name, encoded tiles (None for npy), RunningMoments of the tiles
+    """
+    slide_idx, name, Source_Folder, Des_File, sz, N, out_format, png_compression = job
+    TRAIN, MASKS = Source_Folder
+    ## read the image and label with the lowest res by [-1]
+    img = _img_reader.read(os.path.join(TRAIN, name + '.tiff'))
+    mask = _mask_reader.read(os.path.join(MASKS, name + '_mask.tiff'))
+    ## tile the img and mask to N patches with size (sz,sz,3)
+    imgs, masks = tile(img, mask, sz, N)
+    moments = RunningMoments().update(imgs)
+    if out_format == 'zip':
+        encoded = ZipTileWriter.encode(imgs, masks, png_compression)
+    else:
+        _write_npy_rows(Des_File, slide_idx, imgs, masks)
+        encoded = None
+    return slide_idx, name, encoded, moments
+
+def write_2_zip(Source_Folder, Des_File, names, sz = 128, N = 16, out_format = 'zip', num_workers = 4,
+                png_compression = None, stats_file = None):
     """
     Extract patches from orginal images and save them to des file.
+    Workers read, tile and encode the slides, the main process is the single writer.
     :param Source_Folder: list, contains the original image and mask folder
-    :param Des_File: list, contains the final image and mask path for zip file
+    :param Des_File: list, contains the final image and mask path for zip file (or .npy files for out_format='npy')
     :param names: list, contain the id for images needed to be processed
     :param sz: image patch size
     :param N: how many patches selected from each slide
-    :return:
+    :param out_format: 'zip': png tiles in zip files; 'npy': memory-mappable (num_slides, N, sz, sz, 3) uint8 array
+    :param num_workers: number of worker processes, 0 processes the slides in the main process
+    :param png_compression: png compression level (0-9) for zip output, None uses the OpenCV default
+    :param stats_file: optional json file to save the image statistics, load with utiles.image_stats.load_stats
+    :return: image channel mean and std
     """
-    TRAIN, MASKS = Source_Folder
-    OUT_TRAIN, OUT_MASKS = Des_File
-    ## x_tot: [np.array(r_mean,g_mean,b_mean), np.array(r_mean,g_mean,b_mean),....]
-    ## x2_tot: [np.array(r^2_mean,g^2_mean,b_mean), np.array(r^2_mean,g^2_mean,b^2_mean),....]
-    x_tot, x2_tot = [], []
-    with zipfile.ZipFile(OUT_TRAIN, 'w') as img_out, \
-            zipfile.ZipFile(OUT_MASKS, 'w') as mask_out:
-        for name in tqdm(names):
-            ## read the image and label with the lowest res by [-1]
-            img = skimage.io.MultiImage(os.path.join(TRAIN, name + '.tiff'))[-1]
-            mask = skimage.io.MultiImage(os.path.join(MASKS, name + '_mask.tiff'))[-1]
-            ## tile the img and mask to N patches with size (sz,sz,3)
-            tiles = tile(img, mask, sz, N)
-            for t in tiles:
-                img, mask, idx = t['img'], t['mask'], t['idx']
-                x_tot.append((img / 255.0).reshape(-1, 3).mean(0))  ## append channel mean
-                x2_tot.append(((img / 255.0) ** 2).reshape(-1, 3).mean(0))
-                # if read with PIL RGB turns into BGR
-                img = cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))[1]
-                img_out.writestr('{0:s}_{1:d}.png'.format(name, idx), img)
-                mask = cv2.imencode('.png', mask[:, :, 0])[1]
-                mask_out.writestr('{0:s}_{1:d}.png'.format(name, idx), mask)
+    if out_format == 'zip':
+        writer = ZipTileWriter(Des_File)
+    elif out_format == 'npy':
+        writer = NpyTileWriter(Des_File, names, sz, N)
+    else:
+        raise ValueError('Unknown out_format {}, should be zip or npy'.format(out_format))
+    jobs = [(slide_idx, name, Source_Folder, Des_File, sz, N, out_format, png_compression)
+            for slide_idx, name in enumerate(names)]
+    ## pixel statistics of the selected tiles, merged from the per slide moments
+    moments = RunningMoments()
+    start_time = time.time()
+    pool = Pool(num_workers) if num_workers > 0 else None
+    try:
+        results = pool.imap_unordered(process_slide, jobs) if pool else map(process_slide, jobs)
+        for slide_idx, name, encoded, slide_moments in tqdm(results, total=len(jobs)):
+            writer.write(slide_idx, name, encoded)
+            moments.merge(slide_moments)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        writer.close()
+    elapsed = time.time() - start_time
+    print('{} slides in {:.1f}s, {:.2f} slides/s with {} workers'.format(len(names), elapsed,
+                                                                         len(names) / max(elapsed, 1e-9),
+                                                                         num_workers))
 
     # image stats
-    # print(np.array(x_tot).shape) ## (168256, 3)
-    img_avr = np.array(x_tot).mean(0)
-    # print(np.array(x_tot).shape) ## (168256, 3)
-    img_std = np.sqrt(np.array(x2_tot).mean(0) - img_avr ** 2)  ## variance = sqrt(E(X^2) - E(X)^2)
-    img_std = np.sqrt(img_std)
+    img_avr, img_std = moments.mean, moments.std
     print('mean:', img_avr, ', std:', img_std)
+    if stats_file:
+        save_stats(moments, stats_file)
     return (img_avr, img_std)
 
+def benchmark_write_2_zip(Source_Folder, names, out_dir, sz = 128, N = 16, out_format = 'zip',
+                          worker_counts = (0, 1, 2, 4, 8), png_compression = None):
+    """
+    Run write_2_zip on names with different worker counts, writing into out_dir.
+    :return: dict, {num_workers: slides/s}
+    """
+    ext = '.zip' if out_format == 'zip' else '.npy'
+    Des_File = [os.path.join(out_dir, 'bench_train' + ext), os.path.join(out_dir, 'bench_masks' + ext)]
+    throughput = {}
+    for num_workers in worker_counts:
+        start_time = time.time()
+        write_2_zip(Source_Folder, Des_File, names, sz, N, out_format, num_workers, png_compression)
+        throughput[num_workers] = len(names) / (time.time() - start_time)
+    for num_workers, slides_per_s in throughput.items():
+        print('workers: {:3d}, {:.2f} slides/s'.format(num_workers, slides_per_s))
+    return throughput
+
 if __name__ == "__main__":
     """Define Your Input"""
     TRAIN = '../input/prostate-cancer-grade-assessment/train_images/'  ## train image folder
     MASKS = '../input/prostate-cancer-grade-assessment/train_label_masks/'  ## train mask folder
     OUT_TRAIN = '../input/panda-16x128x128-tiles-data/train.zip'  ## output image folder
     OUT_MASKS = '../input/panda-16x128x128-tiles-data/masks.zip'  ## ouput label folder
+    STATS_FILE = '../input/panda-16x128x128-tiles-data/stats.json'  ## image channel mean and std
     sz = 128 ## image patch size
     N = 16 ## how many patches selected from each slide
+    out_format = 'zip' ## 'zip': png tiles, 'npy': memory-mapped tile store for PandaPatchMemmapDataset
+    num_workers = 4 ## processes reading, tiling and encoding slides
+    png_compression = None ## png compression level 0-9, None for the OpenCV default
+    if out_format == 'npy':
+        OUT_TRAIN, OUT_MASKS = OUT_TRAIN[:-4] + '.npy', OUT_MASKS[:-4] + '.npy'
     names = [name[:-10] for name in os.listdir(MASKS)]
     print(len(names))  ## only images that have masks
 
     """Process Image"""
     Source_Folder = [TRAIN, MASKS]
     Des_File = [OUT_TRAIN, OUT_MASKS]
-    mean, std = write_2_zip(Source_Folder, Des_File, names, sz, N)
\ No newline at end of file
+    mean, std = write_2_zip(Source_Folder, Des_File, names, sz, N, out_format, num_workers, png_compression,
+                            STATS_FILE)
\ No newline at end of file
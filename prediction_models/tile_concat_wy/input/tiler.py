@@ -0,0 +1,134 @@
+"""
+Shared tiler for training preprocessing (tile_extraction.tile) and inference (PandaPatchDatasetInfer).
+The image is conceptually padded to a multiple of sz (padding split evenly on both sides) and cut in a grid
+of sz x sz tiles; the N tiles with the smallest pixel sum (most tissue, white is 255) are kept.
+The padded image is never materialized: tile sums are computed on the original image and the padding
+contribution is added analytically, only edge tiles are padded when they are copied out.
+"""
+
+import time
+import argparse
+import numpy as np
+
+def _grid(h, w, sz):
+    pad0, pad1 = (sz - h % sz) % sz, (sz - w % sz) % sz
+    return pad0 // 2, pad1 // 2, (h + pad0) // sz, (w + pad1) // sz
+
+def _spans(n, sz, offset, size):
+    """start and end (in image coordinates) of the image part of each tile along one axis"""
+    starts = np.arange(n) * sz - offset
+    return np.maximum(starts, 0), np.minimum(starts + sz, size)
+
+def tile_scores(img, sz, pad_value=255):
+    """
+    Pixel sum of each tile of the padded image, in row major grid order.
+    img: (h, w, c) uint8
+    return: (n_rows * n_cols, ) int64
+    """
+    if img.ndim == 2:
+        img = img[..., None]
+    h, w, n_channels = img.shape
+    top, left, n_rows, n_cols = _grid(h, w, sz)
+    row_starts, row_ends = _spans(n_rows, sz, top, h)
+    col_starts, col_ends = _spans(n_cols, sz, left, w)
+    ## full tiles: the first / last row and column are partial when there is padding on that side
+    r0, r1 = int(top > 0), n_rows - int(row_ends[-1] - row_starts[-1] < sz)
+    c0, c1 = int(left > 0), n_cols - int(col_ends[-1] - col_starts[-1] < sz)
+    sums = np.zeros((n_rows, n_cols), dtype=np.int64)
+    if r1 > r0 and c1 > c0:
+        ## reshape view of the interior, no per pixel int64 copy of the image
+        inner = img[row_starts[r0]:row_ends[r1 - 1], col_starts[c0]:col_ends[c1 - 1]]
+        sums[r0:r1, c0:c1] = inner.reshape(r1 - r0, sz, c1 - c0, sz, n_channels).sum(axis=(1, 3, 4), dtype=np.int64)
+    ## partial edge rows and columns, strips of less than sz pixels
+    for r in {0, n_rows - 1} - set(range(r0, r1)):
+        strip = img[row_starts[r]:row_ends[r]].sum(axis=(0, 2), dtype=np.int64)
+        sums[r] = np.add.reduceat(strip, col_starts)
+    for c in {0, n_cols - 1} - set(range(c0, c1)):
+        strip = img[:, col_starts[c]:col_ends[c]].sum(axis=(1, 2), dtype=np.int64)
+        sums[:, c] = np.add.reduceat(strip, row_starts)
+    n_pad = sz * sz - (row_ends - row_starts)[:, None] * (col_ends - col_starts)[None, :]
+    return (sums + n_pad * pad_value * n_channels).reshape(-1)
+
+def select_tiles(scores, N):
+    """
+    Indices of the N smallest scores, sorted from smallest to largest
+    """
+    if len(scores) > N:
+        idxs = np.argpartition(scores, N - 1)[:N]
+    else:
+        idxs = np.arange(len(scores))
+    return idxs[np.argsort(scores[idxs], kind='stable')]
+
+def extract_tiles(img, idxs, sz, N, pad_value=255, out=None):
+    """
+    Copy the tiles idxs (grid indices from tile_scores) of img into out.
+    If fewer than N tiles are selected, the remaining tiles are filled with pad_value.
+    img: (h, w, ...) array
+    out: optional preallocated (N, sz, sz, ...) array with the dtype of img
+    return: out
+    """
+    h, w = img.shape[:2]
+    top, left, n_rows, n_cols = _grid(h, w, sz)
+    if out is None:
+        out = np.empty((N, sz, sz) + img.shape[2:], dtype=img.dtype)
+    for k, t in enumerate(idxs):
+        r, c = divmod(int(t), n_cols)
+        y, x = r * sz - top, c * sz - left
+        y0, y1, x0, x1 = max(y, 0), min(y + sz, h), max(x, 0), min(x + sz, w)
+        if y1 - y0 < sz or x1 - x0 < sz:
+            ## edge tile
+            out[k].fill(pad_value)
+        out[k, y0 - y: y1 - y, x0 - x: x1 - x] = img[y0:y1, x0:x1]
+    out[len(idxs):].fill(pad_value)
+    return out
+
+def tile_image(img, sz=128, N=16, pad_value=255, out=None):
+    """
+    Select the N tiles of img with most tissue.
+    img: (h, w, 3) uint8
+    return: tiles (N, sz, sz, 3) sorted from smallest to largest pixel sum, grid indices of the selected tiles
+    """
+    idxs = select_tiles(tile_scores(img, sz, pad_value), N)
+    return extract_tiles(img, idxs, sz, N, pad_value, out), idxs
+
+def _tile_reference(img, sz, N):
+    """Pad, reshape and argsort every tile, the implementation tile_image replaces"""
+    shape = img.shape
+    pad0, pad1 = (sz - shape[0] % sz) % sz, (sz - shape[1] % sz) % sz
+    img = np.pad(img, [[pad0 // 2, pad0 - pad0 // 2], [pad1 // 2, pad1 - pad1 // 2], [0, 0]], mode='constant',
+                 constant_values=255)
+    img = img.reshape(img.shape[0] // sz, sz, img.shape[1] // sz, sz, 3)
+    img = img.transpose(0, 2, 1, 3, 4).reshape(-1, sz, sz, 3)
+    if len(img) < N:
+        img = np.pad(img, [[0, N - len(img)], [0, 0], [0, 0], [0, 0]], mode='constant', constant_values=255)
+    idxs = np.argsort(img.reshape(img.shape[0], -1).sum(-1))[:N]
+    return img[idxs]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark tile_image against the pad + argsort tiler')
+    ## largest PANDA lowest resolution (level 2) thumbnails are several thousand pixels on each side
+    parser.add_argument('--height', default=8192, type=int)
+    parser.add_argument('--width', default=6144, type=int)
+    parser.add_argument('--sz', default=128, type=int)
+    parser.add_argument('--N', default=16, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    ## white background with a tissue-like darker region
+    img = np.full((args.height, args.width, 3), 255, dtype=np.uint8)
+    img[args.height // 4: 3 * args.height // 4, args.width // 3: 2 * args.width // 3] = \
+        rng.randint(120, 230, (3 * args.height // 4 - args.height // 4, 2 * args.width // 3 - args.width // 3, 3))
+    out = np.empty((args.N, args.sz, args.sz, 3), dtype=np.uint8)
+
+    for name, fn in [('reference', lambda: _tile_reference(img, args.sz, args.N)),
+                     ('tile_image', lambda: tile_image(img, args.sz, args.N, out=out)[0])]:
+        fn()
+        start = time.time()
+        for _ in range(args.repeat):
+            tiles = fn()
+        print('{:>10s}: {:.1f} ms per image'.format(name, (time.time() - start) / args.repeat * 1000))
+    ## same tile sums selected (tile order may differ on ties)
+    ref_sums = np.sort(_tile_reference(img, args.sz, args.N).reshape(args.N, -1).sum(-1))
+    new_sums = np.sort(tile_image(img, args.sz, args.N)[0].reshape(args.N, -1).sum(-1))
+    print('same selection:', np.array_equal(ref_sums, new_sums))
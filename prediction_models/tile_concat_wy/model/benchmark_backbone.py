@@ -0,0 +1,52 @@
+"""
+Construction time of the training Model: torch.hub.load (hub repo resolution + download cache + random init + copy)
+against the local weight registry (meta device + memory-mapped weights), and a check that both give the same
+backbone weights. The registry is filled first, so the registry timings are those of every fold after the first.
+"""
+
+## system package
+import os, sys, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+## general package
+import torch
+## custom package
+from model.resnext_ssl import Model
+from utiles.hubconf import build_backbone, fetch_weights
+
+def timed(build, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        m = build()
+        times.append(time.perf_counter() - start)
+    return m, sorted(times)[len(times) // 2]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the construction of Model')
+    parser.add_argument('--arch', default='resnext50_32x4d_ssl')
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--no_hub', action='store_true', help='skip torch.hub.load (no network access)')
+    args = parser.parse_args()
+
+    fetch_weights(args.arch)
+    results = []
+    if not args.no_hub:
+        hub, t = timed(lambda: torch.hub.load('facebookresearch/semi-supervised-ImageNet1K-models', args.arch),
+                       args.repeat)
+        results.append(('torch.hub.load', t))
+    registry, t = timed(lambda: build_backbone(args.arch), args.repeat)
+    results.append(('registry mmap', t))
+    _, t = timed(lambda: build_backbone(args.arch, mmap=False), args.repeat)
+    results.append(('registry read', t))
+    _, t = timed(lambda: Model(args.arch, n=1), args.repeat)
+    results.append(('Model', t))
+    print('{:>16s} {:>10s}'.format('construction', 'ms'))
+    for name, t in results:
+        print('{:>16s} {:>10.1f}'.format(name, 1000 * t))
+    if not args.no_hub:
+        hub_state = hub.state_dict()
+        same = all(torch.equal(v, hub_state[k]) for k, v in registry.state_dict().items())
+        print('registry weights identical to torch.hub.load: {}'.format(same))
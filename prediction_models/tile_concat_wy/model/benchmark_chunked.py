@@ -0,0 +1,98 @@
+"""
+Peak RSS and step time of the tile encoder with and without chunked/checkpointed encoding (Model_Infer enc_chunk)
+as the number of tiles per slide grows. Each configuration runs in its own process so that its peak RSS is not
+hidden by an earlier, larger one.
+"""
+
+## system package
+import os, sys, time, json, resource, subprocess
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+
+def run_config(mode, N, enc_chunk, args):
+    """train: forward + backward + SGD step in train mode, infer: forward under no_grad in eval mode"""
+    import torch
+    from model.resnext_ssl import Model_Infer
+    torch.manual_seed(0)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    model = Model_Infer(args.arch, n=1, enc_chunk=enc_chunk, enc_segments=args.enc_segments)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    x = torch.rand(args.bs, N, 3, args.sz, args.sz)
+    y = torch.rand(args.bs)
+    if mode == 'train':
+        model.train()
+        def step():
+            optimizer.zero_grad()
+            loss = torch.nn.functional.mse_loss(model(x).squeeze(1), y)
+            loss.backward()
+            optimizer.step()
+    else:
+        model.eval()
+        def step():
+            with torch.no_grad():
+                model(x)
+    step()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        step()
+    step_time = (time.perf_counter() - start) / args.repeat
+    ## ru_maxrss is in kilobytes on linux
+    return dict(mode=mode, N=N, enc_chunk=enc_chunk, step_s=step_time,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+def check_identical(args):
+    """chunked and plain encoding give the same outputs, gradients and BatchNorm statistics"""
+    import copy
+    import torch
+    from model.resnext_ssl import Model_Infer
+    torch.manual_seed(0)
+    x = torch.rand(args.bs, 12, 3, args.sz, args.sz)
+    plain = Model_Infer(args.arch, n=1).train()
+    chunked = copy.deepcopy(plain)
+    chunked.enc_chunk, chunked.enc_segments = 4, args.enc_segments
+    out_plain, out_chunked = plain(x), chunked(x)
+    out_plain.sum().backward()
+    out_chunked.sum().backward()
+    grad_diff = max((p.grad - q.grad).abs().max().item() for p, q in zip(plain.parameters(), chunked.parameters()))
+    bn_diff = max((p - q).abs().max().item() for p, q in zip(plain.buffers(), chunked.buffers()))
+    plain.eval(), chunked.eval()
+    with torch.no_grad():
+        eval_diff = (plain(x) - chunked(x)).abs().max().item()
+    print('train output diff {:.2e}, grad diff {:.2e}, bn stats diff {:.2e}, eval output diff {:.2e}'.format(
+        (out_plain - out_chunked).abs().max().item(), grad_diff, bn_diff, eval_diff))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark chunked tile encoding for growing N')
+    parser.add_argument('--arch', default='resnext50_32x4d')
+    parser.add_argument('--bs', default=2, type=int)
+    parser.add_argument('--sz', default=128, type=int, help='tile size')
+    parser.add_argument('--Ns', default='12,16,24,32,48,64', help='tiles per slide')
+    parser.add_argument('--enc_chunk', default=8, type=int, help='tiles per chunk')
+    parser.add_argument('--enc_segments', default=4, type=int, help='checkpointed segments in training')
+    parser.add_argument('--modes', default='train,infer')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--num_threads', default=None, type=int)
+    parser.add_argument('--config', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config:
+        ## child process: run a single configuration and print its result
+        mode, N, enc_chunk = json.loads(args.config)
+        print(json.dumps(run_config(mode, N, enc_chunk, args)))
+        sys.exit(0)
+
+    check_identical(args)
+    print('{:>6s} {:>4s} {:>9s} {:>10s} {:>13s}'.format('mode', 'N', 'enc_chunk', 'step s', 'peak RSS MB'))
+    child_args = sys.argv[1:]
+    for mode in args.modes.split(','):
+        for N in [int(N) for N in args.Ns.split(',')]:
+            for enc_chunk in [None, args.enc_chunk]:
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), *child_args,
+                                      '--config', json.dumps([mode, N, enc_chunk])],
+                                     check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+                result = json.loads(out.strip().splitlines()[-1])
+                print('{:>6s} {:>4d} {:>9s} {:>10.2f} {:>13.0f}'.format(mode, N, str(enc_chunk), result['step_s'],
+                                                                       result['peak_rss_mb']))
@@ -0,0 +1,83 @@
+"""
+Cold start and throughput of the eager model (fastai + Model_Infer) against the TorchScript and ONNX Runtime
+graphs exported by model/export.py. Cold start is the wall time of a fresh python process that imports the
+backend, loads the weights and predicts one batch.
+"""
+
+## system package
+import os, sys, time, subprocess
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+
+def load_backend(backend, path, arch, n, num_threads):
+    if backend == 'eager':
+        import torch
+        from infer.predict import load_model
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        model = load_model(path, arch, n)
+        def run(x):
+            with torch.no_grad():
+                return model(x)
+        return run
+    from infer.runtime import load_runtime
+    return load_runtime(path, num_threads)
+
+def cold_start(backend, path, args):
+    cmd = [sys.executable, os.path.abspath(__file__), '--single', backend, '--single_path', path,
+           '--arch', args.arch, '--n', str(args.n), '--bs', str(args.bs), '--N', str(args.N), '--sz', str(args.sz)]
+    if args.num_threads:
+        cmd += ['--num_threads', str(args.num_threads)]
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def throughput(run, args):
+    import torch
+    x = torch.rand(args.bs, args.N, 3, args.sz, args.sz)
+    for _ in range(args.warmup):
+        run(x)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        run(x)
+    elapsed = time.perf_counter() - start
+    return elapsed / args.repeat * 1000, args.bs * args.repeat / elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark eager PyTorch against exported TorchScript/ONNX graphs')
+    parser.add_argument('--weights', default='./weights/Resnext50_reg/Resnext50_reg_0_best.pth.tar')
+    parser.add_argument('--out_prefix', default='./weights/Resnext50_reg/Resnext50_reg_0',
+                        help='exported files out_prefix.pt and out_prefix.onnx')
+    parser.add_argument('--arch', default='resnext50_32x4d')
+    parser.add_argument('--n', default=1, type=int, help='model outputs, 1 for regression')
+    parser.add_argument('--bs', default=8, type=int)
+    parser.add_argument('--N', default=12, type=int, help='tiles per slide')
+    parser.add_argument('--sz', default=128, type=int, help='tile size')
+    parser.add_argument('--num_threads', default=None, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--single', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--single_path', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        ## child process of the cold start measurement: import, load and predict one batch
+        import torch
+        load_backend(args.single, args.single_path, args.arch, args.n, args.num_threads)(
+            torch.rand(args.bs, args.N, 3, args.sz, args.sz))
+        sys.exit(0)
+
+    backends = [('eager', args.weights)]
+    for backend, ext in [('torchscript', '.pt'), ('onnx', '.onnx')]:
+        if os.path.exists(args.out_prefix + ext):
+            backends.append((backend, args.out_prefix + ext))
+        else:
+            print('{} not found, run model/export.py first'.format(args.out_prefix + ext))
+
+    print('{:>12s} {:>14s} {:>12s} {:>10s}'.format('backend', 'cold start s', 'ms/batch', 'slides/s'))
+    for backend, path in backends:
+        cold = cold_start(backend, path, args)
+        ms, slides = throughput(load_backend(backend, path, args.arch, args.n, args.num_threads), args)
+        print('{:>12s} {:>14.2f} {:>12.1f} {:>10.2f}'.format(backend, cold, ms, slides))
@@ -0,0 +1,101 @@
+## system package
+import os, sys, io, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+## general package
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from sklearn.metrics import cohen_kappa_score
+## custom package
+from input.inputPipeline import PandaPatchDataset, crossValInx, dataloader_collte_fn
+from input.batch_augment import BatchAugment
+from infer.predict import load_model, to_isup_grade
+from model.quantize import quantize_model
+from utiles.image_stats import load_stats
+from utiles.profiling import rss_mb
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+def load_batches(dataset, idxs, normalize, bs, max_batches = None):
+    """normalized (bs, N, 3, sz, sz) inputs and isup grades, decoded once so every variant sees the same data"""
+    loader = DataLoader(Subset(dataset, idxs), batch_size=bs, shuffle=False, num_workers=2,
+                        collate_fn=dataloader_collte_fn)
+    batches = []
+    for i, (imgs, labels) in enumerate(loader):
+        if max_batches is not None and i >= max_batches:
+            break
+        batches.append((normalize(imgs), labels))
+    return batches
+
+def evaluate(model, batches, warmup = 2):
+    """
+    return: predicted isup grades, median and mean ms per batch, largest RSS increase (MB) sampled after each batch
+        (allocations freed inside a forward pass are not seen)
+    """
+    rss_start = rss_peak = rss_mb()
+    preds, times = [], []
+    with torch.inference_mode():
+        for x, _ in batches[:warmup]:
+            model(x)
+        for x, _ in batches:
+            start = time.perf_counter()
+            outputs = model(x)
+            times.append(time.perf_counter() - start)
+            preds.append(to_isup_grade(outputs))
+            rss_peak = max(rss_peak, rss_mb())
+    return torch.cat(preds).numpy(), np.median(times) * 1000, np.mean(times) * 1000, rss_peak - rss_start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare latency, memory and QWK of quantized Model_Infer variants')
+    parser.add_argument('--csv_file', default='../input/panda-16x128x128-tiles-data/5_fold_train.csv')
+    parser.add_argument('--image_dir', default='../input/panda-16x128x128-tiles-data/train/')
+    parser.add_argument('--stats_file', default='../input/panda-16x128x128-tiles-data/stats.json')
+    parser.add_argument('--weights', default='./weights/Resnext50_reg/Resnext50_reg_0_best.pth.tar')
+    parser.add_argument('--fold', default=0, type=int, help='evaluated on this fold, calibrated on the others')
+    parser.add_argument('--arch', default='resnext50_32x4d')
+    parser.add_argument('--n', default=1, type=int, help='model outputs, 1 for regression')
+    parser.add_argument('--bs', default=8, type=int)
+    parser.add_argument('--N', default=12, type=int, help='tiles per slide')
+    parser.add_argument('--calib_batches', default=16, type=int)
+    parser.add_argument('--eval_batches', default=None, type=int, help='default: whole fold')
+    parser.add_argument('--num_threads', default=None, type=int)
+    parser.add_argument('--modes', default='fp32,dynamic,static')
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    mean, std = load_stats(args.stats_file)
+    normalize = BatchAugment(mean, std, augment=False)
+    dataset = PandaPatchDataset(args.csv_file, args.image_dir, N=args.N)
+    train_idx, val_idx = crossValInx(args.csv_file)(args.fold)
+    ## calibration tiles come from the training folds, never from the evaluated fold
+    rng = np.random.RandomState(0)
+    calib_idx = rng.choice(train_idx, min(len(train_idx), args.calib_batches * args.bs), replace=False).tolist()
+    calib = [x for x, _ in load_batches(dataset, calib_idx, normalize, args.bs)]
+    batches = load_batches(dataset, val_idx, normalize, args.bs, args.eval_batches)
+    labels = torch.cat([y for _, y in batches]).numpy()
+
+    float_model = load_model(args.weights, args.arch, args.n)
+    variants = [('float', float_model)]
+    for mode in args.modes.split(','):
+        start = time.perf_counter()
+        variants.append((mode, quantize_model(float_model, mode, calib_batches=calib if mode == 'static' else None)))
+        print('{}: built in {:.1f}s'.format(mode, time.perf_counter() - start))
+
+    ## max rss+: largest RSS increase over the RSS before the evaluation, sampled after each batch
+    print('{:>8s} {:>10s} {:>10s} {:>9s} {:>13s} {:>7s} {:>9s}'.format(
+        'model', 'med ms', 'mean ms', 'size MB', 'max rss+ MB', 'qwk', 'agree'))
+    float_preds = None
+    for name, model in variants:
+        preds, med, avg, rss = evaluate(model, batches)
+        if float_preds is None:
+            float_preds = preds
+        qwk = cohen_kappa_score(preds, labels, weights='quadratic')
+        print('{:>8s} {:>10.1f} {:>10.1f} {:>9.1f} {:>13.1f} {:>7.4f} {:>9.3f}'.format(
+            name, med, avg, model_size_mb(model), rss, qwk, (preds == float_preds).mean()))
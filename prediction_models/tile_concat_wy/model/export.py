@@ -0,0 +1,110 @@
+"""
+Export a train.py checkpoint to TorchScript and ONNX for inference without fastai.
+The fastai/custom head modules (AdaptiveConcatPool2d, Flatten, Mish with its autograd Function) are swapped
+for plain torch ops before tracing, and the batch size and number of tiles N stay dynamic in both graphs.
+Load the exported files with infer.runtime.load_runtime.
+"""
+
+## system package
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+## general package
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+class ConcatPool(nn.Module):
+    """fastai AdaptiveConcatPool2d with output size 1: [max pool, avg pool] on channels"""
+    def forward(self, x):
+        return torch.cat([F.adaptive_max_pool2d(x, 1), F.adaptive_avg_pool2d(x, 1)], 1)
+
+class PlainMish(nn.Module):
+    def forward(self, x):
+        return x * torch.tanh(F.softplus(x))
+
+class ExportModel(nn.Module):
+    def __init__(self, model):
+        """
+        model: trained Model or Model_Infer, its encoder and head weights are shared, not copied
+        """
+        super().__init__()
+        self.enc = model.enc
+        self.head = nn.Sequential(*[self._plain(m) for m in model.head.children()])
+
+    @staticmethod
+    def _plain(m):
+        name = type(m).__name__
+        if name == 'AdaptiveConcatPool2d':
+            return ConcatPool()
+        if name == 'Flatten':
+            return nn.Flatten()
+        if name == 'Mish':
+            return PlainMish()
+        return m
+
+    def forward(self, x):
+        """
+        x: [bs, N, 3, h, w]
+        x_out: [bs, n]
+        """
+        bs, n, c, h, w = x.shape
+        x = x.reshape(-1, c, h, w)  # x: bs*N x 3 x 128 x 128
+        x = self.enc(x)  # x: bs*N x C x 4 x 4
+        _, c, h, w = x.shape
+        ## concatenate the output for tiles into a single map
+        x = x.reshape(bs, n, c, h, w).permute(0, 2, 1, 3, 4).reshape(bs, c, h * n, w)  # x: bs x C x N*4 x 4
+        return self.head(x)  # x: bs x n
+
+def export_torchscript(model, out_file, example):
+    traced = torch.jit.freeze(torch.jit.trace(model, example))
+    traced.save(out_file)
+    return out_file
+
+def export_onnx(model, out_file, example, opset = 13):
+    torch.onnx.export(model, example, out_file, input_names=['tiles'], output_names=['outputs'],
+                      dynamic_axes={'tiles': {0: 'bs', 1: 'N'}, 'outputs': {0: 'bs'}}, opset_version=opset,
+                      do_constant_folding=True)
+    return out_file
+
+def export(weights_file, out_prefix, arch = 'resnext50_32x4d', n = 1, N = 12, sz = 128, formats = ('torchscript', 'onnx'),
+           check = True):
+    """
+    Export weights_file (best weights or full checkpoint saved by train.py) to out_prefix.pt and/or out_prefix.onnx.
+    With check, the exported graphs are run with a batch size and N different from the tracing example
+    and compared to the eager model.
+    :return: list of exported files
+    """
+    from infer.predict import load_model
+    model = ExportModel(load_model(weights_file, arch, n)).eval()
+    example = torch.rand(2, N, 3, sz, sz)
+    files = []
+    with torch.no_grad():
+        if 'torchscript' in formats:
+            files.append(export_torchscript(model, out_prefix + '.pt', example))
+        if 'onnx' in formats:
+            files.append(export_onnx(model, out_prefix + '.onnx', example))
+        if check:
+            from infer.runtime import load_runtime
+            x = torch.rand(3, N + 4, 3, sz, sz)
+            expected = model(x)
+            for f in files:
+                diff = (load_runtime(f)(x) - expected).abs().max().item()
+                print('{}: max abs diff to eager {:.2e}'.format(f, diff))
+    return files
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a train.py checkpoint to TorchScript and ONNX')
+    parser.add_argument('--weights', default='./weights/Resnext50_reg/Resnext50_reg_0_best.pth.tar')
+    parser.add_argument('--out_prefix', default='./weights/Resnext50_reg/Resnext50_reg_0')
+    parser.add_argument('--arch', default='resnext50_32x4d')
+    parser.add_argument('--n', default=1, type=int, help='model outputs, 1 for regression')
+    parser.add_argument('--N', default=12, type=int, help='tiles per slide of the tracing example')
+    parser.add_argument('--sz', default=128, type=int, help='tile size')
+    parser.add_argument('--formats', default='torchscript,onnx')
+    parser.add_argument('--no_check', action='store_true')
+    args = parser.parse_args()
+    export(args.weights, args.out_prefix, args.arch, args.n, args.N, args.sz, args.formats.split(','),
+           not args.no_check)
@@ -0,0 +1,92 @@
+"""
+CPU inference variants of Model_Infer:
+    'fp32':    BatchNorm folded into the convolutions, channels_last memory format.
+    'dynamic': 'fp32' + int8 dynamic quantization of the Linear layers of the head.
+    'static':  'dynamic' + int8 static quantization of the encoder, calibrated on held-out tiles.
+"""
+
+import copy
+import torch
+import torch.nn as nn
+from torch.fx.experimental.optimization import fuse
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+class QuantizedModelInfer(nn.Module):
+    def __init__(self, enc, head, channels_last = True):
+        super().__init__()
+        self.enc = enc
+        self.head = head
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        """
+        x: [bs, N, 3, h, w]
+        x_out: [bs, n]
+        """
+        bs, n, c, h, w = x.shape
+        x = x.reshape(-1, c, h, w)  # x: bs*N x 3 x 128 x 128
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = self.enc(x)  # x: bs*N x C x 4 x 4
+        _, c, h, w = x.shape
+        ## concatenate the output for tiles into a single map
+        x = x.reshape(bs, n, c, h, w).permute(0, 2, 1, 3, 4).reshape(bs, c, h * n, w)  # x: bs x C x N*4 x 4
+        return self.head(x)  # x: bs x n
+
+def fold_head_bn(head):
+    """
+    Fold the BatchNorm1d of the head (Linear, Mish, BatchNorm1d, Dropout, Linear) into the last Linear,
+    valid in eval mode where Dropout is the identity.
+    """
+    head = copy.deepcopy(head)
+    layers = list(head.children())
+    for i, layer in enumerate(layers[:-1]):
+        if not isinstance(layer, nn.BatchNorm1d):
+            continue
+        following = [m for m in layers[i + 1:] if not isinstance(m, nn.Dropout)]
+        if not following or not isinstance(following[0], nn.Linear):
+            continue
+        linear = following[0]
+        scale = layer.weight / torch.sqrt(layer.running_var + layer.eps)
+        shift = layer.bias - layer.running_mean * scale
+        with torch.no_grad():
+            linear.bias.add_(linear.weight @ shift)
+            linear.weight.mul_(scale[None, :])
+        layers[i] = nn.Identity()
+    return nn.Sequential(*layers)
+
+def quantize_model(model, mode = 'dynamic', calib_batches = None, channels_last = True):
+    """
+    Build a CPU inference variant of a Model/Model_Infer.
+    :param model: float model, not modified
+    :param mode: 'fp32', 'dynamic' or 'static'
+    :param calib_batches: iterable of normalized (bs, N, 3, h, w) float tensors, required for 'static'
+    :param channels_last: run the encoder in channels_last memory format
+    :return: QuantizedModelInfer in eval mode
+    """
+    if mode not in ('fp32', 'dynamic', 'static'):
+        raise ValueError('Unknown mode {}, should be fp32, dynamic or static'.format(mode))
+    model = copy.deepcopy(model).cpu().eval()
+    ## fx fuse folds Conv2d + BatchNorm2d in eval mode
+    enc = fuse(model.enc)
+    head = fold_head_bn(model.head)
+    if mode == 'static':
+        if calib_batches is None:
+            raise ValueError('static quantization needs calib_batches')
+        engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else \
+            torch.backends.quantized.supported_engines[-1]
+        torch.backends.quantized.engine = engine
+        calib_batches = list(calib_batches)
+        example = calib_batches[0].reshape(-1, *calib_batches[0].shape[2:])
+        enc = prepare_fx(enc, get_default_qconfig_mapping(engine), example_inputs=(example, ))
+        with torch.no_grad():
+            for x in calib_batches:
+                x = x.reshape(-1, *x.shape[2:])
+                enc(x.contiguous(memory_format=torch.channels_last) if channels_last else x)
+        enc = convert_fx(enc)
+    if mode in ('dynamic', 'static'):
+        head = quantize_dynamic(head, {nn.Linear}, dtype=torch.qint8)
+    if channels_last:
+        enc = enc.to(memory_format=torch.channels_last)
+    return QuantizedModelInfer(enc, head, channels_last).eval()
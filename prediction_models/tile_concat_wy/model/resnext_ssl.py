@@ -1,23 +1,74 @@
 ## system package
-import os, sys
+import os, sys, contextlib
 os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"]="0"  # specify which GPU(s) to be used
 sys.path.append('../')
 import warnings
 warnings.filterwarnings("ignore")
 ## general package
+import numpy as np
 import torch
 import torch.nn as nn
-from fastai.vision import *
+from torch.utils.checkpoint import checkpoint
 ## custom package
+from utiles.layers import AdaptiveConcatPool2d, Flatten
 from utiles.mishactivation import *
-from utiles.hubconf import *
+from utiles.hubconf import build_backbone
+
+
+@contextlib.contextmanager
+def keep_bn_stats(module):
+    """restore the BatchNorm running statistics of module on exit (checkpoint recomputation updates them again)"""
+    state = [(m, m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone())
+             for m in module.modules()
+             if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, mean, var, n in state:
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(n)
+
+def encode(enc, x, chunk = None, segments = 4):
+    """
+    Apply the tile encoder to x (bs*N x 3 x h x w) with bounded activation memory, same results as enc(x).
+    chunk=None: enc(x).
+    Without grad: chunks of `chunk` tiles, no activation is kept.
+    With grad, eval mode: chunks of `chunk` tiles, each checkpointed.
+    With grad, train mode: BatchNorm needs the statistics of the whole batch, so the full batch goes through
+        `segments` checkpointed groups of enc layers, only the segment inputs are kept for backward.
+    """
+    if chunk is None:
+        return enc(x)
+    if not torch.is_grad_enabled():
+        return torch.cat([enc(c) for c in x.split(chunk)])
+    if not enc.training:
+        return torch.cat([checkpoint(enc, c, use_reentrant=False) for c in x.split(chunk)])
+    layers = list(enc.children())
+    bounds = np.linspace(0, len(layers), min(segments, len(layers)) + 1).round().astype(int)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        segment = nn.Sequential(*layers[start:end])
+        x = checkpoint(segment, x, use_reentrant=False,
+                       context_fn=lambda segment=segment: (contextlib.nullcontext(), keep_bn_stats(segment)))
+    return x
 
 
 class Model(nn.Module):
-    def __init__(self, arch='resnext50_32x4d_ssl', n=6, pre=True):
+    def __init__(self, arch='resnext50_32x4d_ssl', n=6, pre=True, enc_chunk=None, enc_segments=4, offline=None):
+        """
+        pre: pretrained backbone weights from the local weight registry (utiles.hubconf.build_backbone),
+            downloaded once, then memory-mapped; offline (default: env PANDA_OFFLINE) never downloads.
+        enc_chunk: activation checkpointing of the encoder (see encode), None for a single enc call on bs*N tiles.
+            Only eval mode encodes in chunks of enc_chunk tiles. In train mode BatchNorm needs the whole batch,
+            so the bs*N tiles go through enc_segments checkpointed segments: only the segment inputs are kept,
+            but the peak memory still grows with bs*N while a segment is recomputed.
+        """
         super().__init__()
-        m = torch.hub.load('facebookresearch/semi-supervised-ImageNet1K-models', arch)
+        self.enc_chunk = enc_chunk
+        self.enc_segments = enc_segments
+        m = build_backbone(arch, pretrained=pre, offline=offline)
         self.enc = nn.Sequential(*list(m.children())[:-2])
         nc = list(m.children())[-1].in_features
         self.head = nn.Sequential(AdaptiveConcatPool2d(), Flatten(), nn.Linear(2 * nc, 512),
@@ -30,7 +81,7 @@ class Model(nn.Module):
         """
         bs, n, c, h, w = x.shape
         x = x.view(-1, c, h, w)  # x: bs*N x 3 x 128 x 128
-        x = self.enc(x)  # x: bs*N x C x 4 x 4
+        x = encode(self.enc, x, self.enc_chunk, self.enc_segments)  # x: bs*N x C x 4 x 4
         _, c, h, w = x.shape
 
         ## concatenate the output for tiles into a single map
@@ -40,21 +91,17 @@ class Model(nn.Module):
         return x
 
 class Model_Infer(nn.Module):
-    def __init__(self, arch='resnext50_32x4d', n=6, pre=True):
+    def __init__(self, arch='resnext50_32x4d', n=6, pre=True, enc_chunk=None, enc_segments=4):
         super().__init__()
-        # m = torch.hub.load('facebookresearch/semi-supervised-ImageNet1K-models', arch)
-        m = self._resnext(semi_supervised_model_urls[arch], Bottleneck, [3, 4, 6, 3], False,
-                     progress=False, groups=32, width_per_group=4)
+        self.enc_chunk = enc_chunk
+        self.enc_segments = enc_segments
+        ## architecture only, the weights are loaded from a train.py checkpoint
+        m = build_backbone(arch, pretrained=False)
         self.enc = nn.Sequential(*list(m.children())[:-2])
         nc = list(m.children())[-1].in_features
         self.head = nn.Sequential(AdaptiveConcatPool2d(), Flatten(), nn.Linear(2 * nc, 512),
                                   Mish(), nn.BatchNorm1d(512), nn.Dropout(0.5), nn.Linear(512, n))
 
-    def _resnext(self, url, block, layers, pretrained, progress, **kwargs):
-        model = ResNet(block, layers, **kwargs)
-        #state_dict = load_state_dict_from_url(url, progress=progress)
-        #model.load_state_dict(state_dict)
-        return model
     def forward(self, x):
         """
         x: [bs, N, 3, h, w]
@@ -62,7 +109,7 @@ class Model_Infer(nn.Module):
         """
         bs, n, c, h, w = x.shape
         x = x.view(-1, c, h, w)  # x: bs*N x 3 x 128 x 128
-        x = self.enc(x)  # x: bs*N x C x 4 x 4
+        x = encode(self.enc, x, self.enc_chunk, self.enc_segments)  # x: bs*N x C x 4 x 4
         _, c, h, w = x.shape
 
         ## concatenate the output for tiles into a single map
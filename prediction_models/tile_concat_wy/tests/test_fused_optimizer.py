@@ -0,0 +1,64 @@
+"""
+FusedOver9000 (the training default) must follow Over9000: same parameters after every step, over several
+Lookahead periods, with parameters of different shapes and one without gradient.
+
+python -m pytest tests/test_fused_optimizer.py, or python tests/test_fused_optimizer.py
+"""
+
+## system package
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import warnings
+warnings.filterwarnings("ignore")
+## general package
+import torch
+## custom package
+from utiles.radam import Over9000, FusedOver9000
+
+## conv weight, batchnorm weight and bias, linear weight and bias
+SHAPES = [(64, 3, 7, 7), (64, ), (64, ), (6, 2048), (6, )]
+
+def make_params(seed = 0):
+    generator = torch.Generator().manual_seed(seed)
+    return [(torch.randn(shape, generator=generator) * 0.1).requires_grad_() for shape in SHAPES]
+
+def run_steps(opt, n_steps, frozen = None, seed = 1, **kwargs):
+    """
+    n_steps of opt on make_params() with the same random gradients, frozen: index of a parameter without gradient
+    return: parameters after each step
+    """
+    params = make_params()
+    optimizer = opt(params, lr=1e-3, weight_decay=1e-4, **kwargs)
+    generator = torch.Generator().manual_seed(seed)
+    history = []
+    for _ in range(n_steps):
+        for i, p in enumerate(params):
+            p.grad = None if i == frozen else torch.randn(p.shape, generator=generator) * 1e-2
+        optimizer.step()
+        history.append([p.detach().clone() for p in params])
+    return history
+
+def max_rel_diff(history_a, history_b):
+    return max(((a - b).norm() / a.norm().clamp_min(1e-12)).item()
+               for params_a, params_b in zip(history_a, history_b) for a, b in zip(params_a, params_b))
+
+def test_fused_over9000_matches_over9000():
+    ## 20 steps: 3 Lookahead periods (k=6) and the switch to the adaptive RAdam step (N_sma >= 5)
+    assert max_rel_diff(run_steps(Over9000, 20), run_steps(FusedOver9000, 20)) < 1e-5
+
+def test_fused_over9000_skips_params_without_grad():
+    reference, fused = run_steps(Over9000, 20, frozen=1), run_steps(FusedOver9000, 20, frozen=1)
+    assert max_rel_diff(reference, fused) < 1e-5
+    assert torch.equal(fused[-1][1], make_params()[1])
+
+def test_fused_over9000_bf16_state():
+    ## bf16 optimizer state only approximates Over9000, the update stays finite and close
+    history = run_steps(FusedOver9000, 20, state_dtype=torch.bfloat16)
+    assert all(torch.isfinite(p).all() for p in history[-1])
+    assert max_rel_diff(run_steps(Over9000, 20), history) < 1e-2
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('{}: ok'.format(name))
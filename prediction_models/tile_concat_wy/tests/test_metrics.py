@@ -0,0 +1,90 @@
+"""
+Kappa and threshold search used for model selection (train.py) and the ensemble thresholds (infer/fit_thresholds.py):
+the kappa must match a direct observed / expected computation, and the thresholds returned by search_thresholds
+must give back the returned kappa when applied to the scores.
+
+python -m pytest tests/test_metrics.py, or python tests/test_metrics.py
+"""
+
+## system package
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+## general package
+import numpy as np
+import pytest
+## custom package
+from utiles.metrics import confusion_matrix, quadratic_weighted_kappa, search_thresholds, StreamingKappa
+
+N_CLASSES = 6
+
+def direct_kappa(preds, labels, n = N_CLASSES):
+    """1 - observed / expected weighted disagreement, the expected one over all (prediction, label) pairs"""
+    weights = (np.arange(n)[:, None] - np.arange(n)[None, :]) ** 2 / (n - 1) ** 2
+    observed = weights[preds, labels].sum()
+    expected = weights[preds[:, None], labels[None, :]].sum() / len(labels)
+    return 1 - observed / expected
+
+def make_scores(n_samples = 500, seed = 0):
+    """noisy regression scores of isup grades, inside the StreamingKappa score range"""
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, N_CLASSES, n_samples)
+    scores = np.clip(0.8 * labels + 0.4 + rng.normal(0, 0.7, n_samples), -0.9, 5.9)
+    return scores, labels
+
+def score_histogram(scores, labels, edges):
+    bins = np.clip(np.searchsorted(edges, scores, side='right') - 1, 0, len(edges) - 2)
+    return np.bincount(bins * N_CLASSES + labels, minlength=(len(edges) - 1) * N_CLASSES).reshape(-1, N_CLASSES)
+
+def test_confusion_matrix():
+    conf = confusion_matrix([0, 1, 1, 5], [0, 2, 1, 5])
+    expected = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64)
+    expected[0, 0], expected[1, 2], expected[1, 1], expected[5, 5] = 1, 1, 1, 1
+    assert np.array_equal(conf, expected)
+
+def test_kappa_matches_direct_computation():
+    rng = np.random.RandomState(1)
+    labels = rng.randint(0, N_CLASSES, 300)
+    preds = np.clip(labels + rng.randint(-2, 3, 300), 0, N_CLASSES - 1)
+    ## also with classes missing from the predictions
+    for p in (preds, np.minimum(preds, 3)):
+        kappa = quadratic_weighted_kappa(confusion_matrix(p, labels))
+        assert kappa == pytest.approx(direct_kappa(p, labels), abs=1e-12)
+    assert quadratic_weighted_kappa(confusion_matrix(labels, labels)) == pytest.approx(1.0)
+
+def test_kappa_batch():
+    rng = np.random.RandomState(2)
+    labels = rng.randint(0, N_CLASSES, 200)
+    confs = np.stack([confusion_matrix(rng.randint(0, N_CLASSES, 200), labels) for _ in range(4)])
+    assert np.allclose(quadratic_weighted_kappa(confs), [quadratic_weighted_kappa(c) for c in confs])
+
+def test_search_thresholds_reproduce_kappa():
+    scores, labels = make_scores()
+    edges = np.linspace(-1.0, 6.0, 701)
+    thresholds, kappa = search_thresholds(score_histogram(scores, labels, edges), edges)
+    assert len(thresholds) == N_CLASSES - 1 and np.all(np.diff(thresholds) >= 0)
+    preds = np.searchsorted(thresholds, scores, side='right')
+    assert kappa == pytest.approx(direct_kappa(preds, labels), abs=1e-12)
+    ## the search starts from the rounding thresholds and only keeps improvements
+    rounded = np.clip(np.round(scores), 0, N_CLASSES - 1).astype(int)
+    assert kappa >= direct_kappa(rounded, labels) - 1e-3
+
+def test_streaming_kappa():
+    torch = pytest.importorskip('torch')
+    scores, labels = make_scores(seed=3)
+    val_kappa = StreamingKappa()
+    for s, l in zip(np.array_split(scores, 7), np.array_split(labels, 7)):
+        val_kappa.update(torch.from_numpy(s).float(), torch.from_numpy(l))
+    rounded = np.clip(np.round(scores.astype(np.float32)), 0, N_CLASSES - 1).astype(int)
+    assert val_kappa.kappa() == pytest.approx(direct_kappa(rounded, labels), abs=1e-12)
+    thresholds, kappa = val_kappa.optimize_thresholds()
+    preds = np.searchsorted(thresholds, scores.astype(np.float32), side='right')
+    assert kappa == pytest.approx(direct_kappa(preds, labels), abs=1e-12)
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            try:
+                test()
+                print('{}: ok'.format(name))
+            except pytest.skip.Exception as e:
+                print('{}: skipped, {}'.format(name, e))
@@ -0,0 +1,73 @@
+"""
+Step time of FusedOver9000 (multi-tensor Ralamb + Lookahead) against Over9000 on the ResNeXt-50 parameters.
+Both optimizers see the same gradients for many steps (several Lookahead periods) and the largest parameter
+difference is reported; the parity check itself is tests/test_fused_optimizer.py.
+"""
+
+## system package
+import os, sys, time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+## general package
+import torch
+import torchvision
+## custom package
+from utiles.radam import Over9000, FusedOver9000
+
+def make_grads(params, n_steps, seed = 0):
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(n_steps):
+        yield [torch.randn(p.shape, generator=generator) * 1e-2 for p in params]
+
+def run(optimizer, params, grads):
+    for p, g in zip(params, grads):
+        p.grad = g
+    start = time.perf_counter()
+    optimizer.step()
+    return time.perf_counter() - start
+
+def max_diff(params_a, params_b):
+    abs_diff = max((a - b).abs().max().item() for a, b in zip(params_a, params_b))
+    rel_diff = max(((a - b).norm() / a.norm().clamp_min(1e-12)).item() for a, b in zip(params_a, params_b))
+    return abs_diff, rel_diff
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare FusedOver9000 to Over9000')
+    parser.add_argument('--steps', default=60, type=int)
+    parser.add_argument('--lr', default=1e-3, type=float)
+    parser.add_argument('--weight_decay', default=1e-4, type=float)
+    parser.add_argument('--num_threads', default=None, type=int)
+    args = parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    model = torchvision.models.resnext50_32x4d()
+    print('{} parameter tensors, {:.1f}M parameters'.format(len(list(model.parameters())),
+                                                          sum(p.numel() for p in model.parameters()) / 1e6))
+    variants = [('Over9000', Over9000, {}), ('FusedOver9000', FusedOver9000, {}),
+                ('FusedOver9000 bf16', FusedOver9000, {'state_dtype': torch.bfloat16})]
+    params = {}
+    optimizers = {}
+    for name, opt, kwargs in variants:
+        params[name] = [p.detach().clone().requires_grad_() for p in model.parameters()]
+        optimizers[name] = opt(params[name], lr=args.lr, weight_decay=args.weight_decay, **kwargs)
+
+    times = {name: [] for name, _, _ in variants}
+    worst = {name: (0.0, 0.0) for name, _, _ in variants[1:]}
+    for grads in make_grads(params['Over9000'], args.steps):
+        for name, _, _ in variants:
+            times[name].append(run(optimizers[name], params[name], [g.clone() for g in grads]))
+        for name, _, _ in variants[1:]:
+            abs_diff, rel_diff = max_diff(params['Over9000'], params[name])
+            worst[name] = (max(worst[name][0], abs_diff), max(worst[name][1], rel_diff))
+
+    ## the first steps include the state allocation
+    skip = min(5, args.steps - 1)
+    reference = sum(times['Over9000'][skip:]) / (args.steps - skip)
+    print('{:>20s} {:>10s} {:>8s} {:>12s} {:>12s}'.format('optimizer', 'ms/step', 'speedup', 'max abs diff',
+                                                            'max rel diff'))
+    for name, _, _ in variants:
+        step_time = sum(times[name][skip:]) / (args.steps - skip)
+        abs_diff, rel_diff = worst.get(name, (0.0, 0.0))
+        print('{:>20s} {:>10.1f} {:>8.2f} {:>12.2e} {:>12.2e}'.format(name, step_time * 1000, reference / step_time,
+                                                                       abs_diff, rel_diff))
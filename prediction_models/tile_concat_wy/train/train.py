@@ -1,5 +1,6 @@
 ## system package
-import os, sys, shutil
+import os, sys, shutil, time
+import multiprocessing, multiprocessing.connection
 sys.path.append('../')
 from pathlib import Path
 from datetime import datetime
@@ -8,134 +9,306 @@ import warnings
 warnings.filterwarnings("ignore")
 
 ## general package
-from fastai.vision import *
-from torch.utils.tensorboard import SummaryWriter
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.optim as optim
 from tqdm import trange, tqdm
-from sklearn.metrics import cohen_kappa_score
 ## custom package
 from input.inputPipeline import *
+from input.batch_augment import BatchAugment
 from model.resnext_ssl import *
 from utiles.radam import *
 from utiles.utils import *
+from utiles.image_stats import get_stats, FolderSource
+from utiles.checkpoint import CheckpointManager
+from utiles.hubconf import fetch_weights
+from utiles.profiling import StageTimer, step_profiler, rss_mb
+from utiles.csvlogger import StatsCSVLogger
+from utiles.metrics import StreamingKappa, confusion_matrix, quadratic_weighted_kappa
 
 class Train(object):
-    def __init__(self, model, optimizer, scheduler):
+    def __init__(self, model, optimizer, scheduler, train_transform = None, val_transform = None,
+                 profile_steps = None, profile_dir = './runs/profile', sync_timers = False, device = 'cuda'):
+        """
+        train_transform, val_transform: optional batch transforms (input.batch_augment.BatchAugment)
+        applied to the collated uint8 inputs on the device.
+        profile_steps: optional (start, steps) window of training iterations traced with torch.profiler
+        in the first epoch, written to profile_dir.
+        sync_timers: synchronize cuda at each stage boundary for exact stage times (slower).
+        device: device of the model, 'cuda' or 'cpu'.
+        The throughput and stage timings of the last epoch are in self.last_epoch_stats, the regression thresholds
+        optimized on its validation set in self.last_thresholds and the validation outputs (in valloader order)
+        in self.last_val_outputs.
+        """
         self.model = model
         self.optimizer = optimizer
         self.scheduler = scheduler
+        self.train_transform = train_transform
+        self.val_transform = val_transform
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.device = device
+        self.sync = torch.cuda.synchronize if sync_timers and device != 'cpu' else None
+        self.last_epoch_stats = {}
+        self.last_thresholds = None
+        self.last_val_outputs = None
     def train_epoch(self,trainloader, valloader, criterion):
         ## train
         self.model.train()
         train_loss = []
+        timer = StageTimer(self.sync)
+        profiler = None
+        if self.profile_steps:
+            profiler = step_profiler(self.profile_dir, *self.profile_steps)
+            profiler.start()
+            self.profile_steps = None
+        timer.start()
         for i, data in enumerate(tqdm(trainloader, desc='trainIter'), start=0):
             # if i >= 50:
             #     break
+            timer.lap('data')
             # get the inputs; data is a list of [inputs, labels]
             inputs, labels = data
+            inputs = inputs.to(self.device)
+            if self.train_transform:
+                inputs = self.train_transform(inputs)
+            timer.lap('transform')
             # zero the parameter gradients
             self.optimizer.zero_grad()
             # forward + backward + optimize
-            outputs = model(inputs.cuda())
+            outputs = self.model(inputs)
             outputs = outputs.squeeze(dim = 1) # for regression
-            loss = criterion(outputs, labels.float().cuda())
+            loss = criterion(outputs, labels.float().to(self.device))
             train_loss.append(loss.item())
+            timer.lap('forward')
             loss.backward()
+            timer.lap('backward')
             self.optimizer.step()
+            timer.lap('step')
+            timer.step(len(labels))
+            if profiler is not None:
+                profiler.step()
+        if profiler is not None:
+            profiler.stop()
+        stats = timer.stats('train_')
+        val_start = time.perf_counter()
         ## val
-        model.eval()
-        val_loss, val_label, val_preds = [], [], []
+        self.model.eval()
+        val_loss, val_outputs, n_val = [], [], 0
+        ## confusion matrix and score histogram updated batch by batch
+        val_kappa = StreamingKappa()
         with torch.no_grad():
             for i, data in enumerate(tqdm(valloader, desc='valIter'), start=0):
                 #                 if i > 50:
                 #                     break
                 # get the inputs; data is a list of [inputs, labels]
                 inputs, labels = data
-                # zero the parameter gradients
-                optimizer.zero_grad()
-                # forward + backward + optimize
-                outputs = model(inputs.cuda())
+                inputs = inputs.to(self.device)
+                if self.val_transform:
+                    inputs = self.val_transform(inputs)
+                outputs = self.model(inputs)
                 outputs = outputs.squeeze(dim=1)  # for regression
-                loss = criterion(outputs, labels.float().cuda())
+                loss = criterion(outputs, labels.float().to(self.device))
                 val_loss.append(loss.item())
-                val_label.append(labels.cpu())
-                val_preds.append(outputs.cpu())
-        # val_preds = torch.argmax(torch.cat(val_preds, 0), 1) # for classification
-        val_label = torch.cat(val_label)
-        val_preds = torch.cat(val_preds, 0).round()
-        kappa = cohen_kappa_score(val_label, val_preds, weights='quadratic')
+                val_kappa.update(outputs, labels)
+                val_outputs.append(outputs.float().cpu())
+                n_val += len(labels)
+        ## regression outputs rounded and clipped to the isup grades
+        kappa = val_kappa.kappa()
+        thresholds, stats['val_kappa_thresholds'] = val_kappa.optimize_thresholds()
+        self.last_thresholds = thresholds
+        self.last_val_outputs = torch.cat(val_outputs).numpy() if val_outputs else np.zeros(0)
+        stats['val_s'] = time.perf_counter() - val_start
+        stats['val_samples_per_s'] = n_val / max(stats['val_s'], 1e-9)
+        stats['rss_mb'] = rss_mb()
+        self.last_epoch_stats = stats
         self.scheduler.step()
         return np.mean(train_loss), np.mean(val_loss), kappa
 
 
-def save_checkpoint(state, is_best, fname):
-    torch.save(state, '{}_ckpt.pth.tar'.format(fname))
-    if is_best:
-        # shutil.copyfile('{}_ckpt.pth.tar'.format(fname), '{}_best.pth.tar'.format(fname))
-        state = state['state_dict']
-        torch.save(state, '{}_best.pth.tar'.format(fname)) ## only save weights for best model
+def fold_path(cfg, fold):
+    return os.path.join(cfg['weights_dir'], '{}_{}'.format(cfg['fname'], fold))
 
-if __name__ == "__main__":
-    fname = "Resnext50_reg_30"
-    nfolds = 4
-    bs = 32
-    epochs = 30
-    csv_file = '../input/panda-16x128x128-tiles-data/{}_fold_train.csv'.format(nfolds)
-    image_dir = '../input/panda-16x128x128-tiles-data/train/'
-    ## image statistics
-    mean = torch.tensor([0.90949707, 0.8188697, 0.87795304])
-    std = torch.tensor([0.36357649, 0.49984502, 0.40477625])
-    # mean = torch.tensor([0.5, 0.5, 0.5])
-    # std = torch.tensor([0.5, 0.5, 0.5])
-    ## image transformation
-    tsfm = data_transform(mean, std)
+def build_dataset(cfg, tsfm):
+    """read-only memory-mapped tile store shared by all fold processes if available, png tiles otherwise"""
+    if cfg['tiles_file'] and os.path.exists(cfg['tiles_file']):
+        return PandaPatchMemmapDataset(cfg['csv_file'], cfg['tiles_file'], transform=tsfm, N = cfg['N'])
+    ## decoded tiles cached across epochs and folds, e.g. on /dev/shm, None to decode the pngs every time
+    cache = DecodedTileCache(cfg['cache_dir'], cfg['cache_bytes']) if cfg['cache_dir'] else None
+    return PandaPatchDataset(cfg['csv_file'], cfg['image_dir'], transform=tsfm, N = cfg['N'], cache = cache)
+
+def train_fold(fold, cfg):
+    """
+    Train one fold with its own TensorBoard folder, epoch stats and checkpoints.
+    :param cfg: dict of the run settings (see __main__), picklable to run folds in separate processes
+    :return: csv file with the out-of-fold predictions of the best epoch
+    """
+    if cfg['num_threads']:
+        torch.set_num_threads(cfg['num_threads'])
+    device = cfg['device']
+    mean, std = torch.tensor(cfg['mean']), torch.tensor(cfg['std'])
+    ## image transformation: augment the collated uint8 batches (batch_aug) or each PIL tile in the workers
+    if cfg['batch_aug']:
+        tsfm = None
+        train_transform = BatchAugment(mean, std)
+    else:
+        tsfm = data_transform(mean, std)
+        train_transform = None
+    ## validation tiles are uint8 and never augmented, only normalized
+    val_transform = BatchAugment(mean, std, augment=False)
     ## dataset, can fetch data by dataset[idx]
-    dataset = PandaPatchDataset(csv_file, image_dir, transform=tsfm, N = 12)
-    ## dataloader
-    crossValData = crossValDataloader(csv_file, dataset, bs)
+    dataset = build_dataset(cfg, tsfm)
+    crossValData = crossValDataloader(cfg['csv_file'], dataset, cfg['bs'], num_workers = cfg['num_workers'])
 
     # criterion = nn.CrossEntropyLoss()
     criterion = nn.MSELoss()
 
-    ## tensorboard writer
+    ## tensorboard writer and per epoch throughput and stage timings of the fold
+    ## imported here: tensorboard is slow to import and only the fold processes need it
+    from torch.utils.tensorboard import SummaryWriter
+    writer = SummaryWriter(os.path.join(cfg['run_dir'], 'fold{}'.format(fold)))
+    statsLogger = StatsCSVLogger(os.path.join(cfg['run_dir'], 'fold{}_epoch_stats.csv'.format(fold)))
+    fold_start = time.perf_counter()
+    trainloader, valloader = crossValData(fold)
+    ## unset options keep the Model defaults
+    enc_options = {k: cfg[k] for k in ('enc_chunk', 'enc_segments') if cfg[k] is not None}
+    model = Model(cfg['arch'], n = 1, offline = cfg['offline'], **enc_options).to(device)
+    # optimizer = optim.Adam(model.parameters(), lr=1e-3, weight_decay=0)
+    # scheduler = optim.lr_scheduler.StepLR(optimizer, 1, 1)
+    optimizer = FusedOver9000(model.parameters())
+    scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr = 1e-3, total_steps = cfg['epochs'],
+                                              pct_start = 0.3, div_factor = 100)
+    Training = Train(model, optimizer, scheduler, train_transform, val_transform,
+                     profile_steps = cfg['profile_steps'] if fold == 0 else None,
+                     profile_dir = os.path.join(cfg['run_dir'], 'profile'), device = device)
+    best_kappa, best_outputs = 0, None
+    weightsPath = fold_path(cfg, fold)
+    ## checkpoints are written in the background, the last 2 epochs and the best weights are kept
+    checkpoints = CheckpointManager(weightsPath, keep_last = 2)
+    for epoch in trange(cfg['epochs'], desc='fold {} epoch'.format(fold)):
+        train_loss, val_loss, kappa = Training.train_epoch(trainloader,valloader,criterion)
+        tqdm.write("Fold {}, epoch {}, train loss: {:.4f}, val loss: {:.4f}, kappa-score: {:.4f}.\n".format(
+            fold, epoch, train_loss, val_loss, kappa))
+        writer.add_scalar('Fold:{}/train_loss'.format(fold), train_loss, epoch)
+        writer.add_scalar('Fold:{}/val_loss'.format(fold), val_loss, epoch)
+        writer.add_scalar('Fold:{}/kappa_score'.format(fold), kappa, epoch)
+        for name, value in Training.last_epoch_stats.items():
+            writer.add_scalar('Fold:{}/perf/{}'.format(fold, name), value, epoch)
+        writer.flush()
+        statsLogger.write_stats(dict(fold = fold, epoch = epoch, **Training.last_epoch_stats))
+        ## save the checkpoints and best model
+        is_best = kappa > best_kappa
+        checkpoints.save({
+            'epoch': epoch,
+            'state_dict': model.state_dict(),
+            'kappa': kappa,
+            'thresholds': Training.last_thresholds,
+            'optimizer': optimizer.state_dict(),
+        }, epoch, is_best)
+        if is_best or best_outputs is None:
+            best_outputs = Training.last_val_outputs
+        best_kappa = kappa if is_best else best_kappa
+    checkpoints.close()
+    fold_time = time.perf_counter() - fold_start
+    writer.add_scalar('Fold:{}/perf/fold_s'.format(fold), fold_time, fold)
+    tqdm.write("Fold {}: {:.0f}s.".format(fold, fold_time))
+    writer.close()
+    statsLogger.close()
+    ## out-of-fold predictions of the best epoch, the validation batches follow val_idx
+    _, val_idx = crossValInx(cfg['csv_file'])(fold)
+    oof = dataset.train_csv.loc[val_idx, ['image_id', 'isup_grade']].reset_index(drop = True)
+    oof['fold'] = fold
+    oof['pred'] = best_outputs
+    oof_file = '{}_oof.csv'.format(weightsPath)
+    oof.to_csv(oof_file, index = False)
+    return oof_file
+
+def run_folds(cfg, folds, parallel = 1):
+    """
+    Train folds, up to `parallel` at the same time in separate (spawned) processes, and merge their out-of-fold
+    predictions into {weights_dir}/{fname}_oof.csv.
+    """
+    if parallel <= 1:
+        oof_files = [train_fold(fold, cfg) for fold in folds]
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        pending, running = list(folds), {}
+        while pending or running:
+            while pending and len(running) < parallel:
+                fold = pending.pop(0)
+                running[fold] = ctx.Process(target = train_fold, args = (fold, cfg), name = 'fold{}'.format(fold))
+                running[fold].start()
+            multiprocessing.connection.wait([p.sentinel for p in running.values()])
+            for fold, p in list(running.items()):
+                if p.exitcode is None:
+                    continue
+                del running[fold]
+                if p.exitcode != 0:
+                    for other in running.values():
+                        other.terminate()
+                    raise RuntimeError('fold {} failed with exit code {}'.format(fold, p.exitcode))
+        oof_files = ['{}_oof.csv'.format(fold_path(cfg, fold)) for fold in folds]
+    oof = pd.concat([pd.read_csv(f) for f in oof_files], ignore_index = True)
+    oof_file = os.path.join(cfg['weights_dir'], '{}_oof.csv'.format(cfg['fname']))
+    oof.to_csv(oof_file, index = False)
+    preds = np.clip(np.round(oof['pred'].to_numpy()), 0, 5).astype(int)
+    kappa = quadratic_weighted_kappa(confusion_matrix(preds, oof['isup_grade'].to_numpy()))
+    tqdm.write("Out-of-fold kappa-score: {:.4f}, predictions in {}.".format(kappa, oof_file))
+    return oof_file
+
+if __name__ == "__main__":
+    fname = "Resnext50_reg_30"
+    nfolds = 4
+    csv_file = '../input/panda-16x128x128-tiles-data/{}_fold_train.csv'.format(nfolds)
+    image_dir = '../input/panda-16x128x128-tiles-data/train/'
+    stats_file = '../input/panda-16x128x128-tiles-data/stats.json'
+    ## image statistics, computed from the tiles on the first run
+    mean, std = get_stats(stats_file, FolderSource(image_dir))
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ## folds trained at the same time, each with its share of the cpu cores
+    parallel_folds = 1 if device == 'cuda' else nfolds
+    batch_aug = True
+    ## dataloader, fewer workers are needed when they only decode
+    num_workers = 2 if batch_aug else 4
+    cfg = dict(
+        fname = fname,
+        ## backbone from the local weight registry (utiles/hubconf.py), offline: never download
+        arch = 'resnext50_32x4d_ssl',
+        offline = None,
+        bs = 32,
+        epochs = 30,
+        N = 12,
+        ## activation checkpointing of the encoder for large N (model/resnext_ssl.py encode), None: disabled
+        enc_chunk = None,
+        ## checkpointed encoder segments in train mode when enc_chunk is set, None: Model default (4)
+        enc_segments = None,
+        csv_file = csv_file,
+        image_dir = image_dir,
+        ## memory-mapped tile store (input/tile_extraction.py out_format='npy'), used instead of the pngs if it exists
+        tiles_file = '../input/panda-16x128x128-tiles-data/train.npy',
+        cache_dir = None,
+        cache_bytes = 16 * 2 ** 30,
+        mean = mean,
+        std = std,
+        batch_aug = batch_aug,
+        num_workers = num_workers,
+        num_threads = max(1, (os.cpu_count() or 1) // parallel_folds - num_workers) if parallel_folds > 1 else None,
+        device = device,
+        ## optional torch.profiler trace of training iterations [start, start + steps) in the first epoch of fold 0
+        profile_steps = None, # e.g. (10, 5)
+    )
+    ## tensorboard logs, one folder per fold
     writerDir = './runs'
     check_folder_exists(writerDir)
     timeStamp = datetime.now(timezone('US/Pacific')).strftime("%m_%d_%H_%M_%S")
-    writer = SummaryWriter('{}/{}_{}'.format(writerDir,fname,timeStamp))
+    cfg['run_dir'] = '{}/{}_{}'.format(writerDir, fname, timeStamp)
     ## weight saving
-    weightsDir = './weights/{}'.format(fname)
-    check_folder_exists(weightsDir)
-    for fold in trange(nfolds, desc='fold'):
-        trainloader, valloader = crossValData(fold)
-        model = Model(n = 1).cuda()
-        # optimizer = optim.Adam(model.parameters(), lr=1e-3, weight_decay=0)
-        # scheduler = optim.lr_scheduler.StepLR(optimizer, 1, 1)
-        optimizer = Over9000(model.parameters())
-        scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr = 1e-3, total_steps = epochs,
-                                                  pct_start = 0.3, div_factor = 100)
-        Training = Train(model, optimizer, scheduler)
-        best_kappa = 0
-        weightsPath = os.path.join(weightsDir, '{}_{}'.format(fname, fold))
-        for epoch in trange(epochs, desc='epoch'):
-            train_loss, val_loss, kappa = Training.train_epoch(trainloader,valloader,criterion)
-            tqdm.write("Epoch {}, train loss: {:.4f}, val loss: {:.4f}, kappa-score: {:.4f}.\n".format(epoch,
-                                                                                               train_loss,
-                                                                                               val_loss,
-                                                                                               kappa))
-            writer.add_scalar('Fold:{}/train_loss'.format(fold), train_loss, epoch)
-            writer.add_scalar('Fold:{}/val_loss'.format(fold), val_loss, epoch)
-            writer.add_scalar('Fold:{}/kappa_score'.format(fold), kappa, epoch)
-            writer.flush()
-            ## save the checkpoints and best model
-            is_best = kappa > best_kappa
-            save_checkpoint({
-                'epoch': epoch,
-                'state_dict': model.state_dict(),
-                'kappa': kappa,
-                'optimizer': optimizer.state_dict(),
-            }, is_best, weightsPath)
-            best_kappa = kappa if is_best else best_kappa
-        del model
-        del optimizer
-        del Training
-        del scheduler
-    writer.close()
\ No newline at end of file
+    cfg['weights_dir'] = './weights/{}'.format(fname)
+    check_folder_exists(cfg['weights_dir'])
+    ## fetch the backbone weights once, the fold processes then only memory-map them
+    fetch_weights(cfg['arch'], offline = cfg['offline'])
+    start_time = time.perf_counter()
+    run_folds(cfg, range(nfolds), parallel_folds)
+    tqdm.write("{} folds: {:.0f}s.".format(nfolds, time.perf_counter() - start_time))
@@ -0,0 +1,105 @@
+import os, re, glob
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+def snapshot(obj):
+    """copy of a (nested) state with every tensor detached and copied to CPU memory"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+def atomic_save(obj, fname):
+    """
+    torch.save to a temporary file in the same folder, then rename: readers never see a partial file.
+    The zipfile format can be reloaded with torch.load(mmap=True).
+    """
+    tmp = '{}.tmp{}'.format(fname, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            torch.save(obj, f, _use_new_zipfile_serialization=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def load_checkpoint(fname, map_location = 'cpu', mmap = True):
+    """
+    torch.load with memory-mapped tensors when supported (torch >= 2.1 and zipfile checkpoints):
+    tensors are paged in from the file when used instead of being read upfront.
+    """
+    if mmap:
+        try:
+            return torch.load(fname, map_location=map_location, mmap=True)
+        except (TypeError, RuntimeError):
+            ## old torch or legacy (non zipfile) checkpoint
+            pass
+    return torch.load(fname, map_location=map_location)
+
+class CheckpointManager(object):
+    """
+    Save training checkpoints without stalling the epoch loop.
+    save() copies the state to CPU memory and a background thread writes it to {path}_ep{epoch}_ckpt.pth.tar;
+    only the last keep_last checkpoints are kept. The weights of the best epoch go to {path}_best.pth.tar.
+    At most one snapshot waits to be written: save() waits for the previous write to finish.
+    """
+    def __init__(self, path, keep_last = 2):
+        """
+        Args:
+            path (string): prefix of the checkpoint files, e.g. ./weights/Resnext50_reg/Resnext50_reg_0
+            keep_last (int): number of epoch checkpoints kept on disk, 0 to only save the best weights.
+        """
+        self.path = path
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def ckpt_file(self, epoch):
+        return '{}_ep{}_ckpt.pth.tar'.format(self.path, epoch)
+
+    @property
+    def best_file(self):
+        return '{}_best.pth.tar'.format(self.path)
+
+    def save(self, state, epoch, is_best):
+        """
+        Args:
+            state (dict): checkpoint with the model weights in 'state_dict'.
+            epoch (int): epoch of the checkpoint.
+            is_best (bool): also save state['state_dict'] as the best weights.
+        """
+        self.wait()
+        state = snapshot(state)
+        self.pending = self.executor.submit(self._write, state, epoch, is_best)
+
+    def _write(self, state, epoch, is_best):
+        if self.keep_last > 0:
+            atomic_save(state, self.ckpt_file(epoch))
+            self._prune()
+        if is_best:
+            atomic_save(state['state_dict'], self.best_file) ## only save weights for best model
+
+    def _prune(self):
+        pattern = re.compile(re.escape(self.path) + r'_ep(\d+)_ckpt\.pth\.tar$')
+        ckpts = []
+        for fname in glob.glob(glob.escape(self.path) + '_ep*_ckpt.pth.tar'):
+            match = pattern.match(fname)
+            if match:
+                ckpts.append((int(match.group(1)), fname))
+        for _, fname in sorted(ckpts)[:-self.keep_last]:
+            os.remove(fname)
+
+    def wait(self):
+        """block until the last checkpoint is written, raise its error if the write failed"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -1,36 +1,78 @@
-import fastai
-from fastai.vision import *
-from fastai.callbacks import *
-
-#@dataclass
-class CSVLogger(LearnerCallback):
-    def __init__(self, learn, filename= 'history'):
-        self.learn = learn
-        self.path = self.learn.path/f'{filename}.csv'
-        self.file = None
+from pathlib import Path
+
+def _fastai_csv_logger():
+    """the fastai Learner callback, defined on first use so that importing this module does not import fastai"""
+    from fastai.vision import pd, Tensor, Any, StrList, MetricsList, TensorOrNumList
+    from fastai.callbacks import LearnerCallback
+
+    #@dataclass
+    class CSVLogger(LearnerCallback):
+        def __init__(self, learn, filename= 'history'):
+            self.learn = learn
+            self.path = self.learn.path/f'{filename}.csv'
+            self.file = None
+
+        @property
+        def header(self):
+            return self.learn.recorder.names
+
+        def read_logged_file(self):
+            return pd.read_csv(self.path)
+
+        def on_train_begin(self, metrics_names: StrList, **kwargs: Any) -> None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            e = self.path.exists()
+            self.file = self.path.open('a')
+            if not e: self.file.write(','.join(self.header) + '\n')
 
-    @property
-    def header(self):
-        return self.learn.recorder.names
+        def on_epoch_end(self, epoch: int, smooth_loss: Tensor, last_metrics: MetricsList, **kwargs: Any) -> bool:
+            self.write_stats([epoch, smooth_loss] + last_metrics)
 
-    def read_logged_file(self):
-        return pd.read_csv(self.path)
+        def on_train_end(self, **kwargs: Any) -> None:
+            self.file.flush()
+            self.file.close()
 
-    def on_train_begin(self, metrics_names: StrList, **kwargs: Any) -> None:
+        def write_stats(self, stats: TensorOrNumList) -> None:
+            stats = [str(stat) if isinstance(stat, int) else f'{stat:.6f}'
+                     for name, stat in zip(self.header, stats)]
+            str_stats = ','.join(stats)
+            self.file.write(str_stats + '\n')
+
+    return CSVLogger
+
+def __getattr__(name):
+    if name == 'CSVLogger':
+        globals()[name] = _fastai_csv_logger()
+        return globals()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+class StatsCSVLogger(object):
+    """Append rows of named scalars (e.g. Train.last_epoch_stats) to a csv file, without a fastai Learner"""
+    def __init__(self, filename):
+        self.path = Path(filename)
+        self.file = None
+        self.header = None
+
+    def open(self, names):
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        e = self.path.exists()
+        e = self.path.exists() and self.path.stat().st_size > 0
+        if e:
+            with self.path.open() as f:
+                self.header = f.readline().strip().split(',')
+        else:
+            self.header = list(names)
         self.file = self.path.open('a')
         if not e: self.file.write(','.join(self.header) + '\n')
 
-    def on_epoch_end(self, epoch: int, smooth_loss: Tensor, last_metrics: MetricsList, **kwargs: Any) -> bool:
-        self.write_stats([epoch, smooth_loss] + last_metrics)
-
-    def on_train_end(self, **kwargs: Any) -> None:
+    def write_stats(self, stats: dict) -> None:
+        if self.file is None:
+            self.open(stats.keys())
+        stats = ['' if name not in stats else str(stats[name]) if isinstance(stats[name], int)
+                 else f'{stats[name]:.6f}' for name in self.header]
+        self.file.write(','.join(stats) + '\n')
         self.file.flush()
-        self.file.close()
 
-    def write_stats(self, stats: TensorOrNumList) -> None:
-        stats = [str(stat) if isinstance(stat, int) else f'{stat:.6f}'
-                 for name, stat in zip(self.header, stats)]
-        str_stats = ','.join(stats)
-        self.file.write(str_stats + '\n')
\ No newline at end of file
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -7,7 +7,9 @@
 # Optional list of dependencies required by the package
 dependencies = ['torch', 'torchvision']
 
-from torch.hub import load_state_dict_from_url
+import os, json, hashlib
+import torch
+from torch.hub import load_state_dict_from_url, download_url_to_file
 from torchvision.models.resnet import ResNet, Bottleneck
 import torchvision.models as models
 
@@ -179,3 +181,139 @@ def resnext101_32x16d_swsl(progress=True, **kwargs):
     kwargs['groups'] = 32
     kwargs['width_per_group'] = 16
     return _resnext(semi_weakly_supervised_model_urls['resnext101_32x16d'], Bottleneck, [3, 4, 23, 3], True, progress, **kwargs)
+
+
+# -------------- local weight registry ----------------
+# Backbone weights are fetched once into WEIGHTS_DIR (env PANDA_WEIGHTS_DIR, default ~/.cache/panda/weights),
+# converted to the zipfile format (memory-mappable) and recorded with their sha256 in a {file}.json marker.
+# build_backbone then constructs the network without initializing it and assigns the memory-mapped weights:
+# no network access, no hub repo resolution and no random init on every construction.
+# PANDA_OFFLINE=1 (or offline=True) never downloads and fails if the weights are not in the registry.
+
+WEIGHTS_DIR = os.environ.get('PANDA_WEIGHTS_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'panda', 'weights'))
+
+_depths = {'resnet18': [2, 2, 2, 2], 'resnet50': [3, 4, 6, 3], 'resnext50_32x4d': [3, 4, 6, 3],
+           'resnext101_32x4d': [3, 4, 23, 3], 'resnext101_32x8d': [3, 4, 23, 3], 'resnext101_32x16d': [3, 4, 23, 3]}
+
+
+def _parse_arch(arch):
+    """'resnext50_32x4d_ssl' / 'resnext50_32x4d_swsl' / 'resnext50_32x4d' (ssl) -> (name, url)"""
+    if arch.endswith('_swsl'):
+        name, urls = arch[:-len('_swsl')], semi_weakly_supervised_model_urls
+    else:
+        name, urls = arch[:-len('_ssl')] if arch.endswith('_ssl') else arch, semi_supervised_model_urls
+    if name not in urls:
+        raise ValueError('unknown backbone {}, available: {}'.format(arch, ', '.join(sorted(urls))))
+    return name, urls[name]
+
+
+def _architecture(name):
+    if name.startswith('resnext'):
+        width = int(name.split('x')[-1][:-1])
+        return ResNet(Bottleneck, _depths[name], groups=32, width_per_group=width)
+    return ResNet(models.resnet.BasicBlock if name == 'resnet18' else Bottleneck, _depths[name])
+
+
+def _sha256(fname, chunk=2 ** 20):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def registry_file(arch, weights_dir=None):
+    name, url = _parse_arch(arch)
+    suffix = 'swsl' if url in semi_weakly_supervised_model_urls.values() else 'ssl'
+    return os.path.join(weights_dir or WEIGHTS_DIR, '{}_{}.pth'.format(name, suffix))
+
+
+def is_cached(arch, weights_dir=None, verify=False):
+    """
+    The weights of arch are in the registry and match their marker: same size, and same sha256 with verify
+    (reads the whole file, done once when the weights are added).
+    """
+    fname = registry_file(arch, weights_dir)
+    try:
+        with open(fname + '.json') as f:
+            marker = json.load(f)
+        if os.path.getsize(fname) != marker['size']:
+            return False
+    except (OSError, ValueError, KeyError):
+        return False
+    return not verify or _sha256(fname) == marker['sha256']
+
+
+def fetch_weights(arch, weights_dir=None, offline=None, progress=True):
+    """
+    Path of the registry weights of arch, downloaded and added to the registry if needed.
+    The download is checked against the hash prefix in its file name (torch.hub convention).
+    """
+    from utiles.checkpoint import atomic_save
+    if offline is None:
+        offline = os.environ.get('PANDA_OFFLINE', '0') not in ('', '0')
+    fname = registry_file(arch, weights_dir)
+    if is_cached(arch, weights_dir):
+        return fname
+    if offline:
+        raise FileNotFoundError('{} weights are not in the registry {} (offline mode), add them with '
+                                'python utiles/hubconf.py {} on a machine with network access and copy the folder'
+                                .format(arch, os.path.dirname(fname), arch))
+    name, url = _parse_arch(arch)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    download = '{}.download{}'.format(fname, os.getpid())
+    try:
+        hash_prefix = os.path.basename(url).rsplit('-', 1)[-1].split('.')[0]
+        download_url_to_file(url, download, hash_prefix=hash_prefix, progress=progress)
+        ## full state dict of the current torchvision layout (e.g. BatchNorm num_batches_tracked), zipfile format
+        model = _architecture(name)
+        model.load_state_dict(torch.load(download, map_location='cpu'))
+        atomic_save(model.state_dict(), fname)
+    finally:
+        if os.path.exists(download):
+            os.remove(download)
+    marker = {'arch': arch, 'url': url, 'size': os.path.getsize(fname), 'sha256': _sha256(fname)}
+    with open(fname + '.json.tmp', 'w') as f:
+        json.dump(marker, f, indent=2)
+    os.replace(fname + '.json.tmp', fname + '.json')
+    return fname
+
+
+def build_backbone(arch='resnext50_32x4d_ssl', pretrained=True, weights_dir=None, offline=None, mmap=True):
+    """
+    Construct a (semi-)weakly supervised ResNet/ResNeXt, with the registry weights if pretrained.
+    The network is built on the meta device (no allocation, no random init) and the weights are assigned
+    from the memory-mapped registry file (torch >= 2.1; older versions build on cpu and copy).
+    Args:
+        arch (string): e.g. resnext50_32x4d_ssl, resnext50_32x4d_swsl, resnext50_32x4d (ssl).
+        pretrained (bool): load the registry weights, otherwise random init.
+        offline (bool): never download, default: env PANDA_OFFLINE.
+        mmap (bool): memory-map the weights file instead of reading it.
+    """
+    name, _ = _parse_arch(arch)
+    if not pretrained:
+        return _architecture(name)
+    from utiles.checkpoint import load_checkpoint
+    state_dict = load_checkpoint(fetch_weights(arch, weights_dir, offline), mmap=mmap)
+    try:
+        with torch.device('meta'):
+            model = _architecture(name)
+        model.load_state_dict(state_dict, assign=True)
+    except (AttributeError, TypeError):
+        ## torch < 2.1: no device context manager or no assign
+        model = _architecture(name)
+        model.load_state_dict(state_dict)
+    return model
+
+
+if __name__ == '__main__':
+    import sys, argparse
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description='Add backbone weights to the local registry (for offline nodes)')
+    parser.add_argument('archs', nargs='+', help='e.g. resnext50_32x4d_ssl')
+    parser.add_argument('--weights_dir', default=None, help='default: env PANDA_WEIGHTS_DIR or ~/.cache/panda/weights')
+    parser.add_argument('--verify', action='store_true', help='check the sha256 of the registry files')
+    args = parser.parse_args()
+    for arch in args.archs:
+        fname = fetch_weights(arch, args.weights_dir, offline=False)
+        print(arch, fname, 'ok' if is_cached(arch, args.weights_dir, verify=args.verify) else 'CORRUPTED')
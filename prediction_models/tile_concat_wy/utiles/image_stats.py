@@ -0,0 +1,178 @@
+import os
+import json
+import zipfile
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+
+class RunningMoments(object):
+    """
+    Mergeable per channel mean/variance (Chan et al. parallel algorithm) of uint8 pixels scaled to [0, 1],
+    with an optional 256 bins histogram per channel.
+    """
+    def __init__(self, n_channels = 3, hist = False):
+        self.count = 0
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+        self.hist = np.zeros((n_channels, 256), dtype=np.int64) if hist else None
+
+    def update(self, pixels):
+        """
+        pixels: uint8 array (..., n_channels)
+        """
+        pixels = pixels.reshape(-1, self.mean.shape[0])
+        batch = RunningMoments(self.mean.shape[0])
+        x = pixels / 255.0
+        batch.count = len(x)
+        batch.mean = x.mean(0)
+        batch.m2 = ((x - batch.mean) ** 2).sum(0)
+        self.merge(batch)
+        if self.hist is not None:
+            for c in range(pixels.shape[1]):
+                self.hist[c] += np.bincount(pixels[:, c], minlength=256)
+        return self
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        if self.hist is not None and other.hist is not None:
+            self.hist += other.hist
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def to_dict(self):
+        stats = {'mean': self.mean.tolist(), 'std': self.std.tolist(), 'count': int(self.count)}
+        if self.hist is not None:
+            stats['hist'] = self.hist.tolist()
+        return stats
+
+## Tile sources. Sources only keep paths so they can be sent to worker processes, files are opened lazily.
+class ZipSource(object):
+    """png tiles in a zip file (write_2_zip output)"""
+    def __init__(self, path):
+        self.path = path
+        self._zip = None
+
+    def keys(self):
+        with zipfile.ZipFile(self.path) as f:
+            return [name for name in f.namelist() if name.endswith('.png')]
+
+    def read(self, key):
+        import cv2
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.path)
+        img = cv2.imdecode(np.frombuffer(self._zip.read(key), dtype=np.uint8), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def __getstate__(self):
+        return {'path': self.path, '_zip': None}
+
+class FolderSource(object):
+    """image files in a folder"""
+    def __init__(self, path, ext = '.png'):
+        self.path = path
+        self.ext = ext
+
+    def keys(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith(self.ext))
+
+    def read(self, key):
+        from PIL import Image
+        return np.asarray(Image.open(os.path.join(self.path, key)).convert('RGB'))
+
+class NpySource(object):
+    """(num_slides, N, sz, sz, 3) uint8 tile store (write_2_zip out_format='npy'), one key per slide"""
+    def __init__(self, path):
+        self.path = path
+        self._tiles = None
+
+    def keys(self):
+        return list(range(len(np.load(self.path, mmap_mode='r'))))
+
+    def read(self, key):
+        if self._tiles is None:
+            self._tiles = np.load(self.path, mmap_mode='r')
+        return np.asarray(self._tiles[key])
+
+    def __getstate__(self):
+        return {'path': self.path, '_tiles': None}
+
+class LmdbSource(object):
+    """tiles env written by preprocessing/generate_tiles.py, tiles are raw (tile_size, tile_size, 3) uint8"""
+    def __init__(self, path, tile_size):
+        self.path = path
+        self.tile_size = tile_size
+        self._env = None
+
+    def _open(self):
+        import lmdb
+        return lmdb.open(self.path, max_readers=3, readonly=True, lock=False, readahead=False, meminit=False)
+
+    def keys(self):
+        env = self._open()
+        with env.begin(write=False) as txn:
+            keys = list(txn.cursor().iternext(keys=True, values=False))
+        env.close()
+        return keys
+
+    def read(self, key):
+        if self._env is None:
+            self._env = self._open()
+        with self._env.begin(write=False) as txn:
+            return np.frombuffer(txn.get(key), dtype=np.uint8).reshape(self.tile_size, self.tile_size, 3)
+
+    def __getstate__(self):
+        return {'path': self.path, 'tile_size': self.tile_size, '_env': None}
+
+def _chunk_moments(job):
+    source, keys, hist = job
+    moments = RunningMoments(hist=hist)
+    for key in keys:
+        moments.update(source.read(key))
+    return moments
+
+def compute_stats(source, num_workers = 4, chunk_size = 256, hist = False):
+    """
+    Channel mean/std of all tiles in source. Keys are split in chunks of chunk_size, each chunk is reduced to
+    RunningMoments by a worker and merged in the main process, so memory does not grow with the dataset size.
+    :return: RunningMoments
+    """
+    keys = source.keys()
+    jobs = [(source, keys[i: i + chunk_size], hist) for i in range(0, len(keys), chunk_size)]
+    moments = RunningMoments(hist=hist)
+    pool = Pool(num_workers) if num_workers > 0 else None
+    try:
+        results = pool.imap_unordered(_chunk_moments, jobs) if pool else map(_chunk_moments, jobs)
+        for chunk_moments in tqdm(results, total=len(jobs), desc='stats'):
+            moments.merge(chunk_moments)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return moments
+
+def save_stats(moments, json_file):
+    with open(json_file, 'w') as f:
+        json.dump(moments.to_dict(), f)
+
+def load_stats(json_file):
+    """
+    :return: channel mean and std lists
+    """
+    with open(json_file) as f:
+        stats = json.load(f)
+    return stats['mean'], stats['std']
+
+def get_stats(json_file, source, num_workers = 4):
+    """Load the channel mean and std from json_file, compute them from source and save them if it doesn't exist."""
+    if not os.path.isfile(json_file):
+        save_stats(compute_stats(source, num_workers), json_file)
+    return load_stats(json_file)
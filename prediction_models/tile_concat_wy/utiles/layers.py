@@ -0,0 +1,25 @@
+import torch
+import torch.nn as nn
+
+## the head layers of fastai v1 (fastai.layers), without importing fastai: same class names and no parameters,
+## so checkpoints and model.export.ExportModel are unchanged
+
+class AdaptiveConcatPool2d(nn.Module):
+    """Layer that concats `AdaptiveAvgPool2d` and `AdaptiveMaxPool2d`"""
+    def __init__(self, sz = None):
+        super().__init__()
+        self.output_size = sz or 1
+        self.ap = nn.AdaptiveAvgPool2d(self.output_size)
+        self.mp = nn.AdaptiveMaxPool2d(self.output_size)
+
+    def forward(self, x):
+        return torch.cat([self.mp(x), self.ap(x)], 1)
+
+class Flatten(nn.Module):
+    """Flatten x to a single dimension, often used at the end of a model. full for rank-1 tensor"""
+    def __init__(self, full = False):
+        super().__init__()
+        self.full = full
+
+    def forward(self, x):
+        return x.view(-1) if self.full else x.view(x.size(0), -1)
@@ -0,0 +1,91 @@
+import numpy as np
+
+def confusion_matrix(preds, labels, n_classes = 6):
+    """(n_classes, n_classes) counts, rows: predictions, columns: labels"""
+    preds = np.asarray(preds, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int64)
+    return np.bincount(preds * n_classes + labels, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+def quadratic_weighted_kappa(conf):
+    """
+    Quadratic weighted kappa of one (n, n) or a batch (..., n, n) of confusion matrices,
+    same value as sklearn cohen_kappa_score(weights='quadratic') on the underlying predictions when all n classes
+    occur in them (sklearn re-indexes the labels present, which changes the weights otherwise).
+    """
+    conf = np.asarray(conf, dtype=np.float64)
+    n = conf.shape[-1]
+    weights = (np.arange(n)[:, None] - np.arange(n)[None, :]) ** 2 / (n - 1) ** 2
+    total = conf.sum((-2, -1), keepdims=True)
+    expected = conf.sum(-1, keepdims=True) * conf.sum(-2, keepdims=True) / np.maximum(total, 1)
+    observed = (weights * conf).sum((-2, -1))
+    chance = (weights * expected).sum((-2, -1))
+    return 1 - observed / np.where(chance == 0, 1, chance)
+
+def search_thresholds(hist, edges, init = (0.5, 1.5, 2.5, 3.5, 4.5), n_iter = 3):
+    """
+    Regression thresholds maximizing the quadratic weighted kappa, from a score histogram.
+    Coordinate search where all positions of one threshold are evaluated at once: with cumulative histograms,
+    the confusion matrices of every candidate are built and scored in a single vectorized step.
+    :param hist: (n_bins, n_classes) counts of scores in each bin for each label
+    :param edges: (n_bins + 1, ) bin edges, thresholds are chosen among them
+    :param init: initial thresholds, n_classes - 1 increasing values
+    :return: thresholds (list), kappa
+    """
+    n_bins, n_classes = hist.shape
+    cum = np.concatenate([np.zeros((1, n_classes)), np.cumsum(hist, 0)])  # (n_bins + 1, n_classes)
+    ## thresholds as edge indices k[1:-1] (k[0] = 0, k[-1] = n_bins): class c covers the bins [k[c], k[c + 1])
+    k = np.concatenate([[0], np.clip(np.searchsorted(edges, init), 0, n_bins), [n_bins]])
+    k = np.maximum.accumulate(k)
+    conf = cum[k[1:]] - cum[k[:-1]]
+    best = quadratic_weighted_kappa(conf)
+    for _ in range(n_iter):
+        changed = False
+        for i in range(1, n_classes):
+            candidates = np.arange(k[i - 1], k[i + 1] + 1)
+            confs = np.repeat(conf[None], len(candidates), 0)
+            confs[:, i - 1] = cum[candidates] - cum[k[i - 1]]
+            confs[:, i] = cum[k[i + 1]] - cum[candidates]
+            kappas = quadratic_weighted_kappa(confs)
+            j = np.argmax(kappas)
+            if kappas[j] > best + 1e-12:
+                best, k[i], conf = kappas[j], candidates[j], confs[j]
+                changed = True
+        if not changed:
+            break
+    return edges[k[1:-1]].tolist(), float(best)
+
+class StreamingKappa(object):
+    """
+    Quadratic weighted kappa accumulated batch by batch: a confusion matrix of the rounded predictions and,
+    for regression outputs, a per-label histogram of the raw scores to optimize the thresholds at the end.
+    """
+    def __init__(self, n_classes = 6, score_range = (-1.0, 6.0), n_bins = 700):
+        self.n_classes = n_classes
+        self.conf = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.edges = np.linspace(score_range[0], score_range[1], n_bins + 1)
+        self.hist = np.zeros((n_bins, n_classes), dtype=np.int64)
+
+    def update(self, outputs, labels):
+        """
+        outputs: (bs, ) regression scores or (bs, n_classes) class scores
+        labels: (bs, ) int labels
+        """
+        outputs = outputs.detach().float().cpu()
+        labels = labels.detach().cpu().long().numpy()
+        if outputs.dim() > 1:
+            preds = outputs.argmax(1).numpy()
+        else:
+            scores = outputs.numpy()
+            preds = np.clip(np.round(scores), 0, self.n_classes - 1).astype(np.int64)
+            bins = np.clip(np.searchsorted(self.edges, scores, side='right') - 1, 0, len(self.hist) - 1)
+            self.hist += np.bincount(bins * self.n_classes + labels,
+                                     minlength=self.hist.size).reshape(self.hist.shape)
+        self.conf += confusion_matrix(preds, labels, self.n_classes)
+
+    def kappa(self):
+        return float(quadratic_weighted_kappa(self.conf))
+
+    def optimize_thresholds(self, n_iter = 3):
+        """return: thresholds (list), kappa with these thresholds (regression outputs only)"""
+        init = np.arange(self.n_classes - 1) + 0.5
+        return search_thresholds(self.hist, self.edges, init, n_iter)
@@ -0,0 +1,80 @@
+import os, time
+import torch
+
+def rss_mb():
+    """resident set size of this process in MB (linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return float('nan')
+
+class StageTimer(object):
+    """
+    Per-iteration stage timer with a few perf_counter calls per stage, cheap enough to leave on:
+    lap(stage) adds the time since the previous lap to the stage. Stage names are free.
+    Without sync, GPU work is only measured where the code waits for it (e.g. loss.item()).
+    """
+    def __init__(self, sync = None):
+        """
+        Args:
+            sync (callable, optional): called before each lap, e.g. torch.cuda.synchronize for exact GPU stages.
+        """
+        self.sync = sync
+        self.totals = {}
+        self.n_iters = 0
+        self.n_samples = 0
+        self.first_batch_s = None
+        self.peak_rss_mb = 0.0
+
+    def start(self):
+        self.start_time = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        if self.sync is not None:
+            self.sync()
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+        if self.first_batch_s is None:
+            ## the first lap of the epoch ends when the first batch is available
+            self.first_batch_s = now - self.start_time
+        self.last = now
+
+    def step(self, n_samples):
+        """end of an iteration of n_samples samples"""
+        self.n_iters += 1
+        self.n_samples += n_samples
+        self.peak_rss_mb = max(self.peak_rss_mb, rss_mb())
+
+    def stats(self, prefix = ''):
+        """
+        return: dict with the total seconds of each stage, the fraction of time waiting on data,
+        samples/s, iterations, first batch latency and RSS
+        """
+        elapsed = time.perf_counter() - self.start_time
+        stats = {'{}{}_s'.format(prefix, stage): t for stage, t in self.totals.items()}
+        stats.update({
+            prefix + 'epoch_s': elapsed,
+            prefix + 'iters': self.n_iters,
+            prefix + 'samples_per_s': self.n_samples / max(elapsed, 1e-9),
+            prefix + 'first_batch_s': self.first_batch_s or 0.0,
+            prefix + 'data_frac': self.totals.get('data', 0.0) / max(elapsed, 1e-9),
+            prefix + 'peak_rss_mb': self.peak_rss_mb,
+        })
+        return stats
+
+def step_profiler(out_dir, start, steps):
+    """
+    torch.profiler for iterations [start, start + steps) of an epoch, call .step() after every iteration.
+    The trace is written for TensorBoard (torch-tb-profiler) in out_dir.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    ## one warmup step before the window, skip_first accounts for it
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(skip_first=max(start - 1, 0), wait=0,
+                                                                   warmup=1 if start > 0 else 0, active=steps,
+                                                                   repeat=1),
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(out_dir),
+                                  record_shapes=True, profile_memory=True)
@@ -594,4 +594,136 @@ def Over9000(params, alpha=0.5, k=6, *args, **kwargs):
      ralamb = Ralamb(params, *args, **kwargs)
      return Lookahead(ralamb, alpha, k)
 
-RangerLars = Over9000
\ No newline at end of file
+RangerLars = Over9000
+
+def _foreach_copy_(dst, src):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+# Ralamb with torch._foreach_* multi-tensor ops: same update as Ralamb for fp32 parameters
+class FusedRalamb(Optimizer):
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, state_dtype=None):
+        """
+        state_dtype: dtype of exp_avg and exp_avg_sq (e.g. torch.bfloat16 to halve the state memory),
+            the update is computed in fp32. None: fp32 state, same results as Ralamb.
+        """
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        self.buffer = [[None, None, None] for ind in range(10)]
+        self.state_dtype = state_dtype
+        super(FusedRalamb, self).__init__(params, defaults)
+
+    def __setstate__(self, state):
+        super(FusedRalamb, self).__setstate__(state)
+
+    def _radam_step(self, group, step):
+        ## same cache as Ralamb: shared by all groups for a given step
+        beta1, beta2 = group['betas']
+        buffered = self.buffer[int(step % 10)]
+        if step == buffered[0]:
+            return buffered[1], buffered[2]
+        buffered[0] = step
+        beta2_t = beta2 ** step
+        N_sma_max = 2 / (1 - beta2) - 1
+        N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+        buffered[1] = N_sma
+        if N_sma >= 5:
+            radam_step = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+        else:
+            radam_step = group['lr'] / (1 - beta1 ** step)
+        buffered[2] = radam_step
+        return N_sma, radam_step
+
+    @torch.no_grad()
+    def step(self, closure=None):
+
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            ## parameters are updated together when they are at the same step
+            buckets = defaultdict(list)
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError('Ralamb does not support sparse gradients')
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    dtype = self.state_dtype or torch.float32
+                    state['exp_avg'] = torch.zeros_like(p, dtype=dtype, memory_format=torch.preserve_format)
+                    state['exp_avg_sq'] = torch.zeros_like(p, dtype=dtype, memory_format=torch.preserve_format)
+                state['step'] += 1
+                buckets[state['step']].append(p)
+
+            beta1, beta2 = group['betas']
+            for step, params in buckets.items():
+                N_sma, radam_step = self._radam_step(group, step)
+                grads = [p.grad.float() for p in params]
+                ## fp32 parameters are updated in place, others through an fp32 copy
+                params_fp32 = [p.float() for p in params]
+                ## like p.float(), fp32 states are updated in place and low precision states through an fp32 copy
+                exp_avgs = [self.state[p]['exp_avg'] for p in params]
+                exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+                exp_avgs_fp32 = [t.float() for t in exp_avgs]
+                exp_avg_sqs_fp32 = [t.float() for t in exp_avg_sqs]
+
+                # m_t
+                torch._foreach_mul_(exp_avgs_fp32, beta1)
+                torch._foreach_add_(exp_avgs_fp32, grads, alpha=1 - beta1)
+                # v_t
+                torch._foreach_mul_(exp_avg_sqs_fp32, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs_fp32, grads, grads, value=1 - beta2)
+
+                if group['weight_decay'] != 0:
+                    torch._foreach_add_(params_fp32, params_fp32, alpha=-group['weight_decay'] * group['lr'])
+
+                ## for fp32 parameters Ralamb's weight_norm and radam_norm are both the norm after weight decay
+                norms = torch.stack(torch._foreach_norm(params_fp32))
+                trust_ratio = torch.where(norms > 0, norms.clamp(0, 10) / norms, torch.ones_like(norms))
+                scales = (trust_ratio * -radam_step).tolist()
+
+                if N_sma >= 5:
+                    denom = torch._foreach_sqrt(exp_avg_sqs_fp32)
+                    torch._foreach_add_(denom, group['eps'])
+                    update = torch._foreach_div(exp_avgs_fp32, denom)
+                else:
+                    update = [t.clone() for t in exp_avgs_fp32]
+                torch._foreach_mul_(update, scales)
+                torch._foreach_add_(params_fp32, update)
+
+                for dst, src in [(params, params_fp32), (exp_avgs, exp_avgs_fp32), (exp_avg_sqs, exp_avg_sqs_fp32)]:
+                    copies = [(d, s) for d, s in zip(dst, src) if d.dtype != torch.float32]
+                    if copies:
+                        _foreach_copy_([d for d, _ in copies], [s for _, s in copies])
+
+        return loss
+
+class FusedLookahead(Lookahead):
+    """Lookahead with the slow weights updated by multi-tensor ops"""
+
+    @torch.no_grad()
+    def update_slow(self, group):
+        fast = [p for p in group["params"] if p.grad is not None]
+        for fast_p in fast:
+            param_state = self.state[fast_p]
+            if 'slow_buffer' not in param_state:
+                param_state['slow_buffer'] = torch.empty_like(fast_p.data)
+                param_state['slow_buffer'].copy_(fast_p.data)
+        if not fast:
+            return
+        slow = [self.state[fast_p]['slow_buffer'] for fast_p in fast]
+        fast = [fast_p.data for fast_p in fast]
+        torch._foreach_add_(slow, torch._foreach_sub(fast, slow), alpha=group['lookahead_alpha'])
+        _foreach_copy_(fast, slow)
+
+# Over9000 with multi-tensor Ralamb and Lookahead
+def FusedOver9000(params, alpha=0.5, k=6, *args, **kwargs):
+     ralamb = FusedRalamb(params, *args, **kwargs)
+     return FusedLookahead(ralamb, alpha, k)
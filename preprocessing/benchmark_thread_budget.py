@@ -0,0 +1,116 @@
+"""
+Find the best split of the cores between tiling processes and threads per process.
+Each candidate (num_ps, threads_per_ps) tiles and normalizes the same slides as generate_tiles.py does,
+without writing the LMDB envs, and reports slides/s and tiles/s. threads 0 leaves the libraries unpinned
+(the behaviour before the thread budget).
+
+benchmark_thread_budget.py --data_dir <root_dat_dir> --n_slides 32 --normalizer vahadane
+"""
+import sys
+import os
+import argparse
+import time
+from multiprocessing import Process, Queue
+import pandas as pd
+sys.path.append("..")
+from preprocessing.tile_generation import generate_grid
+from preprocessing.thread_budget import apply_thread_budget
+
+
+def get_normalizer(method):
+    if method == "reinhard":
+        from preprocessing.normalization import reinhard_bg
+        normalizer = reinhard_bg.ReinhardNormalizer()
+        # use the pre-computed LAB mean and std values
+        normalizer.fit(None)
+        return normalizer
+    if method == "macenko":
+        from preprocessing.normalization.macenko import MacenkoNormalizer
+        return MacenkoNormalizer()
+    from preprocessing.normalization.vahadane import VahadaneNormalizer
+    return VahadaneNormalizer()
+
+
+def benchmark_helper(pqueue, slides_dir, masks_dir, slides, opts, threads_per_ps):
+    if threads_per_ps:
+        apply_thread_budget(threads_per_ps)
+    normalizer = get_normalizer(opts.normalizer)
+    n_tiles = 0
+    for slide_name in slides:
+        tile_generator = generate_grid.TileGeneratorGrid(slides_dir, f"{slide_name}.tiff", masks_dir)
+        if opts.normalizer != "reinhard":
+            # spams normalizers: fit on the first tile of the slide (one more spams call per slide)
+            counter, locations = tile_generator.get_tile_locations(opts.tile_size, opts.overlap, opts.ts_thres)
+            if counter == 0:
+                continue
+            orig_tile, _, _ = tile_generator.extract_tile([int(locations[0][0]), int(locations[0][1])],
+                                                          opts.tile_size)
+            normalizer.fit(orig_tile)
+        _, norm_tiles, _, _, _ = tile_generator.extract_all_tiles(opts.tile_size, opts.overlap, opts.ts_thres,
+                                                                  opts.dw_rate, normalizer)
+        n_tiles += len(norm_tiles)
+    pqueue.put(n_tiles)
+
+
+def run(slides, opts, num_ps, threads_per_ps):
+    pqueue = Queue()
+    processes = []
+    start = time.time()
+    for i in range(num_ps):
+        p = Process(target=benchmark_helper, args=(pqueue, opts.slides_dir, opts.masks_dir, slides[i::num_ps],
+                                                   opts, threads_per_ps))
+        p.start()
+        processes.append(p)
+    n_tiles = sum(pqueue.get() for _ in range(num_ps))
+    for p in processes:
+        p.join()
+    return n_tiles, time.time() - start
+
+
+def candidate_splits(n_cores, max_ps=None):
+    """(num_ps, threads_per_ps) pairs using all cores, plus the unpinned runs (threads 0)"""
+    splits = []
+    num_ps = 1
+    while num_ps <= (max_ps or n_cores):
+        splits.append((num_ps, max(1, n_cores // num_ps)))
+        num_ps *= 2
+    splits += [(num_ps, 0) for num_ps, _ in splits[-2:]]
+    return splits
+
+
+def main(opts):
+    slides = list(pd.read_csv(opts.train_slide_file, index_col="image_id").index)[:opts.n_slides]
+    n_cores = opts.n_cores or os.cpu_count()
+    results = []
+    print("%8s %8s %10s %10s %10s" % ("num_ps", "threads", "time (s)", "slides/s", "tiles/s"))
+    for num_ps, threads_per_ps in candidate_splits(n_cores, opts.max_ps):
+        n_tiles, elapsed = run(slides, opts, num_ps, threads_per_ps)
+        results.append((len(slides) / elapsed, num_ps, threads_per_ps))
+        print("%8d %8d %10.1f %10.3f %10.1f" % (num_ps, threads_per_ps, elapsed, len(slides) / elapsed,
+                                                n_tiles / elapsed))
+    _, num_ps, threads_per_ps = max(results)
+    print("Best split: --num_ps %d --threads_per_ps %d" % (num_ps, threads_per_ps))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="/data/storage_slides/PANDA_challenge/")
+    parser.add_argument("--slides_dir", default="train_images/")
+    parser.add_argument('--masks_dir', default='train_label_masks/')
+    parser.add_argument('--train_slide_file', default="train.csv")
+    parser.add_argument("--n_slides", default=32, type=int, help="Slides tiled by each candidate")
+
+    parser.add_argument("--tile_size", default=512, type=int)
+    parser.add_argument("--overlap", default=0.25, type=float)
+    parser.add_argument("--ts_thres", default=0.5, type=float)
+    parser.add_argument("--dw_rate", default=1, type=int)
+    parser.add_argument("--normalizer", default="reinhard", choices=["reinhard", "macenko", "vahadane"])
+
+    parser.add_argument("--n_cores", default=None, type=int, help="Cores to split, default: all")
+    parser.add_argument("--max_ps", default=None, type=int, help="Largest number of processes to try")
+
+    args = parser.parse_args()
+    args.slides_dir = f"{args.data_dir}/{args.slides_dir}/"
+    args.masks_dir = f"{args.data_dir}/{args.masks_dir}/"
+    args.train_slide_file = f"{args.data_dir}/{args.train_slide_file}"
+    main(args)
@@ -9,12 +9,20 @@ import time
 import lmdb
 sys.path.append("..")
 from preprocessing.tile_generation import generate_grid
-from preprocessing.normalization import reinhard_bg
+from preprocessing.tile_generation.utils import tile_stats
+from preprocessing.tile_generation.utils.mask_codec import MaskCodec, write_codec_info
+from preprocessing.thread_budget import apply_thread_budget, threads_per_process
 
 
-def generate_helper(pqueue, slides_dir, masks_dir, tile_size, overlap, thres, dw_rate, verbose, slides_to_process):
+def generate_helper(pqueue, slides_dir, masks_dir, tile_size, overlap, thres, dw_rate, verbose, slides_to_process,
+                    threads_per_ps=None):
+    # Pin spams/OpenCV/BLAS/torch threads of this worker, otherwise every library uses all cores in every process.
+    if threads_per_ps:
+        apply_thread_budget(threads_per_ps)
     if verbose:
         print("Queue len: %d" % pqueue.qsize())
+    # imported by the reader processes only (OpenCV), the writer process does not need it
+    from preprocessing.normalization import reinhard_bg
     tile_normalizer = reinhard_bg.ReinhardNormalizer()
     # use the pre-computed LAB mean and std values
     tile_normalizer.fit(None)
@@ -39,6 +47,7 @@ def generate_helper(pqueue, slides_dir, masks_dir, tile_size, overlap, thres, dw
             "tissue_masks": tissue_masks,
             "label_masks": label_masks,
             "locations": locations,
+            "tile_stats": tile_stats.compute_tile_stats(tissue_masks, label_masks),
             "status": "normal"
         }
         pqueue.put(data)
@@ -47,10 +56,13 @@ def generate_helper(pqueue, slides_dir, masks_dir, tile_size, overlap, thres, dw
     pqueue.put('Done')
 
 
-def write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations, batch_data, tot_len, start_counter, verbose):
+def write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations, env_tile_stats, batch_data, tot_len,
+                     start_counter, verbose, tissue_codec=MaskCodec("raw"), label_codec=MaskCodec("raw"), timer=None):
+    # timer: optional StageTimer, gets the time spent encoding (tiles and masks to bytes), in txn.put and in commits
     end_counter = start_counter + len(batch_data)
     with env_tiles.begin(write=True) as txn_tiles, env_tissue_masks.begin(write=True) as txn_masks, \
-            env_label_masks.begin(write=True) as txn_labels, env_locations.begin(write=True) as txn_locs:
+            env_label_masks.begin(write=True) as txn_labels, env_locations.begin(write=True) as txn_locs, \
+            env_tile_stats.begin(write=True) as txn_stats:
         while len(batch_data) > 0:
             data = batch_data.pop()
             write_start = time.time()
@@ -58,17 +70,32 @@ def write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations
             # Encode each tile separately
             tot_n_tiles = len(data['norm_tiles'])
             for i in range(tot_n_tiles):
+                if timer is not None:
+                    timer.reset()
                 cur_tile, cur_mask, cur_loc = data['norm_tiles'][i], data['tissue_masks'][i], data['locations'][i]
                 tile_name = f"{slide_name}_{cur_loc[0]}_{cur_loc[1]}"
-                txn_tiles.put(str(tile_name).encode(), cur_tile.astype(np.uint8).tobytes())
-                txn_masks.put(str(tile_name).encode(), cur_mask.astype(np.uint8).tobytes())
+                tile_buff = cur_tile.astype(np.uint8).tobytes()
+                mask_buff = tissue_codec.encode(cur_mask)
                 # Workaround to deal with deciding if an object is None or numpy array
                 if data['label_masks'] is None:
-                    cur_label = None
+                    label_buff = None
                 else:
-                    cur_label = data['label_masks'][i]
-                    txn_labels.put(str(tile_name).encode(), cur_label.astype(np.uint8).tobytes())
+                    label_buff = label_codec.encode(data['label_masks'][i])
+                if timer is not None:
+                    timer.lap("encode")
+                txn_tiles.put(str(tile_name).encode(), tile_buff)
+                txn_masks.put(str(tile_name).encode(), mask_buff)
+                if label_buff is not None:
+                    txn_labels.put(str(tile_name).encode(), label_buff)
+                if timer is not None:
+                    timer.lap("put")
+            txn_stats.put(str(slide_name).encode(), data['tile_stats'].astype(np.int32).tobytes())
             txn_locs.put(str(slide_name).encode(), data['locations'].astype(np.int64).tobytes())
+        if timer is not None:
+            timer.reset()
+    # The transactions are committed when leaving the with block
+    if timer is not None:
+        timer.lap("commit")
     print("Finish writing [%d]/[%d], time: %f" % (end_counter, tot_len, time.time() - write_start))
     return end_counter
 
@@ -81,13 +108,21 @@ def handle_errors(processes, message):
 
 
 def save_tiled_lmdb(slides_list, num_ps, write_batch_size, out_dir, slides_dir, masks_dir, tile_size,
-                    overlap, thres, dw_rate, verbose):
+                    overlap, thres, dw_rate, verbose, tissue_mask_codec="packbits", label_mask_codec="rle",
+                    threads_per_ps=None):
 
     slides_to_process = []
     env_tiles = lmdb.open(f"{out_dir}/tiles", map_size=6e+13)
     env_label_masks = lmdb.open(f"{out_dir}/label_masks", map_size=6e+12)
     env_tissue_masks = lmdb.open(f"{out_dir}/tissue_masks", map_size=6e+12)
     env_locations = lmdb.open(f"{out_dir}/locations", map_size=6e+11)
+    env_tile_stats = lmdb.open(f"{out_dir}/tile_stats", map_size=6e+11)
+    # Masks are encoded, the codec is recorded in each env directory for readers
+    mask_shape = (int(float(tile_size) / float(dw_rate)), int(float(tile_size) / float(dw_rate)))
+    tissue_codec = MaskCodec(tissue_mask_codec, mask_shape)
+    label_codec = MaskCodec(label_mask_codec, mask_shape)
+    write_codec_info(env_tissue_masks, f"{out_dir}/tissue_masks", tissue_codec)
+    write_codec_info(env_label_masks, f"{out_dir}/label_masks", label_codec)
 
     with env_locations.begin(write=False) as txn:
         for slide_name in slides_list:
@@ -96,6 +131,9 @@ def save_tiled_lmdb(slides_list, num_ps, write_batch_size, out_dir, slides_dir,
     # slides_to_process = slides_to_process[:5]
     print("Total %d slides to process" % len(slides_to_process))
     batch_size = len(slides_to_process) // num_ps
+    if threads_per_ps is None:
+        threads_per_ps = threads_per_process(num_ps)
+    print("Use %d processes with %d threads each" % (num_ps, threads_per_ps))
     # Spawn multiple processes to extract tiles: (each handle a portion of data).
     # If any tiled slide becomes available, the main p
     # process will get it from the queue and write to dataset.
@@ -106,14 +144,15 @@ def save_tiled_lmdb(slides_list, num_ps, write_batch_size, out_dir, slides_dir,
         end_idx = start_idx + batch_size
         reader_p = Process(target=generate_helper, args=(pqueue, slides_dir, masks_dir, tile_size,
                                                          overlap, thres, dw_rate, verbose,
-                                                         slides_to_process[start_idx: end_idx]))
+                                                         slides_to_process[start_idx: end_idx], threads_per_ps))
         reader_p.start()
         reader_processes.append(reader_p)
         start_idx = end_idx
     # Ensure all slides are processed by processes.
     reader_p = Process(target=generate_helper, args=(pqueue, slides_dir, masks_dir, tile_size,
                                                      overlap, thres, dw_rate, verbose,
-                                                     slides_to_process[start_idx: len(slides_to_process)]))
+                                                     slides_to_process[start_idx: len(slides_to_process)],
+                                                     threads_per_ps))
     reader_p.start()
     reader_processes.append(reader_p)
 
@@ -139,8 +178,8 @@ def save_tiled_lmdb(slides_list, num_ps, write_batch_size, out_dir, slides_dir,
         if len(batches) == write_batch_size:
             try:
                 counter = \
-                    write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations, batches,
-                                     len(slides_to_process), counter, verbose)
+                    write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations, env_tile_stats,
+                                     batches, len(slides_to_process), counter, verbose, tissue_codec, label_codec)
             except lmdb.KeyExistsError:
                 handle_errors(reader_processes, "Key exist!")
             except lmdb.TlsFullError:
@@ -154,8 +193,9 @@ def save_tiled_lmdb(slides_list, num_ps, write_batch_size, out_dir, slides_dir,
     try:
         # Write the rest data.
         if len(batches) > 0:
-            counter = write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations, batches,
-                                       len(slides_to_process), counter, verbose)
+            counter = write_batch_data(env_tiles, env_tissue_masks, env_label_masks, env_locations, env_tile_stats,
+                                       batches, len(slides_to_process), counter, verbose, tissue_codec,
+                                       label_codec)
     except lmdb.KeyExistsError:
         handle_errors(reader_processes, "Key exist!")
     except lmdb.TlsFullError:
@@ -185,13 +225,17 @@ def save_tiled_lmdb(slides_list, num_ps, write_batch_size, out_dir, slides_dir,
             for loc in locations:
                 slides_tiles_mapping[slide_name].append(f"{slide_name}_{loc[0]}_{loc[1]}")
     json.dump(slides_tiles_mapping, open(f"{out_dir}/slides_tiles_mappding.json", "w"))
+    # Fixed-width table (one row per tile) with tissue count and label histogram, load with np.load(mmap_mode='r')
+    n_tiles = tile_stats.build_tile_stats_table(env_locations, env_tile_stats, f"{out_dir}/tile_stats.npy")
+    print("Write stats for %d tiles" % n_tiles)
 
 
 def main(opts):
     train_df = pd.read_csv(opts.train_slide_file, index_col="image_id")
     slides_list = list(train_df.index)
     save_tiled_lmdb(slides_list, opts.num_ps, opts.write_batch_size, opts.out_dir, opts.slides_dir, opts.masks_dir,
-                    opts.tile_size, opts.overlap, opts.ts_thres, opts.dw_rate, opts.verbose)
+                    opts.tile_size, opts.overlap, opts.ts_thres, opts.dw_rate, opts.verbose,
+                    opts.tissue_mask_codec, opts.label_mask_codec, opts.threads_per_ps)
 
 
 if __name__ == "__main__":
@@ -208,8 +252,15 @@ if __name__ == "__main__":
     parser.add_argument("--ts_thres", default=0.5, type=float)
     parser.add_argument("--dw_rate", default=1, type=int, help="Generate tiles downsampled")
     parser.add_argument("--verbose", action='store_true', help="Whether to print debug information")
+    parser.add_argument("--tissue_mask_codec", default="packbits", choices=["raw", "packbits", "zstd"],
+                        help="Encoding of tissue masks")
+    parser.add_argument("--label_mask_codec", default="rle", choices=["raw", "rle", "zstd"],
+                        help="Encoding of label masks")
 
     parser.add_argument("--num_ps", default=5, type=int, help="How many processor to use")
+    parser.add_argument("--threads_per_ps", default=None, type=int,
+                        help="Threads of spams/OpenCV/BLAS/torch in each process, default: cores // num_ps, "
+                             "0: not pinned")
     parser.add_argument("--write_batch_size", default=10, type=int, help="Write of batch of n slides")
 
     args = parser.parse_args()
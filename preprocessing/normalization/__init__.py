@@ -0,0 +1,21 @@
+"""
+Stain normalizers. The classes are resolved lazily (module __getattr__): importing the package does not load
+OpenCV, skimage or spams, only the module of the normalizer that is used.
+"""
+import importlib
+
+_LAZY_ATTRS = {
+    "ReinhardNormalizer": "reinhard_bg",
+    "MacenkoNormalizer": "macenko",
+    "VahadaneNormalizer": "vahadane",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{_LAZY_ATTRS[name]}"), name)
+    globals()[name] = value
+    return value
@@ -6,7 +6,7 @@ from __future__ import division
 
 from abc import ABC, abstractmethod
 import preprocessing.normalization.utils.misc_utils as mu
-import spams
+from preprocessing.thread_budget import spams_threads
 import numpy as np
 
 
@@ -65,8 +65,10 @@ class FancyNormalizer(Normaliser):
         #     'mode': spams.PENALTY}  # penalized formulation
         # alpha = spams.lasso(X,D = D,return_reg_path = False,**param)
 
+        # deferred: spams is only needed by the Macenko/Vahadane normalizers, not by Reinhard
+        import spams
         OD = mu.RGB_to_OD(I).reshape((-1, 3))  # convert to optical density and flatten to (H*W)x3.
-        return spams.lasso(OD.T, D=stain_matrix.T, mode=2, numThreads=6, lambda1=lamda, pos=True).toarray().T
+        return spams.lasso(OD.T, D=stain_matrix.T, mode=2, numThreads=spams_threads(), lambda1=lamda, pos=True).toarray().T
 
     def fit(self, target):
         """
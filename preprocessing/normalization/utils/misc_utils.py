@@ -4,10 +4,7 @@ Other utilities
 
 from __future__ import division
 
-from skimage import morphology as skmp
-from skimage import color
 import numpy as np
-import cv2 as cv
 
 
 def standardize_brightness(I):
@@ -77,6 +74,9 @@ def normalize_rows(A):
 
 
 def notwhite_mask(tile, thresh=None):
+    # deferred: skimage is only needed by the Macenko/Vahadane normalizers
+    from skimage import color
+    from skimage import morphology as skmp
     tile_hsv = color.rgb2hsv(np.asarray(tile))
     roi1 = (tile_hsv[:, :, 0] >= 0.33) & (tile_hsv[:, :, 0] <= 0.67)
     roi1 = ~roi1
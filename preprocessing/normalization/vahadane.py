@@ -1,7 +1,7 @@
 from __future__ import division
-from build_dataset.normalization.normalizer_abc import FancyNormalizer
-from build_dataset.normalization.utils import misc_utils as mu
-import spams
+from preprocessing.normalization.normalizer_abc import FancyNormalizer
+from preprocessing.normalization.utils import misc_utils as mu
+from preprocessing.thread_budget import spams_threads
 
 
 class VahadaneNormalizer(FancyNormalizer):
@@ -24,10 +24,11 @@ class VahadaneNormalizer(FancyNormalizer):
         :param lamda:
         :return:
         """
+        import spams
         mask = mu.notwhite_mask(I, thresh=threshold).reshape((-1,))
         OD = mu.RGB_to_OD(I).reshape((-1, 3))
         OD = OD[mask]
-        dictionary = spams.trainDL(OD.T, K=2, lambda1=lamda, mode=2, numThreads=6, modeD=0, posAlpha=True, posD=True, verbose=False).T
+        dictionary = spams.trainDL(OD.T, K=2, lambda1=lamda, mode=2, numThreads=spams_threads(), modeD=0, posAlpha=True, posD=True, verbose=False).T
         if dictionary[0, 0] < dictionary[1, 0]:
             dictionary = dictionary[[1, 0], :]
         dictionary = mu.normalize_rows(dictionary)
@@ -0,0 +1,88 @@
+"""
+Mask codecs of the tissue and label mask envs (generate_tiles.py writes packbits tissue masks and rle label masks
+by default): encode / decode roundtrip, one by one and in batches, and the label histograms.
+
+python -m pytest preprocessing/tests/test_mask_codec.py, or python preprocessing/tests/test_mask_codec.py
+"""
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from preprocessing.tile_generation.utils.mask_codec import MaskCodec
+from preprocessing.tile_generation.utils.tile_stats import N_MASK_CLASSES
+
+# (h, w): a tile size and a width that is not a multiple of 8
+SHAPES = [(64, 64), (7, 13)]
+
+
+def codec(name, shape):
+    if name == "zstd":
+        pytest.importorskip("zstandard")
+    return MaskCodec(name, shape)
+
+
+def binary_masks(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    return [np.zeros(shape, dtype=np.uint8), np.ones(shape, dtype=np.uint8),
+            (rng.random_sample(shape) < 0.3).astype(np.uint8)]
+
+
+def label_masks(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    blocky = np.repeat(rng.randint(0, N_MASK_CLASSES, (shape[0], 1)), shape[1], axis=1).astype(np.uint8)
+    return [np.zeros(shape, dtype=np.uint8), np.full(shape, N_MASK_CLASSES - 1, dtype=np.uint8), blocky,
+            rng.randint(0, N_MASK_CLASSES, shape).astype(np.uint8)]
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("name", ["raw", "packbits", "rle", "zstd"])
+def test_binary_roundtrip(name, shape):
+    mask_codec = codec(name, shape)
+    masks = binary_masks(shape)
+    buffs = [mask_codec.encode(mask) for mask in masks]
+    for mask, buff in zip(masks, buffs):
+        assert np.array_equal(mask_codec.decode(buff), mask)
+    out = np.full((len(masks), ) + shape, 7, dtype=np.uint8)
+    assert np.array_equal(mask_codec.decode_batch(buffs, out=out), np.stack(masks))
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("name", ["raw", "rle", "zstd"])
+def test_label_roundtrip(name, shape):
+    mask_codec = codec(name, shape)
+    masks = label_masks(shape)
+    buffs = [mask_codec.encode(mask) for mask in masks]
+    assert np.array_equal(mask_codec.decode_batch(buffs), np.stack(masks))
+    assert mask_codec.decode_batch([]).shape == (0, ) + shape
+
+
+def test_packbits_size():
+    # 1 bit per pixel, the last byte is padded
+    assert len(MaskCodec("packbits", (7, 13)).encode(np.ones((7, 13), dtype=np.uint8))) == (7 * 13 + 7) // 8
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("name", ["raw", "packbits", "rle", "zstd"])
+def test_class_histogram(name, shape):
+    mask_codec = codec(name, shape)
+    masks = binary_masks(shape) if name == "packbits" else label_masks(shape)
+    for mask in masks:
+        hist = mask_codec.class_histogram(mask_codec.encode(mask), N_MASK_CLASSES)
+        assert hist.dtype == np.int64
+        assert np.array_equal(hist, np.bincount(mask.reshape(-1), minlength=N_MASK_CLASSES))
+
+
+if __name__ == "__main__":
+    for test_name, args in [("test_binary_roundtrip", ["raw", "packbits", "rle", "zstd"]),
+                            ("test_label_roundtrip", ["raw", "rle", "zstd"]),
+                            ("test_class_histogram", ["raw", "packbits", "rle", "zstd"])]:
+        for name in args:
+            for shape in SHAPES:
+                try:
+                    globals()[test_name](name, shape)
+                    print(f"{test_name}[{name}-{shape}]: ok")
+                except pytest.skip.Exception as e:
+                    print(f"{test_name}[{name}-{shape}]: skipped, {e}")
+    test_packbits_size()
+    print("test_packbits_size: ok")
@@ -0,0 +1,58 @@
+"""
+One thread budget for the native thread pools of a worker process: spams, OpenCV, BLAS/OpenMP (through
+threadpoolctl) and torch. Without it each library starts one thread per core in each of the num_ps
+processes of generate_tiles.py, and adding processes makes tiling slower.
+Call apply_thread_budget(n_threads) at the start of each worker; the libraries that are not installed are skipped.
+"""
+import os
+import sys
+
+# spams takes the number of threads as an argument of each call, 6 was hard-coded before
+DEFAULT_SPAMS_THREADS = 6
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS")
+
+_spams_threads = None
+_blas_limits = None
+
+
+def threads_per_process(num_ps, n_cores=None):
+    """Split the cores of the machine evenly between num_ps processes (at least one thread each)"""
+    n_cores = n_cores or os.cpu_count() or 1
+    return max(1, n_cores // max(1, num_ps))
+
+
+def apply_thread_budget(n_threads):
+    """
+    Pin every thread pool of the current process to n_threads.
+    The environment variables only affect libraries loaded afterwards (and child processes),
+    threadpoolctl resizes the BLAS/OpenMP pools already loaded.
+    :param n_threads: number of threads of this process
+    :return: n_threads
+    """
+    global _spams_threads, _blas_limits
+    n_threads = max(1, int(n_threads))
+    _spams_threads = n_threads
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        import cv2 as cv
+        cv.setNumThreads(n_threads)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        # keep a reference, the limits hold for the lifetime of the process
+        _blas_limits = threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+    # do not import torch just to configure it: only when it is already loaded
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        torch.set_num_threads(n_threads)
+    return n_threads
+
+
+def spams_threads():
+    """numThreads argument of the spams calls"""
+    return _spams_threads if _spams_threads is not None else DEFAULT_SPAMS_THREADS
@@ -0,0 +1,19 @@
+"""
+Tile generators. TileGeneratorGrid is resolved lazily (module __getattr__): openslide and skimage are only loaded
+when a slide is tiled.
+"""
+import importlib
+
+_LAZY_ATTRS = {
+    "TileGeneratorGrid": "generate_grid",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{_LAZY_ATTRS[name]}"), name)
+    globals()[name] = value
+    return value
@@ -5,7 +5,6 @@ from preprocessing.tile_generation.tile_generation_abc import TileGeneratorABC
 from preprocessing.tile_generation.utils import prep_utils
 from PIL import Image
 import numpy as np
-import openslide
 import time
 from preprocessing.tissue_detection import threshold_based
 
@@ -16,7 +15,7 @@ This code doesn't support dataset that has slides scanned at different highest m
 """
 
 class TileGeneratorGrid(TileGeneratorABC):
-    def __init__(self, slides_dir, slide_name, masks_dir=None, check_ihc=False, verbose=False):
+    def __init__(self, slides_dir, slide_name, masks_dir=None, check_ihc=False, verbose=False, timer=None):
         """
         Create a DeepZoomGenerator wrapping an OpenSlide object.
         :param slides_dir: location for the slide
@@ -24,7 +23,11 @@ class TileGeneratorGrid(TileGeneratorABC):
 
         :param check_ihc: whether to check current slide is IHC slide
         :param verbose: print logs
+        :param timer: optional StageTimer (tile_generation/utils/stage_timer.py), gets the time of each stage
+                      (location_search, region_read, tissue_mask, normalize, resize, label_read)
         """
+        # deferred: only the processes that open slides load openslide
+        import openslide
         self.slide = openslide.OpenSlide(f"{slides_dir}/{slide_name}")
         self.slide_id = slide_name.split(".")[0]
         if os.path.isfile(f'{masks_dir}/{self.slide_id}_mask.tiff'):
@@ -34,11 +37,16 @@ class TileGeneratorGrid(TileGeneratorABC):
 
         # whether to print logs
         self.verbose = verbose
+        self.timer = timer
         self.ihc = prep_utils.check_ihc_slide(self.slide) if check_ihc else False
 
     def is_ihc_slide(self):
         return self.ihc
 
+    def _lap(self, stage):
+        if self.timer is not None:
+            self.timer.lap(stage)
+
     # Generate tiles from grid, with optional overlap
     def get_tile_locations(self, tile_size, overlap, thres):
         """
@@ -50,6 +58,8 @@ class TileGeneratorGrid(TileGeneratorABC):
         :return: counter: how many tiles were generated
                  location_tracker: tile locations
         """
+        if self.timer is not None:
+            self.timer.reset()
         # how much overlap on the required magnification
         overlap = int(overlap * tile_size)
         # Get the lowest rate for ROI
@@ -78,15 +88,20 @@ class TileGeneratorGrid(TileGeneratorABC):
                         location_tracker[counter][0] = int(j * lowest_rate)
                         location_tracker[counter][1] = int(i * lowest_rate)
                         counter += 1
+        self._lap("location_search")
         if self.verbose:
             print("Generate %d tiles in the grid" % counter)
         return counter, location_tracker
 
     # Generate tiles based on location at highest magnification
     def extract_tile(self, location, tile_size, dw_rate=1, normalizer=None):
+        if self.timer is not None:
+            self.timer.reset()
         orig_tile = self.slide.read_region((location[0], location[1]), 0, (tile_size, tile_size))
         orig_tile = np.asarray(orig_tile.convert('RGB'))
+        self._lap("region_read")
         _, tissue_mask = prep_utils.generate_binary_mask(orig_tile)
+        self._lap("tissue_mask")
 
         norm_tile = None
         if normalizer:
@@ -101,18 +116,23 @@ class TileGeneratorGrid(TileGeneratorABC):
                 orig_tile = Image.fromarray(orig_tile)
                 norm_tile = orig_tile
                 orig_tile.save("error_tile.png")
+            self._lap("normalize")
 
         if dw_rate > 1:
             orig_tile = orig_tile.resize((tile_size // dw_rate, tile_size // dw_rate), Image.ANTIALIAS)
             norm_tile = norm_tile.resize((tile_size // dw_rate, tile_size // dw_rate), Image.ANTIALIAS)
             tissue_mask = tissue_mask[::dw_rate, ::dw_rate]
+            self._lap("resize")
         return np.asarray(orig_tile), np.asarray(norm_tile), tissue_mask
 
     def extract_label_mask(self, location, tile_size, dw_rate=1):
+        if self.timer is not None:
+            self.timer.reset()
         tile_mask = self.label_mask.read_region((location[0], location[1]), 0, (tile_size, tile_size))
         tile_mask = np.asarray(tile_mask.split()[0])
         if dw_rate > 1:
             tile_mask = tile_mask[::dw_rate, ::dw_rate]
+        self._lap("label_read")
         return tile_mask
 
     def extract_all_tiles(self, tile_size, overlap, thres, dw_rate, normalizer=None, w_label_mask=True):
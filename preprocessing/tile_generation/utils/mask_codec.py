@@ -0,0 +1,139 @@
+"""
+Compact encodings for tissue masks (0/1) and label masks (0-5) stored in LMDB.
+The codec used by an env is recorded in {env_dir}/mask_codec.json, readers should use MaskCodec.from_env.
+Envs written before the codec layer have no such file and are read as raw uint8 planes.
+"""
+import json
+import os
+import numpy as np
+
+CODEC_INFO_FILE = "mask_codec.json"
+CODECS = ("raw", "packbits", "rle", "zstd")
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd mask codec requires the zstandard package: pip install zstandard")
+    return zstandard
+
+
+class MaskCodec:
+    def __init__(self, name="raw", shape=None, zstd_level=3):
+        """
+        :param name: raw: uint8 plane, packbits: 1 bit per pixel (binary masks only),
+                     rle: run-length encoded uint8 values, zstd: zstd compressed uint8 plane
+        :param shape: (h, w) of the decoded masks
+        :param zstd_level: compression level for zstd
+        """
+        if name not in CODECS:
+            raise ValueError(f"Unknown mask codec {name}, should be one of {CODECS}")
+        self.name = name
+        self.shape = tuple(shape) if shape is not None else None
+        self.zstd_level = zstd_level
+        if name == "zstd":
+            zstandard = _import_zstd()
+            self._compressor = zstandard.ZstdCompressor(level=zstd_level)
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    @classmethod
+    def from_env(cls, env_dir, shape=None):
+        info = read_codec_info(env_dir)
+        if info is None:
+            return cls("raw", shape)
+        return cls(info["codec"], info["shape"] if shape is None else shape, info.get("zstd_level", 3))
+
+    def encode(self, mask):
+        mask = np.ascontiguousarray(mask, dtype=np.uint8).reshape(-1)
+        if self.name == "raw":
+            return mask.tobytes()
+        if self.name == "packbits":
+            return np.packbits(mask != 0).tobytes()
+        if self.name == "rle":
+            # Start of each run, values and lengths of runs
+            starts = np.concatenate([[0], np.flatnonzero(mask[1:] != mask[:-1]) + 1])
+            lengths = np.diff(np.append(starts, len(mask))).astype(np.uint32)
+            values = mask[starts]
+            return np.uint32(len(starts)).tobytes() + values.tobytes() + lengths.tobytes()
+        return self._compressor.compress(mask.tobytes())
+
+    def _runs(self, buff):
+        buff = memoryview(buff)
+        n_runs = int(np.frombuffer(buff[:4], dtype=np.uint32)[0])
+        values = np.frombuffer(buff[4: 4 + n_runs], dtype=np.uint8)
+        lengths = np.frombuffer(buff[4 + n_runs: 4 + 5 * n_runs], dtype=np.uint32)
+        return values, lengths
+
+    def decode(self, buff):
+        """Decode one buffer to a (h, w) uint8 mask"""
+        return self.decode_batch([buff])[0]
+
+    def decode_batch(self, buffs, out=None):
+        """
+        Decode a list of buffers into a (n, h, w) uint8 array
+        :param buffs: encoded masks
+        :param out: optional preallocated (n, h, w) uint8 array
+        """
+        n_pixels = self.shape[0] * self.shape[1]
+        if out is None:
+            out = np.empty((len(buffs), ) + self.shape, dtype=np.uint8)
+        if len(buffs) == 0:
+            return out
+        flat_out = out.reshape(len(buffs), n_pixels)
+        if self.name == "raw":
+            flat_out[:] = np.frombuffer(b"".join(buffs), dtype=np.uint8).reshape(len(buffs), n_pixels)
+        elif self.name == "packbits":
+            packed = np.frombuffer(b"".join(buffs), dtype=np.uint8).reshape(len(buffs), -1)
+            flat_out[:] = np.unpackbits(packed, axis=1, count=n_pixels)
+        elif self.name == "rle":
+            runs = [self._runs(buff) for buff in buffs]
+            values = np.concatenate([run[0] for run in runs])
+            lengths = np.concatenate([run[1] for run in runs])
+            flat_out[:] = np.repeat(values, lengths).reshape(len(buffs), n_pixels)
+        else:
+            for i, buff in enumerate(buffs):
+                flat_out[i] = np.frombuffer(self._decompressor.decompress(buff, max_output_size=n_pixels),
+                                            dtype=np.uint8)
+        return out
+
+    def class_histogram(self, buff, minlength):
+        """Pixel count per mask value, run-length encoded masks are counted without decoding"""
+        if self.name == "rle":
+            values, lengths = self._runs(buff)
+            return np.bincount(values, weights=lengths, minlength=minlength)[:minlength].astype(np.int64)
+        if self.name == "raw":
+            mask = np.frombuffer(buff, dtype=np.uint8)
+        else:
+            mask = self.decode(buff).reshape(-1)
+        return np.bincount(mask, minlength=minlength)[:minlength]
+
+    def info(self):
+        info = {"codec": self.name, "shape": list(self.shape)}
+        if self.name == "zstd":
+            info["zstd_level"] = self.zstd_level
+        return info
+
+
+def read_codec_info(env_dir):
+    info_file = os.path.join(env_dir, CODEC_INFO_FILE)
+    if not os.path.isfile(info_file):
+        return None
+    with open(info_file) as f:
+        return json.load(f)
+
+
+def write_codec_info(env, env_dir, codec):
+    """
+    Record the codec of an env. Refuse to mix codecs when appending to an env written with another codec.
+    :param env: opened LMDB env, used to detect envs written before the codec layer
+    """
+    info = read_codec_info(env_dir)
+    if info is None:
+        # Existing data without codec info is raw
+        if env.stat()["entries"] > 0 and codec.name != "raw":
+            raise ValueError(f"{env_dir} already has raw masks, can't append masks encoded with {codec.name}")
+    elif info["codec"] != codec.name or list(info["shape"]) != list(codec.shape):
+        raise ValueError(f"{env_dir} was written with {info}, can't append with {codec.info()}")
+    with open(os.path.join(env_dir, CODEC_INFO_FILE), "w") as f:
+        json.dump(codec.info(), f)
@@ -1,7 +1,5 @@
-from skimage import color
 import numpy as np
-import openslide
-from skimage import morphology as skmp
+# skimage and openslide are imported in the functions that use them, importing this module stays cheap
 
 
 def check_ihc_slide(slide):
@@ -10,6 +8,8 @@ def check_ihc_slide(slide):
     :param slide:
     :return:
     """
+    from skimage import color
+    from skimage import morphology as skmp
     sample = slide.read_region((0, 0), slide.level_count - 1,
                               (slide.level_dimensions[slide.level_count - 1][0],
                                slide.level_dimensions[slide.level_count - 1][1]))
@@ -32,6 +32,8 @@ def generate_binary_mask(tile):
     :param tile:
     :return:
     """
+    from skimage import color
+    from skimage import morphology as skmp
     tile_hsv = color.rgb2hsv(np.asarray(tile))
     roi1 = (tile_hsv[:, :, 0] >= 0.33) & (tile_hsv[:, :, 0] <= 0.67)
     roi1 = ~roi1
@@ -50,6 +52,7 @@ def generate_binary_mask(tile):
 
 
 def read_downsample_slide(slides_dir, slide_name):
+    import openslide
     slide = openslide.OpenSlide(f"{slides_dir}/{slide_name}")
     level = slide.level_count
     level -= 1
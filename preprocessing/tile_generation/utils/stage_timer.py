@@ -0,0 +1,29 @@
+"""
+Wall time per pipeline stage, cheap enough to leave in the tile generation and writing loops
+(a perf_counter call per stage boundary). Stage names are free.
+Same lap/totals/stats as the training StageTimer (prediction_models/tile_concat_wy/utiles/profiling.py), which also
+tracks iterations, throughput and RSS; kept apart so that preprocessing does not import the model code or torch.
+"""
+import time
+
+
+class StageTimer:
+    def __init__(self):
+        self.totals = {}
+        self.last = time.perf_counter()
+
+    def reset(self):
+        """start timing from now, the time since the last lap is not attributed to any stage"""
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """add the time since the previous lap (or reset) to stage"""
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def stats(self):
+        """
+        :return: {stage: total seconds}
+        """
+        return dict(self.totals)
@@ -0,0 +1,75 @@
+"""
+Per-tile statistics computed at tile generation time.
+Each tile gets a tissue pixel count and a histogram of its label mask values, so that label generation,
+tile sampling and dataset statistics can run without decoding the mask environments.
+"""
+import numpy as np
+
+# Number of label values in PANDA masks. Radboud: 0 background, 1 stroma, 2 benign epithelium, 3-5 Gleason 3-5.
+# Karolinska: 0 background, 1 benign tissue, 2 cancerous tissue.
+N_MASK_CLASSES = 6
+# Per slide record stored in LMDB: [tissue_count, class_hist_0, ..., class_hist_5] for each tile
+N_STATS_COLUMNS = 1 + N_MASK_CLASSES
+
+
+def tile_stats_dtype(slide_name_len):
+    return np.dtype([("slide_name", f"S{slide_name_len}"), ("loc_x", np.int64), ("loc_y", np.int64),
+                     ("tissue_count", np.int32), ("class_hist", np.int32, (N_MASK_CLASSES, ))])
+
+
+def compute_tile_stats(tissue_masks, label_masks):
+    """
+    :param tissue_masks: (n_tiles, h, w) binary tissue masks
+    :param label_masks: (n_tiles, h, w) label masks, or None if the slide has no label mask
+    :return: (n_tiles, N_STATS_COLUMNS) int32, tissue pixel count followed by the label histogram.
+             The histogram is all zero when there is no label mask.
+    """
+    n_tiles = len(tissue_masks)
+    stats = np.zeros((n_tiles, N_STATS_COLUMNS), dtype=np.int32)
+    stats[:, 0] = np.count_nonzero(tissue_masks.reshape(n_tiles, -1), axis=1)
+    if label_masks is not None:
+        for i in range(n_tiles):
+            stats[i, 1:] = np.bincount(label_masks[i].reshape(-1), minlength=N_MASK_CLASSES)[:N_MASK_CLASSES]
+    return stats
+
+
+def decode_slide_stats(buff):
+    return np.frombuffer(buff, dtype=np.int32).reshape(-1, N_STATS_COLUMNS)
+
+
+def build_tile_stats_table(env_locations, env_tile_stats, out_file):
+    """
+    Gather the per slide records into one fixed-width table with a row per tile and save it as .npy
+    :param env_locations: LMDB env with tile locations of each slide
+    :param env_tile_stats: LMDB env with tile stats of each slide
+    :param out_file: .npy file, load with load_tile_stats
+    :return: number of tiles in the table
+    """
+    slide_names, locations, stats = [], [], []
+    with env_locations.begin(write=False) as txn_locs, env_tile_stats.begin(write=False) as txn_stats:
+        for slide_name, slide_stats in txn_stats.cursor():
+            slide_locations = txn_locs.get(slide_name)
+            if slide_locations is None:
+                continue
+            slide_names.append(slide_name)
+            locations.append(np.frombuffer(slide_locations, dtype=np.int64).reshape(-1, 2))
+            stats.append(decode_slide_stats(slide_stats))
+    n_tiles = sum(len(slide_locations) for slide_locations in locations)
+    name_len = max([len(slide_name) for slide_name in slide_names], default=1)
+    table = np.zeros(n_tiles, dtype=tile_stats_dtype(name_len))
+    start = 0
+    for slide_name, slide_locations, slide_stats in zip(slide_names, locations, stats):
+        end = start + len(slide_locations)
+        table["slide_name"][start: end] = slide_name
+        table["loc_x"][start: end] = slide_locations[:, 0]
+        table["loc_y"][start: end] = slide_locations[:, 1]
+        table["tissue_count"][start: end] = slide_stats[:, 0]
+        table["class_hist"][start: end] = slide_stats[:, 1:]
+        start = end
+    np.save(out_file, table)
+    return n_tiles
+
+
+def load_tile_stats(stats_file):
+    """Memory map the table written by build_tile_stats_table"""
+    return np.load(stats_file, mmap_mode="r")
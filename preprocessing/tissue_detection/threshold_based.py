@@ -1,9 +1,10 @@
 import numpy as np
-from skimage import color
-from skimage import morphology as skmp
 
 
 def get_tissue_area(slide):
+    # deferred: skimage takes a large part of the import time of the tiling modules
+    from skimage import color
+    from skimage import morphology as skmp
     level = slide.level_count
     level -= 1
     dw_samples_dim = slide.level_dimensions[level]